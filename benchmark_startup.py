@@ -0,0 +1,91 @@
+'''
+Measure how long ptycho_gui takes until its main window is shown.
+
+usage: python benchmark_startup.py [-n RUNS] [--top N] [--max-seconds S]
+
+Each run starts a new interpreter with PTYCHO_STARTUP_BENCHMARK set, which makes the GUI report
+the time the window is shown and quit (see ptycho_gui.main). The "cold" run compiles every module
+from scratch (empty bytecode cache), the "warm" runs are ordinary relaunches. A breakdown of the
+import time by package (python -X importtime) follows. With --max-seconds, the exit code is 1
+if the median warm start is slower, so it can guard against regressions.
+'''
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _env(pycache_prefix=None):
+    env = dict(os.environ)
+    env['PTYCHO_STARTUP_BENCHMARK'] = '1'
+    env.setdefault('QT_QPA_PLATFORM', 'offscreen') # no display needed
+    if pycache_prefix is not None:
+        env['PYTHONPYCACHEPREFIX'] = pycache_prefix
+    return env
+
+
+def time_to_window(pycache_prefix=None, extra_args=()):
+    '''
+    Start ptycho_gui.py and return (seconds until the window is shown, stderr)
+    '''
+    t = time.time()
+    proc = subprocess.run([sys.executable] + list(extra_args) + ['ptycho_gui.py'], cwd=HERE,
+                          env=_env(pycache_prefix), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, timeout=300)
+    for line in proc.stdout.splitlines():
+        if line.startswith('[STARTUP] window shown at '):
+            return float(line.split()[-1]) - t, proc.stderr
+    raise RuntimeError("the window was never shown:\n" + proc.stdout + proc.stderr)
+
+
+def import_breakdown(stderr:str):
+    '''
+    Parse the output of python -X importtime into a list of (seconds, package), the time spent
+    importing the modules of each top-level package (ex: matplotlib, h5py), slowest first
+    '''
+    totals = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        # the own time of each module, so that nested imports are counted once, in their package
+        totals[package] = totals.get(package, 0.) + int(own) * 1e-6
+    return sorted(((t, package) for package, t in totals.items()), reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--runs', type=int, default=5, help='number of warm runs')
+    parser.add_argument('--top', type=int, default=15, help='number of packages in the import breakdown')
+    parser.add_argument('--max-seconds', type=float, default=None,
+                        help='fail if the median warm start takes longer than this')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as pycache_prefix:
+        cold, _ = time_to_window(pycache_prefix)
+    print('cold start: {:.3f} s'.format(cold))
+
+    warm = [time_to_window()[0] for _ in range(args.runs)]
+    median = statistics.median(warm)
+    print('warm start: median {:.3f} s, min {:.3f} s, max {:.3f} s over {} runs'.format(
+          median, min(warm), max(warm), len(warm)))
+
+    _, stderr = time_to_window(extra_args=('-X', 'importtime'))
+    print('import time by package:')
+    for t, package in import_breakdown(stderr)[:args.top]:
+        print('  {:8.3f} s  {}'.format(t, package))
+
+    if args.max_seconds is not None and median > args.max_seconds:
+        print('[ERROR] warm start {:.3f} s exceeds {:.3f} s'.format(median, args.max_seconds), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
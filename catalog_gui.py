@@ -0,0 +1,80 @@
+import sys
+from PyQt5 import QtCore, QtWidgets
+from ui import ui_catalog
+from core.ptycho_recon import HardWorker
+from core.ptycho_batch import parse_scan_range
+
+
+class CatalogWindow(QtWidgets.QMainWindow, ui_catalog.Ui_MainWindow):
+    '''
+    List a range of scans from the databroker with their scan type, number of points, energy,
+    angle, step sizes and detectors, to pick the scans of a batch
+    '''
+    def __init__(self, parent=None, main_window=None):
+        super().__init__(parent)
+        self.setupUi(self)
+        QtWidgets.QApplication.setStyle('Plastique')
+        self.main_window = main_window
+        self._worker_thread = None
+        self._num_scans = 0
+        self._num_done = 0
+
+        self.btn_load.clicked.connect(self.load)
+        self.le_scan_range.returnPressed.connect(self.load)
+        self.btn_use_selected.clicked.connect(self.use_selected)
+        self.btn_close.clicked.connect(self.close)
+
+    def load(self):
+        if self._worker_thread is not None and self._worker_thread.isRunning():
+            # also reachable by pressing Enter; replacing the thread would destroy it while running
+            return
+        try:
+            scan_numbers = parse_scan_range(self.le_scan_range.text())
+            self.main_window.setScanRoutes()
+        except ValueError as ex:
+            print("[ERROR] {}".format(ex), file=sys.stderr)
+            return
+
+        self.tw_scans.setRowCount(0)
+        self.progressBar.setValue(0)
+        self._num_scans = len(scan_numbers)
+        self._num_done = 0
+
+        # the headers are fetched concurrently, each from the Broker holding the scan
+        thread = self._worker_thread \
+               = HardWorker("load_catalog", scan_numbers, cache=self.main_window.metadata_cache)
+        thread.update_signal.connect(self.add_scan)
+        thread.finished.connect(lambda: self.btn_load.setEnabled(True))
+        thread.exception_handler = self.main_window.exception_handler
+        self.btn_load.setEnabled(False)
+        thread.start()
+
+    def add_scan(self, scan_num, result):
+        summary, error = result
+        self._num_done += 1
+        self.progressBar.setValue(int(100 * self._num_done / self._num_scans))
+        if error is not None:
+            print("[WARNING] scan {}: {}".format(scan_num, error), file=sys.stderr)
+            return
+
+        # rows arrive in any order, so sort only once they are in
+        self.tw_scans.setSortingEnabled(False)
+        row = self.tw_scans.rowCount()
+        self.tw_scans.insertRow(row)
+        # plain Python numbers, Qt does not know numpy scalars
+        angle = None if summary['angle'] is None else float(summary['angle'])
+        values = [scan_num, summary['scan_type'], int(summary['nz']), round(float(summary['xray_energy_kev']), 4),
+                  angle, float(summary['dr_x']), float(summary['dr_y']), ', '.join(summary['detectors'])]
+        for col, value in enumerate(values):
+            item = QtWidgets.QTableWidgetItem()
+            # numbers are set as such to be sorted numerically
+            item.setData(QtCore.Qt.DisplayRole, '' if value is None else value)
+            self.tw_scans.setItem(row, col, item)
+        self.tw_scans.setSortingEnabled(True)
+
+    def use_selected(self):
+        rows = sorted({index.row() for index in self.tw_scans.selectedIndexes()})
+        scan_numbers = [int(self.tw_scans.item(row, 0).data(QtCore.Qt.DisplayRole)) for row in rows]
+        if len(scan_numbers) == 0:
+            return
+        self.main_window.le_batch_items.setText(', '.join(str(scan_num) for scan_num in scan_numbers))
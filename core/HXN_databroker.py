@@ -1,68 +1,293 @@
 #from hxntools.handlers import register
 #import filestore
-from metadatastore.mds import MDS
-from databroker import Broker
-from filestore.fs import FileStore
-
-# database #1
-_mds_config = {'host': 'xf03id-ca1',
-               'port': 27017,
-               'database': 'datastore-new',
-               'timezone': 'US/Eastern'}
-mds = MDS(_mds_config)
-_fs_config = {'host': 'xf03id-ca1',
-              'port': 27017,
-              'database': 'filestore-new'}
-db1 = Broker(mds, FileStore(_fs_config))
-
-# database #2
-_mds_config = {'host': 'xf03id-ca1',
-               'port': 27017,
-               'database': 'datastore-1',
-               'timezone': 'US/Eastern'}
-mds = MDS(_mds_config)
-_fs_config = {'host': 'xf03id-ca1',
-              'port': 27017,
-              'database': 'filestore-1'}
-db2 = Broker(mds, FileStore(_fs_config))
-
-# database old
-_mds_config_old = {'host': 'xf03id-ca1',
-                   'port': 27017,
-                   'database': 'datastore',
-                   'timezone': 'US/Eastern'}
-mds_old = MDS(_mds_config_old)
-
-_fs_config_old = {'host': 'xf03id-ca1',
-                  'port': 27017,
-                  'database': 'filestore'}
-db_old = Broker(mds_old, FileStore(_fs_config_old))
-
+import threading
 from hxntools.handlers.timepix import TimepixHDF5Handler
 from hxntools.handlers.xspress3 import Xspress3HDF5Handler
-db1.reg.register_handler(TimepixHDF5Handler._handler_name, TimepixHDF5Handler, overwrite=True)
-db2.reg.register_handler(TimepixHDF5Handler._handler_name, TimepixHDF5Handler, overwrite=True)
-db_old.reg.register_handler(Xspress3HDF5Handler.HANDLER_NAME, Xspress3HDF5Handler)
-db_old.reg.register_handler(TimepixHDF5Handler._handler_name, TimepixHDF5Handler, overwrite=True)
+from hxntools.scan_info import ScanInfo
+
+
+# the databases of the HXN Broker instances: name -> (metadatastore, filestore, handlers)
+BROKER_CONFIGS = {'db_old': ('datastore', 'filestore',
+                             [(Xspress3HDF5Handler.HANDLER_NAME, Xspress3HDF5Handler),
+                              (TimepixHDF5Handler._handler_name, TimepixHDF5Handler)]),
+                  'db1': ('datastore-new', 'filestore-new', [(TimepixHDF5Handler._handler_name, TimepixHDF5Handler)]),
+                  'db2': ('datastore-1', 'filestore-1', [(TimepixHDF5Handler._handler_name, TimepixHDF5Handler)])}
+MONGO_HOST = 'xf03id-ca1'
+MONGO_PORT = 27017
+
+# which Broker holds which scans: (first scan id, last scan id or None, Broker name)
+DEFAULT_SCAN_ROUTES = '0-34000: db_old, 34001-48990: db1, 48991-: db2'
+
+_brokers = {}                   # the Broker instances created so far, by name
+_brokers_lock = threading.Lock()
+_scan_routes = None             # set by set_scan_routes()
+
+
+def parse_scan_routes(routes:str):
+    '''
+    Parse a routing table like "0-34000: db_old, 34001-48990: db1, 48991-: db2" into a list of
+    (first scan id, last scan id or None, Broker name)
+    '''
+    table = []
+    for item in routes.split(','):
+        scan_range, name = item.split(':')
+        first, last = scan_range.split('-')
+        name = name.strip()
+        if name not in BROKER_CONFIGS:
+            raise ValueError("unknown Broker {} in the scan routes, expecting one of {}".format(
+                             name, sorted(BROKER_CONFIGS)))
+        table.append((int(first), int(last) if last.strip() else None, name))
+    return table
+
+
+def set_scan_routes(routes:str=''):
+    '''
+    Set the routing table used by get_db_name (see parse_scan_routes), '' for the default
+    '''
+    global _scan_routes
+    _scan_routes = parse_scan_routes(routes or DEFAULT_SCAN_ROUTES)
+
+
+def get_db_name(scan_id:int):
+    '''
+    Get the name of the Broker instance holding the given scan, ex: to key caches with
+    '''
+    if _scan_routes is None:
+        set_scan_routes()
+    for first, last, name in _scan_routes:
+        if first <= scan_id and (last is None or scan_id <= last):
+            return name
+    raise ValueError("scan {} is not in any range of the scan routes".format(scan_id))
+
+
+def get_broker(name:str):
+    '''
+    Get the Broker instance of the given name, creating it on first use. The instances are
+    kept for the session, each with its own pool of MongoDB connections.
+    '''
+    broker = _brokers.get(name)
+    if broker is None:
+        with _brokers_lock:
+            broker = _brokers.get(name)
+            if broker is None:
+                broker = _brokers[name] = _make_broker(name)
+    return broker
+
+
+def _make_broker(name:str):
+    from metadatastore.mds import MDS
+    from databroker import Broker
+    from filestore.fs import FileStore
+    mds_database, fs_database, handlers = BROKER_CONFIGS[name]
+    mds = MDS({'host': MONGO_HOST, 'port': MONGO_PORT, 'database': mds_database, 'timezone': 'US/Eastern'})
+    db = Broker(mds, FileStore({'host': MONGO_HOST, 'port': MONGO_PORT, 'database': fs_database}))
+    for spec, handler in handlers:
+        db.reg.register_handler(spec, handler, overwrite=True)
+    return db
+
+
+def get_db(scan_id:int):
+    '''
+    Get the Broker instance holding the given scan
+    '''
+    return get_broker(get_db_name(scan_id))
+
+
+def warm_up(scan_ids=()):
+    '''
+    Create the Broker instances of the given scans in a background thread, so that the first
+    load does not wait for them
+
+    Return:
+        The thread
+    '''
+    def _run():
+        for name in {get_db_name(scan_id) for scan_id in scan_ids}:
+            try:
+                get_broker(name)
+            except Exception as ex:
+                print("[WARNING] cannot connect to {} ({})".format(name, ex), file=sys.stderr)
+    thread = threading.Thread(target=_run, daemon=True)
+    thread.start()
+    return thread
+
 
 import numpy as np
 import sys, os
+import copy
+import glob
+import contextlib
+import pickle
+import shutil
+import tempfile
+import time
 import h5py
+from concurrent.futures import ThreadPoolExecutor, as_completed
 try:
-    from core.widgets.imgTools import rm_outlier_pixels
+    from core.ptycho_preprocess import (FramePreprocessor, DiffampWriter, ParallelFetcher, PreprocessPipeline,
+                                        ResourceFrameReader, get_output_dtypes, is_counts, block_size_for_budget,
+                                        iter_blocks, FRAMES_PER_BLOCK, RETRIEVE_WORKERS)
+    from core.ptycho_h5 import layout_kwargs, join_parts
+    from core.ptycho_cache import H5Cache, MetadataCache, CachedFrameReader, cache_key
 except ModuleNotFoundError:
     # for test purpose
-    from widgets.imgTools import rm_outlier_pixels
+    from ptycho_preprocess import (FramePreprocessor, DiffampWriter, ParallelFetcher, PreprocessPipeline,
+                                   ResourceFrameReader, get_output_dtypes, is_counts, block_size_for_budget,
+                                   iter_blocks, FRAMES_PER_BLOCK, RETRIEVE_WORKERS)
+    from ptycho_h5 import layout_kwargs, join_parts
+    from ptycho_cache import H5Cache, MetadataCache, CachedFrameReader, cache_key
 #######################################
 
 
+def get_fetcher(db, num_workers:int=RETRIEVE_WORKERS, mds_table=None):
+    '''
+    Get a ParallelFetcher that retrieves the raw frames of the given Broker concurrently
+    '''
+    return ParallelFetcher(lambda datum_id: db.reg.retrieve(datum_id)[0], num_workers, keys=mds_table)
+
+
+# where the frames live inside the HDF5 resource files, per filestore spec;
+# resources of other specs are read through db.reg.retrieve
+RESOURCE_DATASETS = {TimepixHDF5Handler._handler_name: 'entry/instrument/detector/data',
+                     'AD_HDF5': 'entry/data/data'}
+
+
+def group_by_resource(reg, datum_ids):
+    '''
+    Group the datum ids of a scan by the filestore resource they belong to.
+
+    Parameters:
+        - reg: FileStore
+            the registry of a Broker instance (db.reg)
+        - datum_ids: iterable
+            the datum ids in scan order, ex: metadata['mds_table']
+
+    Return:
+        A list of (resource, entries) tuples, where entries is a list of
+        (frame index, datum_id, datum_kwargs) in scan order
+    '''
+    known = {} # datum_id -> (group index, datum_kwargs)
+    groups = []
+    for i, datum_id in enumerate(datum_ids):
+        if datum_id not in known:
+            # one query for the resource and one for all of its datums
+            resource = reg.resource_given_eid(datum_id)
+            for datum in reg.datum_gen_given_resource(resource):
+                known[datum['datum_id']] = (len(groups), datum['datum_kwargs'])
+            groups.append((resource, []))
+        g, kwargs = known[datum_id]
+        groups[g][1].append((i, datum_id, kwargs))
+    return groups
+
+
+class BulkFrameReader(ResourceFrameReader):
+    '''
+    Read raw frames directly from their HDF5 resources, bypassing the per-datum db.reg.retrieve.
+
+    The datum ids are resolved into runs of consecutive frames that are also consecutive points
+    in a resource (see ResourceFrameReader). Frames of resources that cannot be read directly
+    are retrieved datum by datum; if there are none, self.runs alone describes the whole scan.
+
+    Each resource file is opened once here, so that one that cannot be read (ex: moved, wrong
+    root, no permission) raises OSError or KeyError right away and get_frame_reader can fall
+    back to db.reg.retrieve, instead of failing in the middle of the scan.
+    '''
+    def __init__(self, db, datum_ids):
+        self.db = db
+        self._single = []     # (frame index, datum_id) to be read via db.reg.retrieve
+        runs = []
+        for resource, entries in group_by_resource(db.reg, datum_ids):
+            if resource['spec'] not in RESOURCE_DATASETS \
+                or any(list(kwargs) != ['point_number'] for _, _, kwargs in entries):
+                self._single += [(i, datum_id) for i, datum_id, _ in entries]
+                continue
+            path = os.path.join(resource.get('root', '') or '', resource['resource_path'])
+            name = RESOURCE_DATASETS[resource['spec']]
+            with h5py.File(path, 'r') as f:
+                f[name] # raises KeyError if the frames are not where expected
+            fpp = resource.get('resource_kwargs', {}).get('frame_per_point', 1)
+            i0, _, kwargs = entries[0]
+            p0, count = kwargs['point_number'], 1
+            for i, _, kwargs in entries[1:]:
+                if i == i0 + count and kwargs['point_number'] == p0 + count:
+                    count += 1
+                else:
+                    runs.append((i0, i0+count, path, name, p0, fpp))
+                    i0, p0, count = i, kwargs['point_number'], 1
+            runs.append((i0, i0+count, path, name, p0, fpp))
+        super().__init__(runs)
+
+    def probe(self):
+        if not self.runs:
+            first = self.read(0, 1)
+            return first.shape[1:], first.dtype
+        return super().probe()
+
+    def _read_runs(self, start:int, stop:int, window, put):
+        super()._read_runs(start, stop, window, put)
+        for i, datum_id in self._single:
+            if start <= i < stop:
+                put(i, np.array(self.db.reg.retrieve(datum_id)[0][window])[np.newaxis])
+
+
+def probe_frame(db, datum_id):
+    '''
+    Get the shape and dtype of a raw frame without decoding it: from the header of the HDF5
+    dataset of its resource if it can be read directly (see RESOURCE_DATASETS), otherwise by
+    retrieving the frame
+
+    Parameters:
+        - db:
+            a Broker instance
+        - datum_id: str
+            the datum id of the frame, ex: metadata['mds_table'][0]
+
+    Return:
+        A tuple (frame shape, dtype)
+    '''
+    resource = db.reg.resource_given_eid(datum_id)
+    if resource['spec'] in RESOURCE_DATASETS:
+        path = os.path.join(resource.get('root', '') or '', resource['resource_path'])
+        try:
+            with h5py.File(path, 'r') as f:
+                dset = f[RESOURCE_DATASETS[resource['spec']]]
+                return dset.shape[1:], dset.dtype
+        except (OSError, KeyError) as ex:
+            print("[WARNING] cannot probe {} ({}), retrieving the frame".format(path, ex), file=sys.stderr)
+    img = db.reg.retrieve(datum_id)[0]
+    return img.shape, img.dtype
+
+
+def get_frame_reader(db, mds_table, num_workers:int=RETRIEVE_WORKERS, bulk_read=True, raw_cache=None,
+                     scan_num=None):
+    '''
+    Get a BulkFrameReader for the given datum ids if requested and the filestore resources
+    can be resolved, otherwise fall back to a ParallelFetcher. If a RawFrameCache is given,
+    the reader is wrapped such that the frames of scan_num are served from local disk
+    once they have been read.
+    '''
+    reader = None
+    if bulk_read:
+        try:
+            reader = BulkFrameReader(db, mds_table)
+        except Exception as ex:
+            print("[WARNING] bulk read unavailable ({}), retrieving frame by frame".format(ex), file=sys.stderr)
+    if reader is None:
+        reader = get_fetcher(db, num_workers, mds_table)
+    if raw_cache is not None:
+        # datum ids are unique across databases, so they tell scans apart
+        key = cache_key('raw', scan_num, mds_table[0], mds_table[len(mds_table)-1], len(mds_table))
+        reader = CachedFrameReader(raw_cache, key, len(mds_table), reader)
+    return reader
+
+
 def load_metadata(db, scan_num:int, det_name:str):
     '''
     Get all metadata for the given scan number and detector name
 
     Parameters:
         - db: 
-            a Broker instance. For HXN experiments they are db1, db2, and db_old
+            a Broker instance, ex: get_db(scan_num)
         - scan_num: int
             the scan number
         - det_name: str
@@ -75,20 +300,262 @@ def load_metadata(db, scan_num:int, det_name:str):
     metadata = dict()
     header = db[sid]
 
-    plan_args = header.start['plan_args']
-    scan_type = header.start['plan_name']
     scan_motors = header.start['motors']
-    items = [det_name, 'sclr1_ch3', 'sclr1_ch4'] + scan_motors
-    bl = db.get_table(header, stream_name='baseline')
-    df = db.get_table(header, fields=items, fill=False)
+    bl = _get_baseline(db, header, scan_motors)
+    columns = _get_columns(db, header, _primary_fields(scan_motors, det_name))
     #images = db_old.get_images(db_old[sid], name=det_name)
 
     # get energy_kev
-    dcm_th = bl.dcm_th[1]
-    energy_kev = 12.39842 / (2.*3.1355893 * np.sin(dcm_th * np.pi / 180.))
-    metadata['xray_energy_kev'] = energy_kev
+    metadata['xray_energy_kev'] = _energy_kev(bl)
 
     # get scan_type, x_range, y_range, dr_x, dr_y
+    metadata.update(_scan_geometry(header.start))
+
+    metadata.update(_table_metadata(columns, bl, scan_motors, det_name))
+    
+    # get ccd_pixel_um
+    ccd_pixel_um = 55.
+    metadata['ccd_pixel_um'] = ccd_pixel_um
+
+    return metadata
+
+
+# the MetadataCache entries of a scan that are not about one detector (no detector has these names)
+_DETECTORS_ENTRY = '__detectors__'  # get_detectors()
+_SUMMARY_ENTRY = '__summary__'      # scan_summary()
+
+
+def get_detectors(scan_num:int, cache:MetadataCache=None):
+    '''
+    Get the names of the detectors that saved images in the given scan
+
+    Parameters:
+        - scan_num: int
+            the scan number
+        - cache: MetadataCache, optional
+            if given, the names are served from it, and stored there once the scan is finished
+
+    Return:
+        A list of detector names
+    '''
+    db_name = get_db_name(scan_num)
+    if cache is not None:
+        cached = cache.get(db_name, scan_num, _DETECTORS_ENTRY)
+        if cached is not None:
+            return cached['detectors']
+    header = get_db(scan_num)[scan_num]
+    detectors = list(ScanInfo(header).filestore_keys)
+    if cache is not None and header.stop:
+        cache.put(db_name, scan_num, _DETECTORS_ENTRY, {'detectors': detectors})
+    return detectors
+
+
+# the number of headers fetched at the same time by load_catalog
+CATALOG_WORKERS = 16
+
+
+def scan_summary(scan_num:int, cache:MetadataCache=None):
+    '''
+    Get what is needed to tell scans apart at a glance: scan type, number of points, energy,
+    angle, detectors and step sizes. Only the header and the baseline are read, not the events.
+
+    Parameters:
+        - scan_num: int
+            the scan number
+        - cache: MetadataCache, optional
+            if given, the summary is served from it, and stored there once the scan is finished
+
+    Return:
+        A dictionary with keys scan_num, scan_type, nz, xray_energy_kev, angle, detectors,
+        dr_x, dr_y, x_range, y_range and finished
+    '''
+    db_name = get_db_name(scan_num)
+    if cache is not None:
+        cached = cache.get(db_name, scan_num, _SUMMARY_ENTRY)
+        if cached is not None:
+            return cached
+
+    db = get_db(scan_num)
+    header = db[scan_num]
+    scan_motors = header.start['motors']
+    bl = _get_baseline(db, header, scan_motors)
+    summary = {'scan_num': scan_num,
+               'xray_energy_kev': _energy_kev(bl),
+               'angle': _angle(bl, scan_motors),
+               'detectors': list(ScanInfo(header).filestore_keys),
+               'finished': bool(header.stop)}
+    summary.update(_scan_geometry(header.start))
+    num_events = header.stop.get('num_events', {}) if header.stop else {}
+    if 'primary' in num_events:
+        summary['nz'] = num_events['primary']
+    else:
+        # a running scan, or an old one without the count in its stop document
+        summary['nz'] = len(_get_columns(db, header, scan_motors[:1])[scan_motors[0]])
+
+    if cache is not None and summary['finished']:
+        cache.put(db_name, scan_num, _SUMMARY_ENTRY, summary)
+    return summary
+
+
+def load_catalog(scan_numbers, cache:MetadataCache=None, num_workers:int=CATALOG_WORKERS, update_fcn=None):
+    '''
+    Get the scan_summary() of many scans, fetching the headers concurrently, each from the Broker
+    holding it.
+
+    Parameters:
+        - scan_numbers: list of int
+        - cache: MetadataCache, optional
+        - num_workers: int, optional
+            the number of scans fetched at the same time
+        - update_fcn: callable, optional
+            called as update_fcn(scan_num, summary, error) as each scan is done (in any order),
+            with error being None or a message, ex: for scan numbers that do not exist
+
+    Return:
+        A dict mapping each scan number to its summary, the failed scans are left out
+    '''
+    catalog = dict()
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        futures = {pool.submit(scan_summary, scan_num, cache): scan_num for scan_num in scan_numbers}
+        for future in as_completed(futures):
+            scan_num = futures[future]
+            try:
+                summary = future.result()
+            except Exception as ex:
+                if update_fcn is not None:
+                    update_fcn(scan_num, None, '{}: {}'.format(type(ex).__name__, ex))
+                continue
+            catalog[scan_num] = summary
+            if update_fcn is not None:
+                update_fcn(scan_num, summary, None)
+    return catalog
+
+
+def load_scan_metadata(scan_num:int, det_name:str, cache:MetadataCache=None):
+    '''
+    Get the output of load_metadata plus the frame shape (nx, ny) for the given scan number and
+    detector name
+
+    Parameters:
+        - scan_num: int
+            the scan number
+        - det_name: str
+            the detector name
+        - cache: MetadataCache, optional
+            if given, the metadata is served from it, and stored there once the scan is finished
+
+    Return:
+        A dictionary that holds the metadata
+    '''
+    db_name = get_db_name(scan_num)
+    if cache is not None:
+        metadata = cache.get(db_name, scan_num, det_name)
+        if metadata is not None:
+            return metadata
+
+    db = get_db(scan_num)
+    # checked first: a scan that stops meanwhile may have more events than loaded below
+    finished = bool(db[scan_num].stop)
+    metadata = load_metadata(db, scan_num, det_name)
+    if metadata['nz'] == 0:
+        raise ValueError("nz = 0")
+    # get nx and ny from the first frame, without reading it if possible
+    shape, _ = probe_frame(db, metadata['mds_table'][0])
+    nx, ny = shape # can also give a ValueError
+    metadata['nx'] = nx
+    metadata['ny'] = ny
+
+    # a running scan still grows, so it is asked again next time
+    if cache is not None and finished:
+        cache.put(db_name, scan_num, det_name, metadata)
+    return metadata
+
+
+def _angle_field(scan_motors):
+    # the rotation stage under the scanning stage, None if unknown
+    if scan_motors[1] == 'dssy':
+        return 'dsth'
+    elif scan_motors[1] == 'zpssy':
+        return 'zpsth'
+    return None
+
+
+def _ic_field(scan_motors):
+    # the scaler channel monitoring the incident beam
+    if scan_motors[1] == 'dssy':
+        return 'sclr1_ch4'
+    elif scan_motors[1] == 'zpssy':
+        return 'sclr1_ch3'
+    return None
+
+
+def _primary_fields(scan_motors, det_name:str):
+    fields = [det_name] + list(scan_motors)
+    if _ic_field(scan_motors) is not None:
+        fields.append(_ic_field(scan_motors))
+    return fields
+
+
+def _get_baseline(db, header, scan_motors):
+    '''
+    Get the first reading of the baseline stream (taken before the scan), restricted to the
+    fields used here, as a dict
+    '''
+    fields = ['dcm_th']
+    if _angle_field(scan_motors) is not None:
+        fields.append(_angle_field(scan_motors))
+    events = db.get_events(header, stream_name='baseline', fields=fields, fill=False)
+    try:
+        # the reading at the end of the scan is not needed, so stop here
+        for event in events:
+            return event['data']
+    finally:
+        events.close()
+    raise ValueError("no baseline reading found")
+
+
+def _get_columns(db, header, fields, stream_name:str='primary', since:int=0):
+    '''
+    Get the given fields of all events of a stream as a dict of 1D arrays in event order,
+    without building a table. Datum ids (fill=False) come as object arrays.
+
+    Only the events with seq_num > since are taken, ex: the new events of a running scan
+    of which since events are known already (seq_num counts from 1).
+    '''
+    seq_num = []
+    values = {name: [] for name in fields}
+    for event in db.get_events(header, stream_name=stream_name, fields=fields, fill=False):
+        if event['seq_num'] <= since:
+            continue
+        seq_num.append(event['seq_num'])
+        data = event['data']
+        for name in fields:
+            values[name].append(data.get(name, np.nan))
+    order = np.argsort(seq_num, kind='stable')
+    columns = dict()
+    for name, column in values.items():
+        column = np.asarray(column)
+        if column.dtype.kind not in 'biuf':
+            column = np.asarray(values[name], dtype=object)
+        columns[name] = column[order]
+    return columns
+
+
+def _energy_kev(bl):
+    dcm_th = bl['dcm_th']
+    return 12.39842 / (2.*3.1355893 * np.sin(dcm_th * np.pi / 180.))
+
+
+def _angle(bl, scan_motors):
+    # the rotation angle of the stage being scanned, None if unknown
+    field = _angle_field(scan_motors)
+    return None if field is None else bl[field]
+
+
+def _scan_geometry(start):
+    metadata = dict()
+    plan_args = start['plan_args']
+    scan_type = start['plan_name']
     if scan_type == 'FlyPlan2D':
         x_range = plan_args['scan_end1']-plan_args['scan_start1']
         y_range = plan_args['scan_end2']-plan_args['scan_start2']
@@ -118,43 +585,44 @@ def load_metadata(db, scan_num:int, det_name:str):
     metadata['x_range'] = x_range
     metadata['y_range'] = y_range
 
+    return metadata
+
+
+def _table_metadata(columns, bl, scan_motors, det_name:str):
+    # the part of the metadata that grows with the events of the scan
+    metadata = dict()
+
     # get points
-    num_frame, count = np.shape(df)
-    points = np.zeros((2, num_frame))
-    points[0] = np.array(df[scan_motors[0]])
-    points[1] = np.array(df[scan_motors[1]])
+    points = np.zeros((2, len(columns[det_name])))
+    points[0] = columns[scan_motors[0]]
+    points[1] = columns[scan_motors[1]]
     metadata['points'] = points
 
     # get angle, ic
-    if scan_motors[1] == 'dssy':
-        angle = bl.dsth[1]
-        ic = np.asfarray(df['sclr1_ch4'])
-    elif scan_motors[1] == 'zpssy':
-        angle = bl.zpsth[1]
-        ic = np.asfarray(df['sclr1_ch3'])
-    metadata['angle'] = angle
-    metadata['ic'] = ic
-    
-    # get ccd_pixel_um
-    ccd_pixel_um = 55.
-    metadata['ccd_pixel_um'] = ccd_pixel_um
+    metadata['angle'] = _angle(bl, scan_motors)
+    ic_field = _ic_field(scan_motors)
+    if ic_field is None:
+        raise ValueError("unsupported scan motor {}: the ion chamber channel for it is unknown".format(scan_motors[1]))
+    metadata['ic'] = np.asarray(columns[ic_field], dtype=np.float64)
 
     # get diffamp dimensions (uncropped!)
-    nz, = df[det_name].shape
-    mds_table = df[det_name]
-    metadata['nz'] = nz
+    mds_table = columns[det_name]   # datum ids
+    metadata['nz'] = len(mds_table)
     metadata['mds_table'] = mds_table
 
     return metadata
 
 
-def save_data(db, param, scan_num:int, n:int, nn:int, cx=110, cy=160, threshold=1., bad_pixels=None, zero_out=None):
+def save_data(db, param, scan_num:int, n:int, nn:int, cx=110, cy=160, threshold=1., bad_pixels=None, zero_out=None,
+              block_size=FRAMES_PER_BLOCK, mem_budget_mb=None, num_workers=RETRIEVE_WORKERS,
+              bulk_read=True, pipelined=False, diffamp_dtype='auto', frames_per_chunk=0, compression='',
+              cache_size_gb=None, raw_cache=None):
     '''
     Save metadata and diffamp for the given scan number to a HDF5 file.
 
     Parameters:
         - db: 
-            a Broker instance. For HXN experiments they are db1, db2, and db_old
+            a Broker instance, ex: get_db(scan_num)
         - param: Param
             a Param instance containing the metadata and other information from the GUI
         - scan_num: int
@@ -173,6 +641,35 @@ def save_data(db, param, scan_num:int, n:int, nn:int, cx=110, cy=160, threshold=
             the data structure is [[x1, x2, ...], [y1, y2, ...]]. If given, they will be removed from the images.
         - zero_out: list of tuples, optional
             zero out the given rois [(x0, y0, w0, h0), (x1, y1, w1, h1), ...]
+        - block_size: int, optional
+            the number of raw frames retrieved and processed together as one 3D array
+        - mem_budget_mb: float, optional
+            if given, diffamp is streamed to a chunked dataset block by block, with the
+            block size chosen such that the frames in flight fit into this many MB
+        - num_workers: int, optional
+            the number of threads retrieving raw frames from filestore concurrently
+        - bulk_read: bool, optional
+            read the frames directly from their HDF5 resources, one slice per run of
+            consecutive frames, instead of retrieving them datum by datum
+        - pipelined: bool, optional
+            run frame reading, processing and HDF5 writing concurrently as a pipeline of
+            stages joined by bounded queues (implies streaming), and print per-stage timings
+        - diffamp_dtype: str, optional
+            'auto' (follow param.precision), 'float64' or 'float32' store amplitudes; 'uint16'
+            or 'uint32' store the thresholded photon counts, and diffamp gets the attribute
+            sqrt_on_load=True telling readers to take the sqrt themselves
+        - frames_per_chunk: int, optional
+            the number of frames per HDF5 chunk of diffamp; 0 means contiguous if possible
+            (streaming always needs chunks, then one frame per chunk is used)
+        - compression: str, optional
+            '', 'gzip', 'lzf' or 'lz4' (needs hdf5plugin); the shuffle filter is applied first.
+            See core/ptycho_h5.py for a benchmark that picks the best layout for a dataset
+        - cache_size_gb: float, optional
+            if given, the h5 is kept in a content-addressed cache (working_directory/h5_cache/)
+            of this size. A save with the same inputs as a cached one just relinks the file.
+        - raw_cache: RawFrameCache, optional
+            if given, the uncropped raw frames are kept on local disk, so that saving the same
+            scan again (ex: with another ROI or threshold) does not go through the databroker
 
     Notes:
     1. the detector distance is assumed existent as param.z_m
@@ -183,6 +680,86 @@ def save_data(db, param, scan_num:int, n:int, nn:int, cx=110, cy=160, threshold=
     angle = param.angle
     lambda_nm = param.lambda_nm
     ic = param.ic
+    file_path = _h5_data_path(param.working_directory, scan_num)
+    compute_dtype, diffamp_dtype = get_output_dtypes(diffamp_dtype, param.precision)
+
+    cache = None
+    if cache_size_gb:
+        # everything that ends up in the h5 goes into the key, including the precision it was computed in
+        cache = H5Cache(param.working_directory + '/h5_cache/', cache_size_gb)
+        key = cache_key(scan_num, n, nn, cx, cy, threshold, bad_pixels, zero_out, ic, param.points,
+                        param.x_range, param.y_range, param.dr_x, param.dr_y, det_distance_m, lambda_nm,
+                        det_pixel_um, angle, str(compute_dtype), str(diffamp_dtype), frames_per_chunk, compression)
+        if cache.link(key, file_path):
+            print("scan {} with identical settings found in cache, relinked.".format(scan_num))
+            _link_scan_file(param.working_directory, scan_num, file_path)
+            return
+
+    streaming = mem_budget_mb is not None or pipelined
+    if not streaming:
+        # get data array
+        data = np.zeros((num_frame, n, nn), dtype=diffamp_dtype) # nz*nx*ny
+        with get_frame_reader(db, param.mds_table, num_workers, bulk_read, raw_cache, scan_num) as reader:
+            frame_shape, _ = reader.probe()
+            preprocessor = FramePreprocessor(frame_shape, n, nn, cx, cy, ic, bad_pixels, zero_out,
+                                             compute_dtype, threshold, diffamp_dtype)
+            # only the ROI (plus a margin for the bad pixels) of each frame is read and processed
+            for start, stop, frames in reader.fetch_blocks(param.mds_table, num_frame, block_size,
+                                                           preprocessor.window):
+                # process a block of raw frames together
+                data[start:stop] = preprocessor.process(frames, start)
+        # data array got
+        print('array size:', np.shape(data))
+        print('{:d} frames retrieved at {:.1f} frames/s'.format(reader.num_frames, reader.fps))
+
+    # the previous file stays until this one is complete
+    with _replacing(file_path) as tmp_path, h5py.File(tmp_path, 'w') as hf:
+        if not streaming:
+            dset = hf.create_dataset('diffamp', data=data, **layout_kwargs(n, nn, frames_per_chunk, compression,
+                                                                           num_frame=data.shape[0]))
+            dset.attrs['sqrt_on_load'] = is_counts(diffamp_dtype)
+        else:
+            # streaming mode: process and write one block at a time
+            pipeline = None
+            if pipelined:
+                # reading the frames from their HDF5 resources and writing diffamp both take h5py's lock
+                pipeline = PreprocessPipeline(serialized=('reader', 'writer') if bulk_read else ())
+            with get_frame_reader(db, param.mds_table, num_workers, bulk_read, raw_cache, scan_num) as reader:
+                frame_shape, raw_dtype = reader.probe()
+                preprocessor = FramePreprocessor(frame_shape, n, nn, cx, cy, ic, bad_pixels, zero_out,
+                                                 compute_dtype, threshold, diffamp_dtype)
+                if mem_budget_mb is not None:
+                    # in the pipelined mode the budget is shared by all blocks in flight
+                    budget = mem_budget_mb / pipeline.max_blocks_in_flight if pipelined else mem_budget_mb
+                    # the raw cache reads and holds whole frames on a miss, not just the window
+                    read_shape = frame_shape if raw_cache is not None else preprocessor.window_shape
+                    block_size = block_size_for_budget(read_shape, n, nn, budget, raw_dtype.itemsize)
+                writer = DiffampWriter(hf, n, nn, diffamp_dtype, frames_per_chunk=frames_per_chunk,
+                                       compression=compression)
+                compute = lambda block: preprocessor.process(block[2], block[0])
+                blocks = reader.fetch_blocks(param.mds_table, num_frame, block_size, preprocessor.window)
+                if pipelined:
+                    pipeline.run(blocks, compute, writer.append)
+                else:
+                    for block in blocks:
+                        writer.append(compute(block))
+            print('array size:', writer.dset.shape)
+            if pipelined:
+                print(pipeline.report())
+            print('{:d} frames retrieved at {:.1f} frames/s'.format(reader.num_frames, reader.fps))
+        _write_metadata(hf, param, n, nn)
+
+    if cache is not None:
+        cache.store(key, file_path)
+
+    _link_scan_file(param.working_directory, scan_num, file_path)
+
+
+def _write_metadata(hf, param, n:int, nn:int, growing=False):
+    # everything but diffamp; if growing, points and ic can be extended along the frame axis
+    det_distance_m = param.z_m
+    det_pixel_um = param.ccd_pixel_um
+    lambda_nm = param.lambda_nm
     #energy_kev = param.energy_kev
 
     #print('energy:', energy_kev)
@@ -194,85 +771,247 @@ def save_data(db, param, scan_num:int, n:int, nn:int, cx=110, cy=160, threshold=
     y_depth_of_field_m = lambda_nm * 1.e-9 / (nn/2 * det_pixel_um*1.e-6 / det_distance_m)**2
     #print('pixel size: ', x_pixel_m, y_pixel_m)
     #print('depth of field: ', x_depth_of_field_m, y_depth_of_field_m)
-    
-    # get data array
-    data = np.zeros((num_frame, n, nn)) # nz*nx*ny
-    for i in range(num_frame):
-        #print(param.mds_table.iat[i], file=sys.stderr)
-        img = db.reg.retrieve(param.mds_table.iat[i])[0]
-        #img = np.rot90(img, axes=(1,0)) #equivalent to tt = np.flipud(tt).T
-        ny, nx = np.shape(img)
-
-        img = img * ic[0] / ic[i]
-
-        if bad_pixels is not None:
-            img = rm_outlier_pixels(img, bad_pixels[0], bad_pixels[1])
-
-        if zero_out is not None:
-            for blue_roi in zero_out:
-                x0 = blue_roi[0]
-                y0 = blue_roi[1]
-                w = blue_roi[2]
-                h = blue_roi[3]
-                img[y0:y0+h, x0:x0+w] = 0.
-
-        if n < nx:
-            # assuming n=nn???
-            #print(nx, ny, file=sys.stderr)
-            #print(cx-n//2, cx+n//2, cy-nn//2, cy+nn//2, file=sys.stderr)
-            #tmptmp = img[cx-n//2:cx+n//2, cy-nn//2:cy+nn//2]
-            tmptmp = img[cy-nn//2:cy+nn//2, cx-n//2:cx+n//2]
-            #print(tmptmp.shape, file=sys.stderr)
-        else: 
-            raise Exception("zero padding not completed yet")
-            # # is this part necessary???
-            # #tmptmp = t
-            # tmptmp = np.zeros((n, n))
-            # #tmptmp[3:-3,:] = t[:,cy-n//2:cy+n//2]
-            # tmptmp[4:-8, :] = img[:, cy-n//2:cy+n//2]
-
-        #if i == 0:
-        #    import matplotlib.pyplot as plt
-        #    plt.imshow(tmptmp, vmin=np.min(img), vmax=np.max(img))
-        #    plt.savefig("ttttt.png")
-        #    return
-        
-        tmptmp = np.rot90(tmptmp, axes=(1,0)) #equivalent to np.flipud(tmptmp).T
-        data[i] = np.fft.fftshift(tmptmp)
-
-    data[data < threshold] = 0.
-    data = np.sqrt(data)
-    # data array got
-    print('array size:', np.shape(data))
-    
-    # create a folder
-    try:
-        os.mkdir(param.working_directory + '/h5_data/')
-    except FileExistsError:
-        pass 
 
-    file_path = param.working_directory + '/h5_data/scan_' + str(scan_num) + '.h5'
-    with h5py.File(file_path, 'w') as hf:
-        dset = hf.create_dataset('diffamp', data=data)
+    if growing:
+        dset = hf.create_dataset('points', data=param.points, chunks=(2, 1024), maxshape=(2, None))
+    else:
         dset = hf.create_dataset('points', data=param.points)
-        dset = hf.create_dataset('x_range', data=param.x_range)
-        dset = hf.create_dataset('y_range', data=param.y_range)
-        dset = hf.create_dataset('dr_x', data=param.dr_x)
-        dset = hf.create_dataset('dr_y', data=param.dr_y)
-        dset = hf.create_dataset('z_m', data=det_distance_m)
-        dset = hf.create_dataset('lambda_nm', data=lambda_nm)
-        dset = hf.create_dataset('ccd_pixel_um', data=det_pixel_um)
-        dset = hf.create_dataset('angle', data=angle)
-        dset = hf.create_dataset('ic', data=ic)
-        dset = hf.create_dataset('x_pixel_m', data=x_pixel_m)
-        dset = hf.create_dataset('y_pixel_m', data=y_pixel_m)
-        dset = hf.create_dataset('x_depth_field_m', data=x_depth_of_field_m)
-        dset = hf.create_dataset('y_depth_field_m', data=y_depth_of_field_m)
+    dset = hf.create_dataset('x_range', data=param.x_range)
+    dset = hf.create_dataset('y_range', data=param.y_range)
+    dset = hf.create_dataset('dr_x', data=param.dr_x)
+    dset = hf.create_dataset('dr_y', data=param.dr_y)
+    dset = hf.create_dataset('z_m', data=det_distance_m)
+    dset = hf.create_dataset('lambda_nm', data=lambda_nm)
+    dset = hf.create_dataset('ccd_pixel_um', data=det_pixel_um)
+    dset = hf.create_dataset('angle', data=param.angle)
+    if growing:
+        dset = hf.create_dataset('ic', data=param.ic, chunks=(1024,), maxshape=(None,))
+    else:
+        dset = hf.create_dataset('ic', data=param.ic)
+    dset = hf.create_dataset('x_pixel_m', data=x_pixel_m)
+    dset = hf.create_dataset('y_pixel_m', data=y_pixel_m)
+    dset = hf.create_dataset('x_depth_field_m', data=x_depth_of_field_m)
+    dset = hf.create_dataset('y_depth_field_m', data=y_depth_of_field_m)
 
+
+def _h5_data_path(working_directory, scan_num, suffix='.h5'):
+    '''
+    Get the path of the given scan's file (or other item, by suffix) in working_directory/h5_data/,
+    creating that folder if needed. An existing file is to be replaced with _replacing.
+    '''
+    os.makedirs(working_directory + '/h5_data/', exist_ok=True)
+    return working_directory + '/h5_data/scan_' + str(scan_num) + suffix
+
+
+def _link_scan_file(working_directory, scan_num, file_path):
     # symlink so ptycho can find it
     try:
-        symlink_path = param.working_directory + '/scan_' + str(scan_num) + '.h5'
+        symlink_path = working_directory + '/scan_' + str(scan_num) + '.h5'
         os.symlink(file_path, symlink_path)
     except FileExistsError:
         os.remove(symlink_path)
         os.symlink(file_path, symlink_path)
+
+
+@contextlib.contextmanager
+def _replacing(file_path):
+    '''
+    Yield the path of a temporary file next to file_path, which replaces file_path if the block
+    succeeds and is removed otherwise, so that a failed save leaves the previous file intact.
+    The old file is never written in place, as it may share storage with a cache entry.
+    '''
+    directory, name = os.path.split(file_path)
+    tmp_path = os.path.join(directory, '.{}.tmp{}_{}'.format(name, os.getpid(), threading.get_ident()))
+    try:
+        yield tmp_path
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, file_path)
+
+
+def prepare_mpi_save(db, param, scan_num:int, n:int, nn:int, cx=110, cy=160, threshold=1., bad_pixels=None,
+                     zero_out=None, block_size=FRAMES_PER_BLOCK, mem_budget_mb=None, diffamp_dtype='auto',
+                     frames_per_chunk=0, compression=''):
+    '''
+    Prepare saving the given scan with MPI (core/ptycho_mpi_save.py): resolve where the raw frames
+    live and dump everything the MPI processes need into a job file, so that they do not have
+    to access the databroker. Each process then writes its contiguous range of frames to a part
+    file, and finish_mpi_save() joins the parts. See save_data for the parameters.
+
+    Return:
+        The path of the job file, to be passed to ptycho_mpi_save.py
+    '''
+    reader = BulkFrameReader(db, param.mds_table)
+    if reader._single:
+        raise RuntimeError("{} frames of scan {} are not in HDF5 resources, use the serial save instead".format(
+                           len(reader._single), scan_num))
+    with reader:
+        frame_shape, raw_dtype = reader.probe()
+
+    compute_dtype, diffamp_dtype = get_output_dtypes(diffamp_dtype, param.precision)
+    preprocessor = dict(frame_shape=frame_shape, n=n, nn=nn, cx=cx, cy=cy, ic=param.ic,
+                        bad_pixels=bad_pixels, zero_out=zero_out, dtype=compute_dtype,
+                        threshold=threshold, out_dtype=diffamp_dtype)
+    if mem_budget_mb is not None:
+        window_shape = FramePreprocessor(**preprocessor).window_shape
+        block_size = block_size_for_budget(window_shape, n, nn, mem_budget_mb, raw_dtype.itemsize)
+
+    parts_dir = _h5_data_path(param.working_directory, scan_num, '_parts/')
+    # parts of a previous save must not be joined by mistake
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    os.mkdir(parts_dir)
+
+    job = {'scan_num': scan_num, 'n': n, 'nn': nn, 'num_frame': param.nz, 'runs': reader.runs,
+           'preprocessor': preprocessor, 'block_size': block_size, 'frames_per_chunk': frames_per_chunk,
+           'compression': compression, 'parts_dir': parts_dir}
+    # a file of its own, so that saves from several GUIs sharing a working directory don't collide
+    fd, job_path = tempfile.mkstemp(prefix='.ptycho_save_job_', suffix='.pkl', dir=param.working_directory)
+    with os.fdopen(fd, 'wb') as output:
+        pickle.dump(job, output, pickle.HIGHEST_PROTOCOL)
+    return job_path
+
+
+def finish_mpi_save(param, job_path:str):
+    '''
+    Write the h5 of a scan saved with MPI: diffamp is a virtual dataset joining the part files
+    written by the MPI processes (which therefore must be kept), plus the usual metadata
+    '''
+    with open(job_path, 'rb') as f:
+        job = pickle.load(f)
+    scan_num = job['scan_num']
+    file_path = _h5_data_path(param.working_directory, scan_num)
+    with _replacing(file_path) as tmp_path, h5py.File(tmp_path, 'w') as hf:
+        dset = join_parts(hf, sorted(glob.glob(job['parts_dir'] + 'part_*.h5')))
+        if dset.shape[0] != job['num_frame']:
+            raise RuntimeError("expected {} frames, the MPI processes saved {}".format(job['num_frame'],
+                                                                                       dset.shape[0]))
+        print('array size:', dset.shape)
+        _write_metadata(hf, param, job['n'], job['nn'])
+    _link_scan_file(param.working_directory, scan_num, file_path)
+
+
+def save_data_live(db, param, scan_num:int, n:int, nn:int, cx=110, cy=160, threshold=1., bad_pixels=None,
+                   zero_out=None, det_name=None, poll_interval=2., idle_timeout=600., num_workers=RETRIEVE_WORKERS,
+                   bulk_read=False, diffamp_dtype='auto', frames_per_chunk=0, compression='', update_fcn=None):
+    '''
+    Save a scan that is still being acquired: poll the databroker for new events, preprocess the
+    new frames and append them to diffamp, points and ic, until the scan has ended and all of its
+    frames are saved. The file is written in SWMR mode, so it can be read while it grows
+    (open it with h5py.File(path, 'r', swmr=True) and call refresh() on the datasets).
+
+    Parameters (see save_data for the others):
+        - det_name: str, optional
+            the detector name, default to param.detectorkind
+        - poll_interval: float, optional
+            seconds between two polls of the databroker
+        - idle_timeout: float, optional
+            give up if no new frame arrives for this many seconds while the scan has not ended
+        - bulk_read: bool, optional
+            read the frames directly from their HDF5 resources; off by default, since these
+            files are usually still open for writing by the detector during the scan
+        - update_fcn: callable, optional
+            called as update_fcn(num_frame, metadata) whenever frames are saved, metadata being
+            that of load_metadata for the num_frame frames saved so far
+
+    Return:
+        The metadata of the saved frames, as given to update_fcn. param itself is not modified,
+        since it usually belongs to the GUI while this runs in a worker thread.
+    '''
+    if det_name is None:
+        det_name = param.detectorkind
+    header = db[scan_num]
+    scan_motors = header.start['motors']
+    fields = _primary_fields(scan_motors, det_name)
+    metadata = load_metadata(db, scan_num, det_name)
+    param = copy.copy(param)
+    param.__dict__.update(metadata)
+    compute_dtype, diffamp_dtype = get_output_dtypes(diffamp_dtype, param.precision)
+
+    file_path = _h5_data_path(param.working_directory, scan_num)
+
+    bl = _get_baseline(db, header, scan_motors)
+    done = 0            # frames saved
+    preprocessor = None
+    t_idle = time.perf_counter()
+    try:
+        # the file is read through the symlink while it grows, and replaces the previous one once complete
+        with _replacing(file_path) as tmp_path, h5py.File(tmp_path, 'w', libver='latest') as hf:
+            writer = DiffampWriter(hf, n, nn, diffamp_dtype, frames_per_chunk=frames_per_chunk,
+                                   compression=compression)
+            saved = param.points, param.ic
+            param.points, param.ic = param.points[:, :0], param.ic[:0]
+            _write_metadata(hf, param, n, nn, growing=True)
+            param.points, param.ic = saved
+            # all datasets exist, readers can come in
+            hf.swmr_mode = True
+            _link_scan_file(param.working_directory, scan_num, tmp_path)
+            print("scan {}: saving live to {}".format(scan_num, tmp_path))
+
+            while True:
+                num_frame = param.nz
+                if num_frame > done:
+                    try:
+                        with get_frame_reader(db, param.mds_table[done:], num_workers, bulk_read) as reader:
+                            if preprocessor is None:
+                                frame_shape, _ = reader.probe()
+                                preprocessor = FramePreprocessor(frame_shape, n, nn, cx, cy, param.ic, bad_pixels,
+                                                                 zero_out, compute_dtype, threshold, diffamp_dtype)
+                            preprocessor.ic = np.asarray(param.ic, dtype=preprocessor.dtype)
+                            for start, stop in iter_blocks(num_frame - done, FRAMES_PER_BLOCK):
+                                frames = reader.read(start, stop, preprocessor.window)
+                                writer.append(preprocessor.process(frames, done + start))
+                    except (OSError, KeyError) as ex:
+                        # the detector has not written these frames yet, try again at the next poll
+                        print("scan {}: frames from {} not readable yet ({})".format(scan_num, writer.dset.shape[0],
+                                                                                      ex), file=sys.stderr)
+                        num_frame = writer.dset.shape[0]
+                    if num_frame > done:
+                        # only the new part of points and ic is written
+                        for name, data in (('points', param.points), ('ic', param.ic)):
+                            hf[name].resize(num_frame, axis=data.ndim-1)
+                            hf[name][..., done:num_frame] = data[..., done:num_frame]
+                        hf.flush()
+                        print("scan {}: {} frames saved".format(scan_num, num_frame))
+                        t_idle = time.perf_counter()
+                        done = num_frame
+                        if update_fcn is not None:
+                            update_fcn(done, _saved_metadata(param, metadata, done))
+
+                if header.stop and done == param.nz:
+                    break
+                if time.perf_counter() - t_idle > idle_timeout:
+                    raise RuntimeError("scan {}: no new frame for {} s, giving up with {} frames saved".format(
+                                       scan_num, idle_timeout, done))
+                time.sleep(poll_interval)
+
+                # poll the scan; stop is set once the scan has ended
+                header = db[scan_num]
+                columns = _get_columns(db, header, fields, since=param.nz)
+                if len(columns[det_name]) > 0:
+                    # append the new events; the known ones are skipped, not converted again
+                    new = _table_metadata(columns, bl, scan_motors, det_name)
+                    param.points = np.concatenate((param.points, new['points']), axis=1)
+                    param.ic = np.concatenate((param.ic, new['ic']))
+                    param.mds_table = np.concatenate((param.mds_table, new['mds_table']))
+                    param.nz = len(param.mds_table)
+    except BaseException:
+        # point back to the previous file, if any
+        if os.path.lexists(file_path):
+            _link_scan_file(param.working_directory, scan_num, file_path)
+        raise
+    _link_scan_file(param.working_directory, scan_num, file_path)
+
+    print("scan {}: done, {} frames".format(scan_num, done))
+    return _saved_metadata(param, metadata, done)
+
+
+def _saved_metadata(param, metadata, num_frame:int):
+    # the metadata (keys as in load_metadata) of the first num_frame frames in param
+    metadata = {key: getattr(param, key) for key in metadata}
+    metadata['points'] = param.points[:, :num_frame]
+    metadata['ic'] = param.ic[:num_frame]
+    metadata['mds_table'] = param.mds_table[:num_frame]
+    metadata['nz'] = num_frame
+    return metadata
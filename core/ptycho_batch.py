@@ -0,0 +1,274 @@
+'''
+Preprocess many scans from the databroker with the same settings, several scans at a time.
+
+usage: python core/ptycho_batch.py recipe.json config.txt "1238-1242, 1250" [step] [processes]
+
+The recipe (ROI, center, threshold, bad pixels and zero-out rois) is captured once, ex: by
+"save to h5" in the ROI window, and the other settings (working directory, detector, h5 layout,
+...) come from a GUI config file.
+'''
+import os
+import sys
+import copy
+import json
+import time
+import traceback
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+
+# where RoiWindow.save_to_h5 keeps the last recipe, relative to the working directory
+RECIPE_FILENAME = 'preprocess_recipe.json'
+
+
+def parse_scan_range(batch_items:str, every_nth_scan:int=1):
+    '''
+    Note the range is inclusive on both ends.
+    Ex: 1238 - 1242 with step size 2 --> [1238, 1240, 1242]
+
+    Return:
+        The scan numbers in descending order
+    '''
+    scan_range = []
+    scan_numbers = []
+
+    if batch_items == '':
+        raise ValueError("No item list is given for batch processing.")
+
+    # first parse items and separate them into two catogories
+    slist = batch_items.split(',')
+    for item in slist:
+        if '-' in item:
+            sublist = item.split('-')
+            scan_range.append((int(sublist[0].strip()), int(sublist[1].strip())))
+        else:
+            scan_numbers.append(int(item.strip()))
+
+    # next generate all legit items from the chosen ranges and make a sorted item list
+    for item in scan_range:
+        scan_numbers = scan_numbers + list(range(item[0], item[1]+1, every_nth_scan))
+    scan_numbers.sort(reverse=True)
+    return scan_numbers
+
+
+def save_options(param):
+    '''
+    Get the keyword arguments of save_data that are set in param
+    '''
+    return {'mem_budget_mb': param.mem_budget_mb if param.mem_budget_mb > 0 else None,
+            'pipelined': param.pipelined_save,
+            'diffamp_dtype': param.diffamp_dtype,
+            'frames_per_chunk': param.diffamp_chunk_frames,
+            'compression': param.diffamp_compression,
+            'cache_size_gb': param.h5_cache_gb if param.h5_cache_gb > 0 else None}
+
+
+class PreprocessRecipe(object):
+    '''
+    The per-scan settings of save_data chosen in the ROI window, to be reused for other scans
+    '''
+    def __init__(self, n:int, nn:int, cx:int, cy:int, threshold:float=1., bad_pixels=None, zero_out=None):
+        self.n = int(n)
+        self.nn = int(nn)
+        self.cx = int(cx)
+        self.cy = int(cy)
+        self.threshold = float(threshold)
+        # plain lists, so that the recipe can be written as json
+        self.bad_pixels = None if bad_pixels is None else [[int(i) for i in bad_pixels[0]],
+                                                            [int(i) for i in bad_pixels[1]]]
+        self.zero_out = None if not zero_out else [[int(i) for i in roi[:4]] for roi in zero_out]
+
+    def save(self, filename:str):
+        with open(filename, 'w') as f:
+            json.dump(self.__dict__, f, indent=1)
+
+    @classmethod
+    def load(cls, filename:str):
+        with open(filename, 'r') as f:
+            return cls(**json.load(f))
+
+    def __repr__(self):
+        return 'PreprocessRecipe(ROI {}x{} at ({}, {}), threshold {}, {} bad pixels, {} zero-out rois)'.format(
+            self.n, self.nn, self.cx, self.cy, self.threshold,
+            0 if self.bad_pixels is None else len(self.bad_pixels[0]),
+            0 if self.zero_out is None else len(self.zero_out))
+
+
+def preprocess_scan(recipe:PreprocessRecipe, param, scan_num:int):
+    '''
+    Load the metadata of the given scan and save it to h5 following the recipe. Runs in a worker
+    process of PreprocessFarm, which has its own databroker connections.
+
+    Return:
+        The elapsed time in seconds
+    '''
+    try:
+        from core.HXN_databroker import get_db, set_scan_routes, load_scan_metadata, save_data
+        from core.ptycho_cache import MetadataCache, METADATA_CACHE_FILENAME
+    except ModuleNotFoundError:
+        # for test purpose
+        from HXN_databroker import get_db, set_scan_routes, load_scan_metadata, save_data
+        from ptycho_cache import MetadataCache, METADATA_CACHE_FILENAME
+    t = time.perf_counter()
+    set_scan_routes(param.db_routes)
+    db = get_db(scan_num)
+    cache = MetadataCache(os.path.join(param.working_directory, METADATA_CACHE_FILENAME)) \
+            if param.metadata_cache else None
+    metadata = load_scan_metadata(scan_num, param.detectorkind, cache)
+    # same as MainWindow._setExpParamBroker followed by update_param_from_gui
+    param.__dict__ = {**param.__dict__, **metadata}
+    param.scan_num = str(scan_num)
+    if param.xray_energy_kev != 0.:
+        param.lambda_nm = 1.2398/param.xray_energy_kev
+    save_data(db, param, scan_num, recipe.n, recipe.nn, recipe.cx, recipe.cy, recipe.threshold,
+              recipe.bad_pixels, recipe.zero_out, **save_options(param))
+    return time.perf_counter() - t
+
+
+class PreprocessFarm(object):
+    '''
+    Apply a PreprocessRecipe to a list of scans with a pool of worker processes.
+
+    Each scan is saved independently: a scan that fails is reported and the others go on. If a
+    worker process dies (which breaks the whole pool), the scans that were not finished yet are
+    run again one by one in fresh processes, so only the scan responsible is lost.
+
+    With a lookahead, the farm runs ahead of a consumer (ex: the batch reconstruction) by at
+    most that many scans: every scan started takes a credit, which the consumer gives back
+    with release() when it takes a saved scan. A failed scan gives its credit back by itself.
+    '''
+    def __init__(self, recipe:PreprocessRecipe, param, num_processes:int=0, lookahead:int=0):
+        '''
+        Parameters:
+            - recipe: PreprocessRecipe
+            - param: Param
+                the settings shared by all scans (working directory, detectorkind, z_m, h5 layout, ...);
+                it is copied here, so it can be changed as soon as the farm is created
+            - num_processes: int
+                the number of scans preprocessed at the same time, 0 for the number of cores
+            - lookahead: int
+                the number of scans being saved or saved but not yet taken by the consumer,
+                0 for no limit
+        '''
+        self.recipe = recipe
+        # taken on the caller's thread, as the GUI keeps changing its param while the farm runs
+        self.param = copy.deepcopy(param)
+        self.num_processes = num_processes if num_processes > 0 else (os.cpu_count() or 1)
+        # databroker clients are not fork-safe
+        self._context = multiprocessing.get_context('spawn')
+        self._credits = threading.Semaphore(lookahead) if lookahead > 0 else None
+        self._granted = set()     # scans holding a credit
+        self._cancel = threading.Event()
+
+    def release(self):
+        '''
+        Called by the consumer when it takes a saved scan, letting the farm start another one
+        '''
+        if self._credits is not None:
+            self._credits.release()
+
+    def cancel(self):
+        '''
+        Do not start any more scans; those being saved are finished and reported as usual
+        '''
+        self._cancel.set()
+
+    def _acquire(self, scan_num:int):
+        if self._credits is None or scan_num in self._granted:
+            return True
+        if self._credits.acquire(blocking=False):
+            self._granted.add(scan_num)
+            return True
+        return False
+
+    @staticmethod
+    def _report(future, scan_num:int, report, broken):
+        # report the outcome of a finished future, or add the scan to broken if its worker died
+        try:
+            report(scan_num, None, future.result())
+        except BrokenProcessPool:
+            broken.append(scan_num)
+        except Exception as ex:
+            report(scan_num, ''.join(traceback.format_exception(type(ex), ex, ex.__traceback__)), None)
+
+    def _run_pool(self, scan_numbers, num_processes:int, report):
+        broken = []
+        todo = deque(scan_numbers)
+        futures = {}
+        with ProcessPoolExecutor(max_workers=num_processes, mp_context=self._context) as pool:
+            while todo or futures:
+                if self._cancel.is_set():
+                    # the scans not started yet are dropped, those being saved are finished and reported
+                    running = [future for future in futures if not future.cancel()]
+                    for future in wait(running).done:
+                        self._report(future, futures.pop(future), report, broken)
+                    break
+                # only as many scans as there are processes are submitted, so that cancel() is quick
+                while todo and len(futures) < num_processes and self._acquire(todo[0]):
+                    scan_num = todo.popleft()
+                    # each process gets its own (pickled) copy of the snapshot
+                    futures[pool.submit(preprocess_scan, self.recipe, self.param, scan_num)] = scan_num
+                if not futures:
+                    time.sleep(0.1) # waiting for the consumer
+                    continue
+                done, _ = wait(futures, timeout=0.1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self._report(future, futures.pop(future), report, broken)
+                if broken:
+                    # the other scans in flight are lost with the pool
+                    broken += futures.values()
+                    break
+        return broken, list(todo)
+
+    def run(self, scan_numbers, update_fcn=None):
+        '''
+        Preprocess the given scans in the given order, calling update_fcn(scan_num, error) as each
+        scan is done, with error being None on success or the formatted traceback
+
+        Return:
+            A dict mapping each scan number to None (saved) or the error; cancelled scans are left out
+        '''
+        results = {}
+        def report(scan_num, error, elapsed):
+            results[scan_num] = error
+            if error is None:
+                print("[BATCH] scan {} saved in {:.1f} s ({}/{})".format(scan_num, elapsed, len(results),
+                                                                         len(scan_numbers)))
+            else:
+                print("[BATCH] scan {} failed ({}/{}):\n{}".format(scan_num, len(results), len(scan_numbers),
+                                                                    error), file=sys.stderr)
+                # nobody will take this scan
+                if scan_num in self._granted:
+                    self.release()
+            if update_fcn is not None:
+                update_fcn(scan_num, error)
+
+        print("[BATCH] preprocessing {} scans with {} processes, {}".format(
+              len(scan_numbers), self.num_processes, self.recipe))
+        todo = list(scan_numbers)
+        while todo and not self._cancel.is_set():
+            broken, todo = self._run_pool(todo, self.num_processes, report)
+            for scan_num in broken:
+                # isolate the scan that killed its worker (not retried once cancelled)
+                if self._cancel.is_set() or self._run_pool([scan_num], 1, report)[0]:
+                    report(scan_num, "the worker process died unexpectedly", None)
+        return results
+
+
+if __name__ == '__main__':
+    try:
+        from core.ptycho_param import Param, parse_config
+    except ModuleNotFoundError:
+        # for test purpose
+        from ptycho_param import Param, parse_config
+    recipe = PreprocessRecipe.load(sys.argv[1])
+    param = parse_config(sys.argv[2], Param())
+    every_nth_scan = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    num_processes = int(sys.argv[5]) if len(sys.argv) > 5 else 0
+    results = PreprocessFarm(recipe, param, num_processes).run(parse_scan_range(sys.argv[3], every_nth_scan))
+    failed = sorted(scan_num for scan_num, error in results.items() if error is not None)
+    print("[BATCH] done, {} saved, {} failed {}".format(len(results) - len(failed), len(failed), failed or ''))
+    sys.exit(1 if failed else 0)
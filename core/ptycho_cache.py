@@ -0,0 +1,410 @@
+import os
+import time
+import fcntl
+import shutil
+import hashlib
+import pickle
+import sqlite3
+import numpy as np
+from numpy.lib.format import open_memmap
+try:
+    from core.ptycho_preprocess import iter_blocks, FRAMES_PER_BLOCK
+except ModuleNotFoundError:
+    # for test purpose
+    from ptycho_preprocess import iter_blocks, FRAMES_PER_BLOCK
+
+
+# where MainWindow keeps the MetadataCache, relative to the working directory
+METADATA_CACHE_FILENAME = '.ptycho_metadata.sqlite'
+
+# bump this whenever the content of the cached files changes for the same inputs
+CACHE_VERSION = 2
+
+# bump this whenever the content of the MetadataCache entries changes (the h5 files are
+# versioned by CACHE_VERSION, so changing them keeps the metadata)
+METADATA_CACHE_VERSION = 1
+
+
+def _update_hash(h, value):
+    '''
+    Feed a (possibly nested) value into the hash object h in a canonical way
+    '''
+    if value is None:
+        h.update(b'N')
+    elif isinstance(value, (list, tuple)):
+        h.update(b'L' + str(len(value)).encode())
+        for v in value:
+            _update_hash(h, v)
+    elif isinstance(value, dict):
+        h.update(b'D' + str(len(value)).encode())
+        for k in sorted(value):
+            _update_hash(h, k)
+            _update_hash(h, value[k])
+    elif isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        h.update(b'A' + str(value.dtype).encode() + str(value.shape).encode())
+        h.update(value.tobytes())
+    elif isinstance(value, (np.generic, int, float, bool)):
+        # numpy scalars and Python numbers with the same value hash the same
+        h.update(b'S' + repr(np.asarray(value).item()).encode())
+    else:
+        h.update(b'R' + repr(value).encode())
+
+
+def cache_key(*values):
+    '''
+    Hash the given values (scalars, strings, arrays, and lists/tuples/dicts of them) into a hex key
+    '''
+    h = hashlib.sha1()
+    _update_hash(h, CACHE_VERSION)
+    for value in values:
+        _update_hash(h, value)
+    return h.hexdigest()
+
+
+class H5Cache(object):
+    '''
+    A content-addressed cache of preprocessed scan files, with size-based LRU eviction.
+
+    Entries live in <directory>/<key>.h5. A hit is served by hard-linking the entry to the
+    requested path, so it takes constant time regardless of the file size. Since the cached file
+    and the linked scan file share storage, writers must remove the scan file before writing a
+    new one in its place. Across file systems (ex: the cache on local scratch) the file is copied
+    instead; a symlink is never used, as the scan file it would point to (or from) can be removed
+    or evicted independently. The access time used for LRU is the entry's mtime, refreshed on
+    every hit.
+    '''
+    def __init__(self, directory:str, max_size_gb:float):
+        self.directory = directory
+        self.max_size = int(max_size_gb * 2**30)
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.h5')
+
+    def lookup(self, key):
+        '''
+        Return the path of the cached entry for key, or None
+        '''
+        path = self._path(key)
+        if os.path.islink(path):
+            # left by an older version, its target may be gone or be the requested scan file
+            os.remove(path)
+            return None
+        if not os.path.isfile(path):
+            return None
+        os.utime(path) # mark as recently used
+        return path
+
+    def link(self, key, dest):
+        '''
+        Make dest point to the cached entry for key. Return False on a cache miss.
+        '''
+        path = self.lookup(key)
+        if path is None:
+            return False
+        _replace_with_link(path, dest)
+        return True
+
+    def store(self, key, src):
+        '''
+        Add the finished file src to the cache as the entry for key, then evict old entries
+        '''
+        path = self._path(key)
+        _replace_with_link(os.path.abspath(src), path)
+        self.evict()
+
+    def entries(self):
+        '''
+        Return a list of (mtime, size, path) of all entries, least recently used first
+        '''
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.h5'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.lstat(path)
+            except FileNotFoundError: # removed meanwhile
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        return entries
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            os.remove(path)
+            total -= size
+
+
+def _replace_with_link(src, dest):
+    if os.path.lexists(dest):
+        if os.path.exists(dest) and os.path.samefile(src, dest):
+            return # already linked, removing dest would remove the data
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        # e.g. cross-device link: copy under a temporary name, so that dest is never incomplete
+        tmp = dest + '.tmp' + str(os.getpid())
+        try:
+            shutil.copy2(src, tmp)
+            os.replace(tmp, dest)
+        finally:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+
+
+class MetadataCache(object):
+    '''
+    A persistent cache of scan metadata in a SQLite file, keyed by (database, scan id, detector).
+    The detector can also name another kind of entry of the scan, ex: '__summary__'.
+
+    Each entry is a pickled dict (ex: the output of load_metadata plus the frame shape). Only
+    finished scans should be stored, since an entry is served as is without asking the
+    databroker. A new connection is opened for every call, so one instance can be shared by
+    threads and several processes can use the same file.
+    '''
+    def __init__(self, filename:str):
+        self.filename = filename
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('''CREATE TABLE IF NOT EXISTS metadata (database TEXT, scan_id INTEGER,
+                                detector TEXT, version INTEGER, value BLOB,
+                                PRIMARY KEY (database, scan_id, detector))''')
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.filename, timeout=30.)
+
+    def get(self, database:str, scan_id:int, detector:str):
+        '''
+        Return the dict stored for the key, or None
+        '''
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT value FROM metadata WHERE database=? AND scan_id=? AND detector=? AND version=?',
+                               (database, int(scan_id), detector, METADATA_CACHE_VERSION)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        try:
+            return pickle.loads(row[0])
+        except Exception:
+            # ex: written by an incompatible pandas version, treat as a miss
+            return None
+
+    def put(self, database:str, scan_id:int, detector:str, value:dict):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?)',
+                             (database, int(scan_id), detector, METADATA_CACHE_VERSION,
+                              pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)))
+        finally:
+            conn.close()
+
+
+class RawFrameStore(object):
+    '''
+    The uncropped raw frames of one scan in a memory-mapped .npy file, plus a per-frame
+    "filled" flag so that a partially cached scan can be completed later.
+    '''
+    def __init__(self, frames, filled):
+        self.frames = frames
+        self.filled = filled
+
+    @property
+    def complete(self):
+        return bool(self.filled.all())
+
+    def has(self, start:int, stop:int):
+        return bool(self.filled[start:stop].all())
+
+    def get(self, start:int, stop:int, window=None):
+        if window is None:
+            return np.array(self.frames[start:stop])
+        return np.array(self.frames[(slice(start, stop),) + window])
+
+    def put(self, start:int, frames):
+        stop = start + frames.shape[0]
+        self.frames[start:stop] = frames
+        self.filled[start:stop] = True
+
+    def flush(self):
+        self.frames.flush()
+        self.filled.flush()
+
+
+class RawFrameCache(object):
+    '''
+    A cache of raw detector frames on fast local disk, one memory-mapped store per scan, with
+    a total size budget and LRU eviction across scans (mtime of the store is the access time).
+    Full frames are stored, so that the cache serves any ROI of the scan.
+    '''
+    def __init__(self, directory:str, max_size_gb:float):
+        self.directory = directory
+        self.max_size = int(max_size_gb * 2**30)
+        os.makedirs(directory, exist_ok=True)
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + '.frames.npy', base + '.filled.npy'
+
+    def open(self, key, num_frame:int, frame_shape=None, dtype=None):
+        '''
+        Open the store for key. If it does not exist yet, create it when frame_shape and dtype
+        are given (evicting other scans to make room), otherwise return None. None is also
+        returned if the scan alone exceeds the budget.
+
+        Opening is done under a lock file in the directory, so that two users of the cache (ex:
+        the frame viewer and save_data, or two GUIs) never create the same store at once, one
+        truncating the other's.
+        '''
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            return self._open(key, num_frame, frame_shape, dtype)
+
+    def _open(self, key, num_frame:int, frame_shape, dtype):
+        frames_path, filled_path = self._paths(key)
+        if os.path.isfile(frames_path) and os.path.isfile(filled_path):
+            frames = open_memmap(frames_path, mode='r+')
+            if frames.shape[0] == num_frame:
+                os.utime(frames_path) # mark as recently used
+                return RawFrameStore(frames, open_memmap(filled_path, mode='r+'))
+            del frames
+        if frame_shape is None or dtype is None:
+            return None
+
+        needed = num_frame * int(np.prod(frame_shape)) * np.dtype(dtype).itemsize + num_frame
+        if needed > self.max_size:
+            return None
+        self.evict(self.max_size - needed)
+        # created under temporary names and moved into place, the frames last as they mark the store
+        # as existing, so an interrupted creation never leaves a store behind
+        tmp = '.tmp' + str(os.getpid())
+        filled = open_memmap(filled_path + tmp, mode='w+', dtype=np.bool_, shape=(num_frame,))
+        frames = open_memmap(frames_path + tmp, mode='w+', dtype=dtype, shape=(num_frame,) + tuple(frame_shape))
+        os.replace(filled_path + tmp, filled_path)
+        os.replace(frames_path + tmp, frames_path)
+        return RawFrameStore(frames, filled)
+
+    def entries(self):
+        '''
+        Return a list of (mtime, size, key) of all stores, least recently used first
+        '''
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.frames.npy'):
+                continue
+            key = name[:-len('.frames.npy')]
+            size = 0
+            for path in self._paths(key):
+                if os.path.isfile(path):
+                    size += os.path.getsize(path)
+            entries.append((os.path.getmtime(os.path.join(self.directory, name)), size, key))
+        entries.sort()
+        return entries
+
+    def evict(self, max_size:int=None):
+        '''
+        Remove the least recently used stores until the total size is at most max_size
+        '''
+        if max_size is None:
+            max_size = self.max_size
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= max_size:
+                break
+            for path in self._paths(key):
+                if os.path.isfile(path):
+                    os.remove(path)
+            total -= size
+
+
+class CachedFrameReader(object):
+    '''
+    Serve raw frames from a RawFrameCache, and fill the cache from the wrapped reader
+    (a BulkFrameReader or ParallelFetcher) on a miss. Same interface as the wrapped reader.
+    '''
+    def __init__(self, cache:RawFrameCache, key:str, num_frame:int, reader):
+        self.cache = cache
+        self.key = key
+        self.num_frame = num_frame
+        self.reader = reader
+        self.num_frames = 0   # frames delivered so far
+        self.elapsed = 0.     # seconds spent in reading
+        self._store = None
+
+    @property
+    def fps(self):
+        return self.num_frames / self.elapsed if self.elapsed > 0. else 0.
+
+    def _open(self, frames=None):
+        if self._store is None:
+            if frames is None:
+                self._store = self.cache.open(self.key, self.num_frame)
+            else:
+                self._store = self.cache.open(self.key, self.num_frame, frames.shape[1:], frames.dtype)
+        return self._store
+
+    def read(self, start:int, stop:int, window=None):
+        t = time.perf_counter()
+        store = self._open()
+        if store is not None and store.has(start, stop):
+            frames = store.get(start, stop, window)
+        else:
+            # the full frames are needed to fill the cache
+            frames = self.reader.read(start, stop)
+            store = self._open(frames)
+            if store is not None:
+                store.put(start, frames)
+            if window is not None:
+                frames = frames[(slice(None),) + window]
+        self.num_frames += stop - start
+        self.elapsed += time.perf_counter() - t
+        return frames
+
+    def probe(self):
+        '''
+        Return the shape and dtype of the raw frames, from the cache if the scan is there
+        '''
+        store = self._open()
+        if store is not None:
+            return store.frames.shape[1:], store.frames.dtype
+        return self.reader.probe()
+
+    def fetch_blocks(self, keys, num_frame:int, block_size:int=FRAMES_PER_BLOCK, window=None):
+        store = self._open()
+        if store is not None and store.complete:
+            for start, stop in iter_blocks(num_frame, block_size):
+                yield start, stop, self.read(start, stop, window)
+            return
+        t = time.perf_counter()
+        for start, stop, frames in self.reader.fetch_blocks(keys, num_frame, block_size):
+            store = self._open(frames)
+            if store is not None:
+                store.put(start, frames)
+            self.num_frames += stop - start
+            self.elapsed = time.perf_counter() - t
+            yield start, stop, frames if window is None else frames[(slice(None),) + window]
+
+    def close(self):
+        if self._store is not None:
+            self._store.flush()
+            self._store = None
+        self.reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
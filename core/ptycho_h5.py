@@ -0,0 +1,187 @@
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import h5py
+
+try:
+    import hdf5plugin # registers the lz4 filter with HDF5
+except ImportError:
+    hdf5plugin = None
+
+
+# filters that can be chosen for diffamp; the shuffle filter is always applied before them
+COMPRESSIONS = ('', 'gzip', 'lzf', 'lz4')
+
+# layouts tried by benchmark_layouts() if none is given, as (frames_per_chunk, compression)
+DEFAULT_CANDIDATES = [(0, ''), (1, ''), (1, 'lzf'), (1, 'gzip'), (1, 'lz4'),
+                      (16, ''), (16, 'lzf'), (16, 'gzip'), (16, 'lz4')]
+
+
+def layout_kwargs(n:int, nn:int, frames_per_chunk:int=0, compression:str='', resizable=False,
+                  num_frame:int=None):
+    '''
+    Get the keyword arguments of h5py's create_dataset for a diffamp of frame shape (n, nn).
+
+    Parameters:
+        - frames_per_chunk: int
+            the number of frames per HDF5 chunk; 0 means contiguous storage, which is only
+            possible for uncompressed, non-resizable datasets (otherwise one frame per chunk is used)
+        - compression: str
+            one of COMPRESSIONS; '' means no compression, otherwise shuffle + the given filter
+        - resizable: bool
+            whether the dataset will be extended along the frame axis
+        - num_frame: int, optional
+            the number of frames of a non-resizable dataset; a chunk cannot hold more than that
+    '''
+    if compression not in COMPRESSIONS:
+        raise ValueError("unknown compression {}, choose from {}".format(compression, COMPRESSIONS))
+    kwargs = {}
+    if frames_per_chunk <= 0 and (compression or resizable):
+        frames_per_chunk = 1
+    if frames_per_chunk > 0 and not resizable and num_frame is not None:
+        frames_per_chunk = max(1, min(frames_per_chunk, num_frame))
+    if frames_per_chunk > 0:
+        kwargs['chunks'] = (frames_per_chunk, n, nn)
+    if resizable:
+        kwargs['maxshape'] = (None, n, nn)
+    if compression:
+        kwargs['shuffle'] = True
+        if compression == 'lz4':
+            if hdf5plugin is None:
+                raise RuntimeError("lz4 compression requires the hdf5plugin package")
+            kwargs.update(hdf5plugin.LZ4())
+        else:
+            kwargs['compression'] = compression
+    return kwargs
+
+
+def join_parts(hf, part_paths, name:str='diffamp'):
+    '''
+    Create a virtual dataset in the open file hf joining the slabs of a dataset written by
+    several processes, one file per process (ex: ptycho_mpi_save.py).
+
+    Each part holds the dataset name with the attributes start and stop, the frame range of
+    the slab in the whole scan. The parts must cover the frames without gaps or overlaps;
+    the attributes of the first part (ex: sqrt_on_load) are copied to the joined dataset.
+    '''
+    parts = []
+    for path in part_paths:
+        with h5py.File(path, 'r') as f:
+            dset = f[name]
+            parts.append((int(dset.attrs['start']), int(dset.attrs['stop']), os.path.abspath(path),
+                          dset.shape, dset.dtype, dict(dset.attrs)))
+    if not parts:
+        raise ValueError("no parts to join")
+    parts.sort(key=lambda part: part[0])
+    if parts[0][0] != 0 or any(a[1] != b[0] for a, b in zip(parts[:-1], parts[1:])):
+        raise ValueError("the parts do not cover the frames contiguously: "
+                         + str([part[:2] for part in parts]))
+
+    shape = (parts[-1][1],) + parts[0][3][1:]
+    layout = h5py.VirtualLayout(shape=shape, dtype=parts[0][4])
+    for start, stop, path, part_shape, _, _ in parts:
+        # absolute paths, since the joined file is usually opened through a symlink elsewhere
+        layout[start:stop] = h5py.VirtualSource(path, name, shape=part_shape)
+    dset = hf.create_virtual_dataset(name, layout)
+    for key, value in parts[0][5].items():
+        if key not in ('start', 'stop'):
+            dset.attrs[key] = value
+    return dset
+
+
+def _time_reads(dset, num_reads:int, frames_per_read:int, rng):
+    num_frame = dset.shape[0]
+    frames_per_read = min(frames_per_read, num_frame)
+    starts = rng.randint(0, num_frame - frames_per_read + 1, size=num_reads)
+    t = time.perf_counter()
+    for start in starts:
+        dset[start:start+frames_per_read]
+    return time.perf_counter() - t
+
+
+def benchmark_layouts(data, candidates=None, directory=None, num_reads:int=50, frames_per_rank:int=None):
+    '''
+    Measure write speed, read speed and file size of diffamp layouts for the given data.
+
+    Parameters:
+        - data: ndarray
+            a representative (nz, n, nn) diffamp, ex: the first few hundred frames of a scan
+        - candidates: list of (frames_per_chunk, compression), optional
+            default to DEFAULT_CANDIDATES (lz4 is skipped if hdf5plugin is unavailable)
+        - directory: str, optional
+            where the temporary files are written; use the disk that will hold the data
+        - num_reads: int
+            the number of random single-frame reads (frame viewer) and slab reads (MPI ranks)
+        - frames_per_rank: int, optional
+            the size of a slab read, default to 1/4 of the frames
+
+    Return:
+        A list of dicts with keys layout, write_s, frame_read_s, slab_read_s, size_mb, one per candidate
+    '''
+    if candidates is None:
+        candidates = [c for c in DEFAULT_CANDIDATES if c[1] != 'lz4' or hdf5plugin is not None]
+    if frames_per_rank is None:
+        frames_per_rank = max(1, data.shape[0] // 4)
+    n, nn = data.shape[1:]
+    rng = np.random.RandomState(0)
+
+    results = []
+    for frames_per_chunk, compression in candidates:
+        fd, path = tempfile.mkstemp(suffix='.h5', dir=directory)
+        os.close(fd)
+        try:
+            t = time.perf_counter()
+            with h5py.File(path, 'w') as hf:
+                hf.create_dataset('diffamp', data=data, **layout_kwargs(n, nn, frames_per_chunk, compression,
+                                                                        num_frame=data.shape[0]))
+            write_s = time.perf_counter() - t
+            size_mb = os.path.getsize(path) / 2**20
+            with h5py.File(path, 'r') as hf:
+                dset = hf['diffamp']
+                frame_read_s = _time_reads(dset, num_reads, 1, rng)
+                slab_read_s = _time_reads(dset, num_reads, frames_per_rank, rng)
+        finally:
+            os.remove(path)
+        results.append({'layout': (frames_per_chunk, compression), 'write_s': write_s,
+                        'frame_read_s': frame_read_s, 'slab_read_s': slab_read_s, 'size_mb': size_mb})
+    return results
+
+
+def pick_best_layout(results, metric:str='time'):
+    '''
+    Pick the best (frames_per_chunk, compression) from the output of benchmark_layouts().
+
+    metric='time' minimizes write + frame reads + slab reads, metric='size' minimizes the file size.
+    '''
+    if metric == 'size':
+        key = lambda r: r['size_mb']
+    elif metric == 'time':
+        key = lambda r: r['write_s'] + r['frame_read_s'] + r['slab_read_s']
+    else:
+        raise ValueError("metric must be 'time' or 'size'")
+    return min(results, key=key)['layout']
+
+
+def format_results(results):
+    lines = ['{:>6s} {:>5s} {:>9s} {:>13s} {:>12s} {:>9s}'.format(
+        'chunk', 'comp', 'write(s)', 'frame read(s)', 'slab read(s)', 'size(MB)')]
+    for r in results:
+        frames_per_chunk, compression = r['layout']
+        lines.append('{:>6s} {:>5s} {:9.3f} {:13.3f} {:12.3f} {:9.1f}'.format(
+            str(frames_per_chunk) if frames_per_chunk > 0 else 'contig', compression or '-',
+            r['write_s'], r['frame_read_s'], r['slab_read_s'], r['size_mb']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    # usage: python core/ptycho_h5.py scan_xxx.h5 [max_frames]
+    file_path = sys.argv[1]
+    max_frames = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    with h5py.File(file_path, 'r') as f:
+        data = f['diffamp'][:max_frames]
+    results = benchmark_layouts(data, directory=os.path.dirname(os.path.abspath(file_path)))
+    print(format_results(results))
+    print('best for speed: {}, best for size: {}'.format(pick_best_layout(results, 'time'),
+                                                           pick_best_layout(results, 'size')))
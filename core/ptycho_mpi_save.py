@@ -0,0 +1,60 @@
+'''
+Preprocess the raw frames of a scan with MPI, one contiguous range of frames per process.
+
+usage: mpirun -n N python ./core/ptycho_mpi_save.py job_file
+
+The job file is written by HXN_databroker.prepare_mpi_save(), and the part files written here
+are joined by HXN_databroker.finish_mpi_save(). No databroker access is needed.
+'''
+import sys
+import time
+import pickle
+import traceback
+import h5py
+from mpi4py import MPI
+try:
+    from core.ptycho_preprocess import FramePreprocessor, DiffampWriter, ResourceFrameReader, iter_blocks
+except ModuleNotFoundError:
+    # run as a script, core/ is on the path
+    from ptycho_preprocess import FramePreprocessor, DiffampWriter, ResourceFrameReader, iter_blocks
+
+
+def frame_range(num_frame:int, size:int, rank:int):
+    '''
+    Get the [start, stop) frames of the given rank, such that the ranges of all ranks are
+    contiguous and differ in length by at most one frame
+    '''
+    return rank * num_frame // size, (rank + 1) * num_frame // size
+
+
+def save_part(job, rank:int, size:int):
+    start, stop = frame_range(job['num_frame'], size, rank)
+    n, nn = job['n'], job['nn']
+    preprocessor = FramePreprocessor(**job['preprocessor'])
+    part_path = job['parts_dir'] + 'part_{:04d}.h5'.format(rank)
+
+    t = time.perf_counter()
+    with ResourceFrameReader(job['runs']) as reader, h5py.File(part_path, 'w') as hf:
+        writer = DiffampWriter(hf, n, nn, preprocessor.out_dtype, frames_per_chunk=job['frames_per_chunk'],
+                               compression=job['compression'])
+        writer.dset.attrs['start'] = start
+        writer.dset.attrs['stop'] = stop
+        # only the ROI (plus a margin for the bad pixels) of each frame is read and processed
+        for lo, hi in iter_blocks(stop - start, job['block_size']):
+            frames = reader.read(start + lo, start + hi, preprocessor.window)
+            writer.append(preprocessor.process(frames, start + lo))
+    elapsed = time.perf_counter() - t
+    print('[rank {}] frames {} to {} saved at {:.1f} frames/s'.format(
+          rank, start, stop, (stop - start) / elapsed if elapsed > 0. else 0.), flush=True)
+
+
+if __name__ == '__main__':
+    comm = MPI.COMM_WORLD
+    with open(sys.argv[1], 'rb') as f:
+        job = pickle.load(f)
+    try:
+        save_part(job, comm.Get_rank(), comm.Get_size())
+    except:
+        traceback.print_exc()
+        sys.stderr.flush()
+        comm.Abort(1)
@@ -1,4 +1,6 @@
 import os
+import copy
+import tempfile
 import numpy as np
 
 
@@ -23,6 +25,10 @@ def get_working_directory():
 class Param(object):
     """
     ptychography reconstruction parameters
+
+    The preprocessing parameters below (from mem_budget_mb to batch_prefetch_scans) have no widget
+    in the GUI: they are set in a config file (see parse_config) loaded into the GUI, and kept when
+    the GUI exports its config.
     """
     def __init__(self):
         # from recon_ptycho.py
@@ -135,6 +141,22 @@ class Param(object):
         self.ms_pie_flag = False
         self.sf_flag = False
 
+        # preprocessing (save to h5) parameters, config file only
+        self.mem_budget_mb = 0.     # if > 0, stream diffamp to h5 using about this much memory
+        self.pipelined_save = False # overlap frame reading, processing and h5 writing
+        self.diffamp_dtype = 'auto' # ['auto', 'float64', 'float32', 'uint16', 'uint32'], auto follows precision
+        self.diffamp_chunk_frames = 0   # frames per h5 chunk of diffamp, 0 for contiguous
+        self.diffamp_compression = ''   # ['', 'gzip', 'lzf', 'lz4'], shuffle is applied before compression
+        self.h5_cache_gb = 0.       # if > 0, keep saved h5 files in a content-addressed cache of this size
+        self.raw_cache_gb = 0.      # if > 0, keep raw frames on local disk, up to this size over all scans
+        self.raw_cache_dir = ''     # where the raw frames are kept, default to the system temp dir
+        self.db_routes = ''         # which databroker holds which scans, ex: "0-34000: db_old, 34001-48990: db1, 48991-: db2"
+        self.metadata_cache = True  # keep the metadata of finished scans in a SQLite file in the working directory
+        self.live_save = False      # keep saving a scan that is still being acquired until it ends (SWMR h5)
+        self.mpi_save_processes = 0 # if > 0, preprocess with this many MPI processes (all slots of mpi_file_path if given)
+        self.batch_save_processes = 0   # scans preprocessed at the same time in batch mode, 0 for all cores
+        self.batch_prefetch_scans = 2   # scans preprocessed ahead of the batch reconstruction, 0 for all at once
+
         # mode calculation parameter
         self.save_tmp_pic_flag = False
         #self.p_flag = False          # True to load an exsiting probe
@@ -174,6 +196,61 @@ class Param(object):
         return np.round(self.slice_spacing_m / 1e-6)
 
 
+# items merged into Param from the databroker (see load_metadata) that are only needed to save
+# the h5 file, never by the reconstruction, and are too big or not meant for a text file
+DATA_SOURCE_KEYS = ('points', 'ic', 'mds_table')
+
+
+def write_config(param, filename):
+    '''
+    Write param as a txt config that parse_config reads back, without the data source items
+
+    Parameters:
+     - param: Param
+     - filename: str
+    '''
+    with open(filename, 'w') as f:
+        f.write("[GUI]\n")
+        for key in param.__dict__:
+            if key in DATA_SOURCE_KEYS:
+                continue
+            f.write(key+" = "+str(param.__dict__[key])+"\n")
+
+
+def write_run_param(param, directory:str):
+    '''
+    Pickle what the MPI processes of a reconstruction need to know about param into a new file in
+    directory, and return its path, to be given to the processes (ex: as a command line argument)
+    and removed when they are done. Each call gets its own file, so that several runs (ex: from
+    different GUIs) can share a working directory.
+
+    The data source items (DATA_SOURCE_KEYS) are left out, as the processes read them from the
+    h5 file and they can be large.
+
+    Parameters:
+     - param: Param
+     - directory: str
+           must be visible to all MPI processes, ex: param.working_directory
+    '''
+    import pickle
+    lean = copy.copy(param)
+    for key in DATA_SOURCE_KEYS:
+        lean.__dict__.pop(key, None)
+    fd, filename = tempfile.mkstemp(prefix='.ptycho_param_', suffix='.pkl', dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump(lean, f, pickle.HIGHEST_PROTOCOL)
+    return filename
+
+
+def read_run_param(filename:str):
+    '''
+    Get the Param written by write_run_param (to be called by the MPI processes)
+    '''
+    import pickle
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
 # parse a txt file containing ptycho config generated by GUI
 def parse_config(filename, param):
     import configparser
@@ -203,6 +280,12 @@ def parse_config(filename, param):
     p.preview_flag              = config.getboolean('GUI', 'preview_flag')
     p.save_config_history       = config.getboolean('GUI', 'save_config_history')
     p.cal_error_flag            = config.getboolean('GUI', 'cal_error_flag')
+    if 'pipelined_save' in config['GUI']:
+        p.pipelined_save        = config.getboolean('GUI', 'pipelined_save')
+    if 'metadata_cache' in config['GUI']:
+        p.metadata_cache        = config.getboolean('GUI', 'metadata_cache')
+    if 'live_save' in config['GUI']:
+        p.live_save             = config.getboolean('GUI', 'live_save')
 
     # integers
     p.frame_num                 = config.getint('GUI', 'frame_num')
@@ -223,6 +306,14 @@ def parse_config(filename, param):
     p.position_correction_step  = config.getint('GUI', 'position_correction_step')
     p.start_update_probe        = config.getint('GUI', 'start_update_probe')
     p.start_update_object       = config.getint('GUI', 'start_update_object')
+    if 'diffamp_chunk_frames' in config['GUI']:
+        p.diffamp_chunk_frames  = config.getint('GUI', 'diffamp_chunk_frames')
+    if 'mpi_save_processes' in config['GUI']:
+        p.mpi_save_processes    = config.getint('GUI', 'mpi_save_processes')
+    if 'batch_save_processes' in config['GUI']:
+        p.batch_save_processes  = config.getint('GUI', 'batch_save_processes')
+    if 'batch_prefetch_scans' in config['GUI']:
+        p.batch_prefetch_scans  = config.getint('GUI', 'batch_prefetch_scans')
 
     # floats
     if 'lambda_nm' in config['GUI']:
@@ -254,6 +345,12 @@ def parse_config(filename, param):
     p.bragg_gamma               = config.getfloat('GUI', 'bragg_gamma')
     p.bragg_delta               = config.getfloat('GUI', 'bragg_delta')
     p.pc_sigma                  = config.getfloat('GUI', 'pc_sigma')
+    if 'mem_budget_mb' in config['GUI']:
+        p.mem_budget_mb         = config.getfloat('GUI', 'mem_budget_mb')
+    if 'h5_cache_gb' in config['GUI']:
+        p.h5_cache_gb           = config.getfloat('GUI', 'h5_cache_gb')
+    if 'raw_cache_gb' in config['GUI']:
+        p.raw_cache_gb          = config.getfloat('GUI', 'raw_cache_gb')
 
     # strings
     p.scan_num                  = config['GUI']['scan_num']
@@ -271,6 +368,14 @@ def parse_config(filename, param):
     p.ml_mode                   = config['GUI']['ml_mode']   # drop off box
     p.pc_alg                    = config['GUI']['pc_alg']    # drop off box
     p.precision                 = config['GUI']['precision'] # drop off box
+    if 'diffamp_dtype' in config['GUI']:
+        p.diffamp_dtype         = config['GUI']['diffamp_dtype']
+    if 'diffamp_compression' in config['GUI']:
+        p.diffamp_compression   = config['GUI']['diffamp_compression']
+    if 'db_routes' in config['GUI']:
+        p.db_routes             = config['GUI']['db_routes']
+    if 'raw_cache_dir' in config['GUI']:
+        p.raw_cache_dir         = config['GUI']['raw_cache_dir']
 
     # special cases:
     p.gpus                      = config['GUI']['gpus']
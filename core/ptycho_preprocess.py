@@ -0,0 +1,591 @@
+import numpy as np
+import h5py
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+try:
+    from core.ptycho_h5 import layout_kwargs
+    from core.widgets.imgTools import BadPixelCorrector
+except ModuleNotFoundError:
+    # for test purpose
+    from ptycho_h5 import layout_kwargs
+    from widgets.imgTools import BadPixelCorrector
+
+
+# number of raw frames processed together as one 3D block
+FRAMES_PER_BLOCK = 64
+
+# number of threads retrieving raw frames concurrently
+RETRIEVE_WORKERS = 8
+
+# storage modes of diffamp, see get_output_dtypes()
+DIFFAMP_DTYPES = ('auto', 'float64', 'float32', 'uint16', 'uint32')
+
+# end-of-stream marker passed between pipeline stages
+_DONE = object()
+
+
+def crop_rot_shift_map(frame_shape, n:int, nn:int, cx:int, cy:int):
+    '''
+    Precompute the flat indices that crop, rotate and fftshift a raw detector frame in one gather.
+
+    Parameters:
+        - frame_shape: tuple
+            the (ny, nx) shape of a raw detector frame
+        - n: int
+            the x dimension of the ROI window
+        - nn: int
+            the y dimension of the ROI window
+        - cx: int
+            x index of the center of mass
+        - cy: int
+            y index of the center of mass
+
+    Return:
+        An int array of shape (n, nn) such that frame.ravel()[index_map] equals
+        np.fft.fftshift(np.rot90(frame[cy-nn//2:cy+nn//2, cx-n//2:cx+n//2], axes=(1,0)))
+    '''
+    ny, nx = frame_shape
+    index = np.arange(ny*nx).reshape(ny, nx)
+    index = index[cy-nn//2:cy+nn//2, cx-n//2:cx+n//2]
+    index = np.rot90(index, axes=(1,0)) #equivalent to np.flipud(index).T
+    return np.ascontiguousarray(np.fft.fftshift(index))
+
+
+class FramePreprocessor(object):
+    '''
+    Turn blocks of raw detector frames into diffamp frames.
+
+    All per-frame steps of save_data (ic normalization, bad pixel removal, zero-out ROIs,
+    cropping, rot90, fftshift, threshold and sqrt) are applied to a 3D array (n_frames, ny, nx)
+    with array operations over the whole block. Bad pixels are replaced by the median of their
+    good neighbors (see BadPixelCorrector). With dtype=np.float32 the whole computation is done
+    in single precision.
+
+    Only the pixels of the ROI plus a 1-pixel margin (needed by the bad pixel neighborhoods) are
+    ever processed: self.window is that part of the detector frame, and readers can be asked to
+    deliver only it. The result is identical to processing the full frames.
+
+    The zero-out ROIs are turned once into a mask in detector coordinates and gathered into ROI
+    coordinates, so that zero-out, threshold and sqrt are done together in place on the cropped
+    block (see finalize_diffamp), reusing one boolean buffer across blocks.
+    '''
+    def __init__(self, frame_shape, n:int, nn:int, cx:int, cy:int, ic, bad_pixels=None, zero_out=None,
+                 dtype=np.float64, threshold=None, out_dtype=None):
+        '''
+        Parameters (see save_data for the others):
+            - dtype: numpy dtype
+                the dtype of the computation
+            - threshold: float, optional
+                if None, process() returns the cropped frames before threshold and sqrt
+            - out_dtype: numpy dtype, optional
+                the storage dtype, default to dtype; see get_output_dtypes
+        '''
+        ny, nx = frame_shape
+        if n >= nx:
+            raise Exception("zero padding not completed yet")
+
+        self.frame_shape = tuple(frame_shape)
+        self.n = n
+        self.nn = nn
+        self.dtype = np.dtype(dtype)
+        self.out_dtype = np.dtype(out_dtype if out_dtype is not None else dtype)
+        self.threshold = threshold
+        self.ic = np.asarray(ic, dtype=self.dtype)
+        self.bad_pixels = bad_pixels
+        self.zero_out = zero_out
+        index_map = crop_rot_shift_map(frame_shape, n, nn, cx, cy)
+        self.zero_mask = None
+        if zero_out:
+            zero_mask = np.zeros(frame_shape, dtype=bool)
+            for blue_roi in zero_out:
+                x0, y0, w, h = blue_roi[:4]
+                zero_mask[y0:y0+h, x0:x0+w] = True
+            self.zero_mask = zero_mask.ravel()[index_map]
+
+        # the bounding box of the ROI pixels with a 1-pixel margin, clipped to the frame
+        rows, cols = np.divmod(index_map, nx)
+        y0, y1 = max(int(rows.min()) - 1, 0), min(int(rows.max()) + 2, ny)
+        x0, x1 = max(int(cols.min()) - 1, 0), min(int(cols.max()) + 2, nx)
+        self.window = (slice(y0, y1), slice(x0, x1))
+        self.window_shape = (y1 - y0, x1 - x0)
+        self.index_map = (rows - y0) * (x1 - x0) + (cols - x0)
+        self.corrector = None
+        if bad_pixels is not None:
+            self.corrector = BadPixelCorrector(bad_pixels[0], bad_pixels[1], frame_shape).crop(y0, y1, x0, x1)
+        self._buffer = None
+
+    def _mask_buffer(self, shape):
+        if self._buffer is None or self._buffer.shape[0] < shape[0]:
+            self._buffer = np.empty(shape, dtype=bool)
+        return self._buffer[:shape[0]]
+
+    def process(self, frames, start:int=0):
+        '''
+        Parameters:
+            - frames: ndarray
+                raw frames of shape (n_frames, ny, nx), or already cut to self.window
+            - start: int
+                the frame number of frames[0] in the scan, used to look up ic
+
+        Return:
+            An array of shape (n_frames, n, nn), of self.out_dtype if a threshold is set,
+            otherwise the (not yet thresholded) frames of self.dtype
+        '''
+        num_frame = frames.shape[0]
+        ic = self.ic
+
+        if frames.shape[1:] != self.window_shape:
+            frames = frames[(slice(None),) + self.window]
+        frames = frames.astype(self.dtype)
+        frames *= ic[0]
+        frames /= ic[start:start+num_frame, np.newaxis, np.newaxis]
+
+        if self.corrector is not None:
+            self.corrector(frames)
+
+        # crop + rot90 + fftshift as a single gather
+        data = np.take(frames.reshape(num_frame, -1), self.index_map, axis=1)
+        del frames
+
+        if self.threshold is None:
+            if self.zero_mask is not None:
+                np.copyto(data, 0., where=self.zero_mask)
+            return data
+        return finalize_diffamp(data, self.threshold, self.out_dtype, self.zero_mask,
+                                self._mask_buffer(data.shape))
+
+
+def iter_blocks(num_frame:int, block_size:int=FRAMES_PER_BLOCK):
+    '''
+    Yield (start, stop) pairs that split range(num_frame) into consecutive blocks.
+    '''
+    for start in range(0, num_frame, block_size):
+        yield start, min(start + block_size, num_frame)
+
+
+def get_output_dtypes(diffamp_dtype:str='auto', precision:str='double'):
+    '''
+    Get the (compute dtype, storage dtype) pair for the given output mode.
+
+    Parameters:
+        - diffamp_dtype: str
+            one of DIFFAMP_DTYPES. 'auto' follows precision; 'uint16' and 'uint32' store the
+            thresholded photon counts (rounded after ic normalization) instead of amplitudes
+        - precision: str
+            'single' or 'double', ex: Param.precision
+    '''
+    if diffamp_dtype not in DIFFAMP_DTYPES:
+        raise ValueError("unknown diffamp dtype {}, choose from {}".format(diffamp_dtype, DIFFAMP_DTYPES))
+    if diffamp_dtype == 'auto':
+        diffamp_dtype = 'float32' if precision == 'single' else 'float64'
+    compute_dtype = np.float32 if (diffamp_dtype == 'float32' or precision == 'single') else np.float64
+    return np.dtype(compute_dtype), np.dtype(diffamp_dtype)
+
+
+def is_counts(dtype):
+    '''
+    Whether diffamp of this storage dtype holds photon counts, i.e. needs a sqrt on load
+    '''
+    return np.issubdtype(np.dtype(dtype), np.integer)
+
+
+def finalize_diffamp(data, threshold:float, dtype=np.float64, zero_mask=None, buffer=None):
+    '''
+    Zero out, threshold and convert the processed frames to the storage dtype, in place.
+
+    For float dtypes this is threshold + sqrt; for integer dtypes the thresholded counts
+    are rounded and clipped to the range of the dtype, and the sqrt is left to the reader.
+
+    Parameters:
+        - data: ndarray
+            the cropped frames (n_frames, n, nn), overwritten
+        - zero_mask: ndarray, optional
+            a boolean (n, nn) mask of the pixels to be zeroed out in every frame
+        - buffer: ndarray, optional
+            a boolean array of the shape of data, reused for the threshold mask
+    '''
+    dtype = np.dtype(dtype)
+    if buffer is None:
+        buffer = np.empty(data.shape, dtype=bool)
+    np.less(data, threshold, out=buffer)
+    if zero_mask is not None:
+        buffer |= zero_mask
+    np.copyto(data, 0., where=buffer)
+    if not is_counts(dtype):
+        np.sqrt(data, out=data)
+        return data.astype(dtype, copy=False)
+    np.rint(data, out=data)
+    np.clip(data, 0, np.iinfo(dtype).max, out=data)
+    return data.astype(dtype)
+
+
+def read_diffamp(dset, selection=()):
+    '''
+    Read (a selection of) a diffamp dataset as amplitudes, taking the sqrt of stored counts
+    '''
+    data = dset[selection]
+    if dset.attrs.get('sqrt_on_load', False):
+        data = np.sqrt(data)
+    return data
+
+
+def stores_counts(file_path:str):
+    '''
+    Whether the diffamp saved in file_path holds counts (sqrt_on_load), False if there is no such file
+    '''
+    try:
+        with h5py.File(file_path, 'r') as hf:
+            return bool(hf['diffamp'].attrs.get('sqrt_on_load', False))
+    except (OSError, KeyError):
+        return False
+
+
+def block_size_for_budget(frame_shape, n:int, nn:int, mem_budget_mb:float, raw_itemsize:int=8):
+    '''
+    Get the number of frames per block such that a block in flight fits into mem_budget_mb.
+
+    A block in flight holds the raw frames, their normalized float64 copy, the cropped
+    float64 output and the boolean threshold mask. Pass FramePreprocessor.window_shape as
+    frame_shape when the frames are read cut to the ROI, and the whole frame shape when they
+    are read whole (ex: through a raw frame cache).
+    '''
+    ny, nx = frame_shape
+    bytes_per_frame = (raw_itemsize + 8) * ny * nx + 9 * n * nn
+    return max(1, int(mem_budget_mb * 2**20) // bytes_per_frame)
+
+
+class DiffampWriter(object):
+    '''
+    Append processed frames to a chunked, resizable diffamp dataset in an open HDF5 file,
+    so that the whole array never has to be held in memory. See ptycho_h5.layout_kwargs for
+    frames_per_chunk and compression.
+    '''
+    def __init__(self, hf, n:int, nn:int, dtype=np.float64, name='diffamp', frames_per_chunk:int=1,
+                 compression:str=''):
+        self.dset = hf.create_dataset(name, shape=(0, n, nn), dtype=dtype,
+                                      **layout_kwargs(n, nn, frames_per_chunk, compression, resizable=True))
+        self.dset.attrs['sqrt_on_load'] = is_counts(dtype)
+
+    def append(self, block):
+        start = self.dset.shape[0]
+        self.dset.resize(start + block.shape[0], axis=0)
+        self.dset[start:] = block
+        return self.dset.shape[0]
+
+
+class ParallelFetcher(object):
+    '''
+    Retrieve raw frames with a bounded thread pool and deliver them in order.
+
+    Frame retrieval through filestore is I/O bound (each call opens and slices a detector
+    HDF5 file), so several retrievals can be in flight at the same time. At most
+    max_in_flight frames are requested ahead of the consumer.
+    '''
+    def __init__(self, retrieve, num_workers:int=RETRIEVE_WORKERS, max_in_flight:int=None, keys=None):
+        '''
+        Parameters:
+            - retrieve: callable
+                retrieve(key) returns one raw frame
+            - num_workers: int
+                the number of threads
+            - max_in_flight: int, optional
+                the number of outstanding requests, default to 4*num_workers
+            - keys: array-like, optional
+                the keys of the scan (ex: mds_table), needed by read()
+        '''
+        self.retrieve = retrieve
+        self.keys = keys
+        self.num_workers = max(1, num_workers)
+        self.max_in_flight = max_in_flight if max_in_flight is not None else 4 * self.num_workers
+        self.num_frames = 0   # frames delivered so far
+        self.elapsed = 0.     # seconds since the first request
+
+    @property
+    def fps(self):
+        return self.num_frames / self.elapsed if self.elapsed > 0. else 0.
+
+    def fetch(self, keys, window=None):
+        '''
+        A generator yielding the frames for the given keys, in the order of keys.
+        If window (a tuple of slices, ex: FramePreprocessor.window) is given, only that
+        part of each frame is kept.
+        '''
+        keys = iter(keys)
+        t_start = time.perf_counter()
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+            try:
+                for key in islice(keys, self.max_in_flight):
+                    pending.append(pool.submit(self.retrieve, key))
+                while pending:
+                    frame = pending.popleft().result()
+                    # keep the pool busy before handing the frame over
+                    for key in islice(keys, 1):
+                        pending.append(pool.submit(self.retrieve, key))
+                    self.num_frames += 1
+                    self.elapsed = time.perf_counter() - t_start
+                    yield frame if window is None else np.array(frame[window])
+            finally:
+                # the consumer may stop early (or raise), don't leave requests behind
+                for future in pending:
+                    future.cancel()
+
+    def fetch_blocks(self, keys, num_frame:int, block_size:int=FRAMES_PER_BLOCK, window=None):
+        '''
+        A generator yielding (start, stop, frames) with frames being a 3D array of the
+        raw frames [start, stop), cut to window if given
+        '''
+        frames = self.fetch(keys, window)
+        for start, stop in iter_blocks(num_frame, block_size):
+            block = list(islice(frames, stop - start))
+            if len(block) != stop - start:
+                raise ValueError("expected {} frames, but only {} keys were given".format(num_frame, start + len(block)))
+            yield start, stop, np.stack(block)
+
+    def read(self, start:int, stop:int, window=None):
+        '''
+        Return the raw frames [start, stop) of self.keys as a 3D array, cut to window if given
+        '''
+        return np.stack(list(self.fetch((self.keys[i] for i in range(start, stop)), window)))
+
+    def probe(self):
+        '''
+        Return the shape and dtype of the raw frames. Retrieving is the only way to know here,
+        so the first frame is read.
+        '''
+        first = self.read(0, 1)
+        return first.shape[1:], first.dtype
+
+    def close(self):
+        pass # nothing to release, the thread pool lives only inside fetch()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ResourceFrameReader(object):
+    '''
+    Read raw frames directly from the detector HDF5 files, given where each run of frames lives.
+
+    Each file is opened once, and every run of consecutive frames is read with a single (strided)
+    slice. The runs are plain data, so a reader can be rebuilt in another process (ex: an MPI rank)
+    without access to the databroker; see HXN_databroker.BulkFrameReader for how they are found.
+    '''
+    def __init__(self, runs):
+        '''
+        Parameters:
+            - runs: list of tuples
+                (first frame, last frame + 1, file path, dataset name, first point number, frames per point)
+                in scan order
+        '''
+        self.runs = runs
+        self.num_frames = 0   # frames delivered so far
+        self.elapsed = 0.     # seconds spent in reading
+        self._files = {}      # path -> open h5py.File
+
+    @property
+    def fps(self):
+        return self.num_frames / self.elapsed if self.elapsed > 0. else 0.
+
+    def _dataset(self, path, name):
+        if path not in self._files:
+            self._files[path] = h5py.File(path, 'r')
+        return self._files[path][name]
+
+    def _read_runs(self, start:int, stop:int, window, put):
+        for first, last, path, name, p0, fpp in self.runs:
+            lo, hi = max(first, start), min(last, stop)
+            if lo >= hi:
+                continue
+            # only the first frame of each point is used, as in db.reg.retrieve(...)[0]
+            p_lo = p0 + lo - first
+            put(lo, self._dataset(path, name)[(slice(p_lo*fpp, (p_lo+hi-lo)*fpp, fpp),) + window])
+
+    def read(self, start:int, stop:int, window=None):
+        '''
+        Return the raw frames [start, stop) of the scan as a 3D array. If window (a tuple of
+        slices, ex: FramePreprocessor.window) is given, only that part of the frames is read.
+        '''
+        if window is None:
+            window = (slice(None), slice(None))
+        t_start = time.perf_counter()
+        frames = None
+        def _put(i, block):
+            nonlocal frames
+            if frames is None:
+                frames = np.empty((stop-start,) + block.shape[1:], dtype=block.dtype)
+            frames[i-start:i-start+block.shape[0]] = block
+
+        self._read_runs(start, stop, window, _put)
+        self.num_frames += stop - start
+        self.elapsed += time.perf_counter() - t_start
+        return frames
+
+    def probe(self):
+        '''
+        Return the shape and dtype of the raw frames from the HDF5 dataset header, without
+        reading any pixel
+        '''
+        _, _, path, name, _, _ = self.runs[0]
+        dset = self._dataset(path, name)
+        return dset.shape[1:], dset.dtype
+
+    def fetch_blocks(self, keys, num_frame:int, block_size:int=FRAMES_PER_BLOCK, window=None):
+        '''
+        Same as ParallelFetcher.fetch_blocks; keys are ignored as the runs are already known
+        '''
+        for start, stop in iter_blocks(num_frame, block_size):
+            yield start, stop, self.read(start, stop, window)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PreprocessPipeline(object):
+    '''
+    Run the reader, compute and writer stages of preprocessing at the same time.
+
+    The stages run in their own threads (the writer in the caller's thread) and are joined by
+    bounded queues, so a fast stage blocks (backpressure) instead of piling up blocks in memory.
+    NumPy releases the GIL for the heavy lifting, so the compute stage overlaps with the others,
+    and so does a reader waiting on the databroker (reg.retrieve). h5py does not: every h5py call
+    holds its global lock, so a reader and a writer both using h5py (ex: BulkFrameReader) take
+    turns instead of overlapping. Such stages are given as serialized, and the wall time then
+    approaches the larger of the compute time and their summed busy times, see report().
+
+    After run(), stats holds per stage the busy time (doing work), idle time (waiting for input
+    or for room downstream) and the number of blocks handled, all in seconds.
+    '''
+    STAGES = ('reader', 'compute', 'writer')
+
+    def __init__(self, max_queued:int=2, serialized=()):
+        '''
+        Parameters:
+            - max_queued: int
+                the number of blocks waiting between two stages
+            - serialized: tuple of str, optional
+                the stages that cannot run at the same time, ex: ('reader', 'writer') when
+                both read and write through h5py
+        '''
+        self.max_queued = max_queued
+        self.serialized = tuple(serialized)
+        self.stats = {name: {'busy': 0., 'idle': 0., 'blocks': 0} for name in self.STAGES}
+        self._abort = threading.Event()
+        self._error = None
+
+    @property
+    def max_blocks_in_flight(self):
+        # two queues plus one block held by each stage
+        return 2 * self.max_queued + len(self.STAGES)
+
+    def _put(self, q, item, name):
+        t = time.perf_counter()
+        while not self._abort.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.stats[name]['idle'] += time.perf_counter() - t
+
+    def _get(self, q, name):
+        t = time.perf_counter()
+        item = None
+        while not self._abort.is_set():
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                pass
+        self.stats[name]['idle'] += time.perf_counter() - t
+        return item
+
+    def _stage(self, name, work, q_in, q_out):
+        try:
+            while not self._abort.is_set():
+                if q_in is None:
+                    t = time.perf_counter()
+                    item = next(work, _DONE)
+                else:
+                    item = self._get(q_in, name)
+                    if item is None:
+                        break
+                    t = time.perf_counter()
+                    if item is not _DONE:
+                        item = work(item)
+                if item is _DONE:
+                    self._put(q_out, _DONE, name)
+                    break
+                self.stats[name]['busy'] += time.perf_counter() - t
+                self.stats[name]['blocks'] += 1
+                self._put(q_out, item, name)
+        except BaseException as ex:
+            self._error = ex
+            self._abort.set()
+
+    def run(self, blocks, process, write):
+        '''
+        Parameters:
+            - blocks: iterable
+                the reader stage, ex: ParallelFetcher.fetch_blocks(...)
+            - process: callable
+                the compute stage, process(block) returns the block to be written
+            - write: callable
+                the writer stage, write(block)
+        '''
+        to_compute = queue.Queue(self.max_queued)
+        to_write = queue.Queue(self.max_queued)
+        threads = [threading.Thread(target=self._stage, args=('reader', iter(blocks), None, to_compute)),
+                   threading.Thread(target=self._stage, args=('compute', process, to_compute, to_write))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            while True:
+                item = self._get(to_write, 'writer')
+                if item is None or item is _DONE:
+                    break
+                t = time.perf_counter()
+                write(item)
+                self.stats['writer']['busy'] += time.perf_counter() - t
+                self.stats['writer']['blocks'] += 1
+        except BaseException:
+            self._abort.set()
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+
+        if self._error is not None:
+            raise self._error
+
+    def report(self):
+        lines = []
+        for name in self.STAGES:
+            stat = self.stats[name]
+            lines.append('{:>8s}: busy {:.2f} s, idle {:.2f} s, {:d} blocks'.format(
+                name, stat['busy'], stat['idle'], stat['blocks']))
+        # serialized stages add up, as if they were one
+        busy = {name: self.stats[name]['busy'] for name in self.STAGES if name not in self.serialized}
+        if len(self.serialized) > 0:
+            busy[' + '.join(self.serialized)] = sum(self.stats[name]['busy'] for name in self.serialized)
+        limiting = max(busy, key=busy.get)
+        lines.append('throughput is limited by the {} stage{}'.format(
+            limiting, ' (serialized by the h5py lock)' if limiting not in self.STAGES else ''))
+        return '\n'.join(lines)
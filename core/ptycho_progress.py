@@ -0,0 +1,250 @@
+'''
+A binary channel carrying the progress of a reconstruction from the MPI ranks to the GUI, next
+to (and independent of) the human-readable log on stdout.
+
+The GUI side (ProgressServer) listens on a Unix socket whose path is passed to mpirun in the
+environment variable PTYCHO_PROGRESS_SOCKET. A rank (normally rank 0, which holds the reduced
+errors) connects with ProgressClient.from_env() and sends one record per iteration:
+
+    uint32      length of the rest of the record in bytes
+    int32       iteration number (0-based)
+    uint32 x 3  number of object, probe and diff chi values (ex: modes, or slices in multislice)
+    float64     seconds spent in this iteration
+    float64 x (n_object + n_probe + n_diff)
+                the chi values, object first, then probe, then diff
+
+All fields are little endian. The chi arrays are decoded with np.frombuffer, no text parsing.
+
+Run as a script, this module stands in for the ranks of a reconstruction (see
+PtychoReconFakeWorker): python ptycho_progress.py n_iterations n_object n_probe n_diff
+'''
+import os
+import sys
+import socket
+import selectors
+import subprocess
+import struct
+import shutil
+import tempfile
+from collections import namedtuple
+import numpy as np
+
+
+ENV_VAR = 'PTYCHO_PROGRESS_SOCKET'
+
+_LENGTH = struct.Struct('<I')
+_HEADER = struct.Struct('<iIIId')
+
+ProgressRecord = namedtuple('ProgressRecord', ['iteration', 'object_chi', 'probe_chi', 'diff_chi', 'elapsed'])
+
+
+def encode_record(iteration:int, object_chi, probe_chi, diff_chi=(), elapsed:float=0.):
+    '''
+    Pack one iteration into bytes, see the module docstring for the layout
+    '''
+    arrays = [np.ascontiguousarray(a, dtype='<f8').ravel() for a in (object_chi, probe_chi, diff_chi)]
+    payload = _HEADER.pack(iteration, *(a.size for a in arrays), elapsed) + b''.join(a.tobytes() for a in arrays)
+    return _LENGTH.pack(len(payload)) + payload
+
+
+def decode_record(payload:bytes):
+    '''
+    Unpack the bytes after the length prefix into a ProgressRecord
+    '''
+    iteration, n_obj, n_prb, n_diff, elapsed = _HEADER.unpack_from(payload)
+    chi = np.frombuffer(payload, dtype='<f8', offset=_HEADER.size)
+    return ProgressRecord(iteration, chi[:n_obj], chi[n_obj:n_obj+n_prb], chi[n_obj+n_prb:n_obj+n_prb+n_diff],
+                          elapsed)
+
+
+class RecordDecoder(object):
+    '''
+    Reassemble records from a byte stream that arrives in arbitrary pieces
+    '''
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data:bytes):
+        '''
+        Add the received bytes and return the list of records completed by them
+        '''
+        self._buffer += data
+        records = []
+        while len(self._buffer) >= _LENGTH.size:
+            length, = _LENGTH.unpack_from(self._buffer)
+            if len(self._buffer) < _LENGTH.size + length:
+                break
+            records.append(decode_record(bytes(self._buffer[_LENGTH.size:_LENGTH.size+length])))
+            del self._buffer[:_LENGTH.size+length]
+        return records
+
+
+class ProgressServer(object):
+    '''
+    The receiving end, owned by the GUI. It only accepts and reads when asked, so that it can be
+    driven by the selector waiting on the output of mpirun (see iter_output_lines).
+    '''
+    def __init__(self):
+        # a private directory, as the socket path must be short and not guessable
+        self._directory = tempfile.mkdtemp(prefix='ptycho_')
+        self.path = os.path.join(self._directory, 'progress.sock')
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(self.path)
+        self.socket.listen(8)
+        self.socket.setblocking(False)
+        self._decoders = {}   # connection -> RecordDecoder
+        self.connected = False # whether any rank has connected
+
+    @property
+    def env(self):
+        '''
+        The environment variable telling the ranks where to connect
+        '''
+        return {ENV_VAR: self.path}
+
+    def accept(self):
+        '''
+        Accept a waiting rank and return its connection
+        '''
+        conn, _ = self.socket.accept()
+        conn.setblocking(False)
+        self._decoders[conn] = RecordDecoder()
+        self.connected = True
+        return conn
+
+    def receive(self, conn):
+        '''
+        Read what has arrived on conn and return the completed records; a closed connection
+        returns None and is forgotten
+        '''
+        try:
+            data = conn.recv(65536)
+        except BlockingIOError:
+            return []
+        if not data:
+            del self._decoders[conn]
+            conn.close()
+            return None
+        return self._decoders[conn].feed(data)
+
+    def close(self):
+        for conn in self._decoders:
+            conn.close()
+        self._decoders = {}
+        self.socket.close()
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ProgressClient(object):
+    '''
+    The sending end, used by a rank of the reconstruction
+    '''
+    def __init__(self, path:str):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+
+    @classmethod
+    def from_env(cls):
+        '''
+        Connect to the GUI if it asked for progress records, otherwise (or if it cannot be
+        reached, ex: the rank runs on another host) return None
+        '''
+        path = os.environ.get(ENV_VAR)
+        if not path:
+            return None
+        try:
+            return cls(path)
+        except OSError:
+            return None
+
+    def send(self, iteration:int, object_chi, probe_chi, diff_chi=(), elapsed:float=0.):
+        self.socket.sendall(encode_record(iteration, object_chi, probe_chi, diff_chi, elapsed))
+
+    def close(self):
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_output_lines(process:subprocess.Popen, progress:ProgressServer=None):
+    '''
+    A generator yielding (stream, line) from the stdout and stderr pipes of process as lines
+    complete, stream being sys.stdout or sys.stderr and line a str ending with '\n' (except
+    possibly the last one of a stream). The calling thread sleeps until either pipe has data,
+    and a line written in pieces is only yielded once complete. Stops when both pipes are closed,
+    normally when the process ends.
+
+    Parameters:
+     - progress: ProgressServer, optional. If given, the progress records sent by the ranks are
+       yielded as (None, record) in between the lines
+    '''
+    buffers = {}
+    with selectors.DefaultSelector() as selector:
+        for pipe, stream in ((process.stdout, sys.stdout), (process.stderr, sys.stderr)):
+            if pipe is not None:
+                selector.register(pipe, selectors.EVENT_READ, stream)
+                buffers[pipe] = b''
+        if progress is not None:
+            selector.register(progress.socket, selectors.EVENT_READ, 'accept')
+
+        # once the pipes are closed, only collect the records already waiting in the sockets
+        timeout = None
+        while buffers or timeout is None:
+            if not buffers:
+                timeout = 0
+            ready = selector.select(timeout)
+            if not ready and timeout == 0:
+                break
+            for key, _ in ready:
+                if key.data == 'accept':
+                    selector.register(progress.accept(), selectors.EVENT_READ, 'progress')
+                    continue
+                if key.data == 'progress':
+                    records = progress.receive(key.fileobj)
+                    if records is None:
+                        selector.unregister(key.fileobj)
+                        continue
+                    for record in records:
+                        yield None, record
+                    continue
+                pipe, stream = key.fileobj, key.data
+                # whatever is there, without waiting for more
+                chunk = os.read(pipe.fileno(), 65536)
+                if not chunk:
+                    # closed: flush a last line without '\n'
+                    selector.unregister(pipe)
+                    tail = buffers.pop(pipe)
+                    if tail:
+                        yield stream, tail.decode('utf-8', errors='replace')
+                    continue
+                *lines, buffers[pipe] = (buffers[pipe] + chunk).split(b'\n')
+                for line in lines:
+                    # '\n' never occurs inside a multi-byte character, so each line decodes on its own
+                    yield stream, line.decode('utf-8', errors='replace') + '\n'
+
+
+if __name__ == '__main__':
+    # random chi values, both logged and sent as records, like a reconstruction would
+    import time
+    n_iterations, n_object, n_probe, n_diff = (int(arg) for arg in sys.argv[1:5])
+    client = ProgressClient.from_env()
+    for it in range(n_iterations):
+        t = time.perf_counter()
+        time.sleep(.1)
+        chi = [np.random.random(k) for k in (n_object, n_probe, n_diff)]
+        print('[INFO] DM {:d} object_chi = [{}] probe_chi = [{}] diff_chi = [{}]'.format(
+              it, *(' '.join('{:f}'.format(v) for v in c) for c in chi)), flush=True)
+        if client is not None:
+            client.send(it, *chi, elapsed=time.perf_counter() - t)
+    if client is not None:
+        client.close()
@@ -1,23 +1,58 @@
 from PyQt5 import QtCore
 from datetime import datetime
-from core.ptycho_param import Param
+from core.ptycho_param import Param, write_run_param
+from core.ptycho_progress import ProgressServer, iter_output_lines
 #from .ptycho.recon_ptycho_gui import recon_gui
-import mpi4py
-mpi4py.rc.initialize = False
-from mpi4py import MPI
 import sys, os
-import pickle     # dump param into disk
 import subprocess # call mpirun from shell
-from fcntl import fcntl, F_GETFL, F_SETFL
-from os import O_NONBLOCK
-import numpy as np
 import traceback
-try:
-    from core.HXN_databroker import load_metadata, save_data
-except ImportError as ex:
-    print('[!] Unable to import core.HXN_databroker packages some features will '
-          'be unavailable')
-    print('[!] (import error: {})'.format(ex))
+
+
+def get_mpirun_command(param:Param, script:str, num_processes:int):
+    '''
+    Get the mpirun command (as a list for subprocess) that runs the given Python script with
+    num_processes processes, or on all slots of param.mpi_file_path if a machine file is given
+    '''
+    # imported here as it is slow; only the vendor is needed, MPI is not initialized in the GUI
+    import mpi4py
+    mpi4py.rc.initialize = False
+    from mpi4py import MPI
+    mpirun_command = ["mpirun", "-n", str(num_processes), "python", "-W", "ignore", script]
+
+    if 'MPICH' in MPI.get_vendor()[0]:
+        mpirun_command.insert(-1, "-u") # force flush asap (MPICH is weird...)
+
+    # use MPI machine file if available, assuming each line of which is: 
+    # ip_address slots=n max-slots=n   --- Open MPI
+    # ip_address:n                     --- MPICH
+    if param.mpi_file_path != '':
+        with open(param.mpi_file_path, 'r') as f:
+            node_count = 0
+            if MPI.get_vendor()[0] == 'Open MPI':
+                for line in f:
+                    line = line.split()
+                    node_count += int(line[1].split('=')[-1])
+                mpirun_command.insert(3, "-machinefile")
+                # use mpirun to find where MPI is installed
+                import shutil
+                path = os.path.split(shutil.which('mpirun'))[0] 
+                if path[-3:] == 'bin':
+                    path = path[:-3]
+                mpirun_command[4:4] = ["--prefix", path, "-x", "PATH", "-x", "LD_LIBRARY_PATH"]
+            elif 'MPICH' in MPI.get_vendor()[0]:
+                for line in f:
+                    line = line.split(":")
+                    node_count += int(line[1])
+                mpirun_command.insert(3, "-f")
+            else:
+                raise RuntimeError("mpi4py is built on top of unrecognized MPI library. "
+                                   "Only Open MPI and MPICH are tested.")
+            mpirun_command[2] = str(node_count) # use all available nodes
+            mpirun_command.insert(4, param.mpi_file_path)
+            #param.gpus = range(node_count)
+            #print(" ".join(mpirun_command))
+
+    return mpirun_command
 
 
 class PtychoReconWorker(QtCore.QThread):
@@ -27,136 +62,87 @@ class PtychoReconWorker(QtCore.QThread):
     def __init__(self, param:Param=None, parent=None):
         super().__init__(parent)
         self.param = param
+        self.exception_handler = None
 
     def _parse_message(self, tokens):
-        def _parser(current, upper_limit, target_list):
-            if self.param.mode_flag:
-                for j in range(upper_limit):
-                    target_list.append(float(tokens[current+2+j]))
-            elif self.param.multislice_flag:
-                raise NotImplementedError("PtychoReconWorker's parser doesn't know how to handle multislice yet.") 
-            else:
-                target_list.append(float(tokens[current+2]))
-    
-        # assuming tokens (stdout line) is split but not yet processed
+        # assuming tokens (stdout line) is split but not yet processed, ex:
+        # [INFO] DM 12 object_chi = [0.1 0.2] probe_chi = [0.3 0.4 0.5] diff_chi = 0.6
+        # each chi takes all the numbers after it, so any number of modes or slices is fine
         it = int(tokens[2])
-        
-        # first remove brackets
-        empty_index_list = []
-        for i, token in enumerate(tokens):
-            tokens[i] = token.replace('[', '').replace(']', '')
-            if tokens[i] == '':
-                empty_index_list.append(i)
-        counter = 0
-        for i in empty_index_list:
-            del tokens[i-counter]
-            counter += 1
-
-        # next parse based on param and the known format
-        prb_list = []
-        obj_list = []
-        for i, token in enumerate(tokens):
-            if token == 'probe_chi':
-                _parser(i, self.param.prb_mode_num, prb_list)
-            if token == 'object_chi':
-                _parser(i, self.param.obj_mode_num, obj_list)
-
-        # return a dictionary
-        result = {'probe_chi':prb_list, 'object_chi':obj_list}
+        result = {'probe_chi':[], 'object_chi':[]}
+        name = None
+        for token in tokens[3:]:
+            token = token.replace('[', '').replace(']', '')
+            if token == '' or token == '=':
+                continue
+            try:
+                value = float(token)
+            except ValueError:
+                name = token
+                result.setdefault(name, [])
+                continue
+            if name is not None:
+                result[name].append(value)
 
         return it, result
 
+    def _get_command(self, param:Param, param_path:str):
+        # the command running the reconstruction, given the path of the pickled param
+        if param.gpu_flag:
+            num_processes = len(param.gpus)
+        else:
+            num_processes = param.processes if param.processes > 1 else 1
+        mpirun_command = get_mpirun_command(param, "./core/ptycho/recon_ptycho_gui.py", num_processes)
+        mpirun_command.append(param_path) # read back with read_run_param
+        return mpirun_command
 
     def recon_api(self, param:Param, update_fcn=None):
-        with open(param.working_directory + '.ptycho_param.pkl', 'wb') as output:
-            # dump param into disk and let children read it back
-            pickle.dump(param, output, pickle.HIGHEST_PROTOCOL)
-            print("pickle dumped")
+        # the reconstruction in core/ptycho reads diffamp as amplitudes and knows nothing about
+        # sqrt_on_load, so it would silently reconstruct from counts
+        # (checked through the symlink the reconstruction opens, which may point into the h5 cache)
+        from core.ptycho_preprocess import stores_counts
+        if stores_counts(param.working_directory + '/scan_' + str(param.scan_num) + '.h5'):
+            raise ValueError("diffamp of scan {} is saved as photon counts, which the reconstruction cannot read "
+                             "yet. Save it again with diffamp_dtype float32 or float64.".format(param.scan_num))
 
-        # working version
-        if param.gpu_flag:
-            num_processes = str(len(param.gpus))
-        else:
-            num_processes = str(param.processes) if param.processes > 1 else str(1)
-        mpirun_command = ["mpirun", "-n", num_processes, "python", "-W", "ignore", "./core/ptycho/recon_ptycho_gui.py"]
-                
-        if 'MPICH' in MPI.get_vendor()[0]:
-            mpirun_command.insert(-1, "-u") # force flush asap (MPICH is weird...)
-
-        # use MPI machine file if available, assuming each line of which is: 
-        # ip_address slots=n max-slots=n   --- Open MPI
-        # ip_address:n                     --- MPICH
-        if param.mpi_file_path != '':
-            with open(param.mpi_file_path, 'r') as f:
-                node_count = 0
-                if MPI.get_vendor()[0] == 'Open MPI':
-                    for line in f:
-                        line = line.split()
-                        node_count += int(line[1].split('=')[-1])
-                    mpirun_command.insert(3, "-machinefile")
-                    # use mpirun to find where MPI is installed
-                    import shutil
-                    path = os.path.split(shutil.which('mpirun'))[0] 
-                    if path[-3:] == 'bin':
-                        path = path[:-3]
-                    mpirun_command[4:4] = ["--prefix", path, "-x", "PATH", "-x", "LD_LIBRARY_PATH"]
-                elif 'MPICH' in MPI.get_vendor()[0]:
-                    for line in f:
-                        line = line.split(":")
-                        node_count += int(line[1])
-                    mpirun_command.insert(3, "-f")
-                else:
-                    raise RuntimeError("mpi4py is built on top of unrecognized MPI library. "
-                                       "Only Open MPI and MPICH are tested.")
-                mpirun_command[2] = str(node_count) # use all available nodes
-                mpirun_command.insert(4, param.mpi_file_path)
-                #param.gpus = range(node_count)
-                #print(" ".join(mpirun_command))
+        # dump param (without the data source items) into a file of this run only and let the
+        # children read it back with read_run_param(sys.argv[1])
+        param_path = write_run_param(param, param.working_directory)
+        print("pickle dumped")
+
+        mpirun_command = self._get_command(param, param_path)
+
+        # the ranks report each iteration through a binary channel if the reconstruction code
+        # supports it; otherwise the [INFO] lines of the log are parsed instead
+        progress = ProgressServer()
 
         try:
             return_value = None
             with subprocess.Popen(mpirun_command,
                                   stdout=subprocess.PIPE,
                                   stderr=subprocess.PIPE,
-                                  env=dict(os.environ, mpi_warn_on_fork='0')) as run_ptycho:
+                                  env=dict(os.environ, mpi_warn_on_fork='0', **progress.env)) as run_ptycho:
                 self.process = run_ptycho # register the subprocess
 
-                # idea: if we attempts to readline from an empty pipe, it will block until 
-                # at least one line is piped in. However, stderr is ususally empty, so reading
-                # from it is very likely to block the output until the subprocess ends, which 
-                # is bad. Thus, we want to set the O_NONBLOCK flag for stderr, see
-                # http://eyalarubas.com/python-subproc-nonblock.html 
-                #
-                # Note that it is unclear if readline in Python 3.5+ is guaranteed safe with 
-                # non-blocking pipes or not. See https://bugs.python.org/issue1175#msg56041 
-                # and https://stackoverflow.com/questions/375427/
-                # If this is a concern, using the asyncio module could be a safer approach?
-                # One could also process stdout in one loop and then stderr in another, which
-                # will not have the blocking issue.
-                flags = fcntl(run_ptycho.stderr, F_GETFL) # first get current stderr flags
-                fcntl(run_ptycho.stderr, F_SETFL, flags | O_NONBLOCK)
-
-                while True:
-                    stdout = run_ptycho.stdout.readline()
-                    stderr = run_ptycho.stderr.readline() # without O_NONBLOCK this will very likely block
-                    if (run_ptycho.poll() is not None) and (stdout==b'') and (stderr==b''):
-                        break
-
-                    if stdout:
-                        stdout = stdout.decode('utf-8')
-                        print(stdout, end='') # because the line already ends with '\n'
-                        stdout = stdout.split()
-                        if len(stdout) > 0 and stdout[0] == "[INFO]" and update_fcn is not None:
-                            it, result = self._parse_message(stdout)
+                # wait on both pipes and the progress channel at once, so that none can hold back the others
+                for stream, line in iter_output_lines(run_ptycho, progress):
+                    if stream is None:
+                        if update_fcn is not None:
+                            record = line
+                            result = {'object_chi':record.object_chi, 'probe_chi':record.probe_chi,
+                                      'diff_chi':record.diff_chi, 'elapsed':record.elapsed}
+                            update_fcn(record.iteration+1, result)
+                        continue
+                    print(line, file=stream, end='') # because the line already ends with '\n'
+                    if stream is sys.stdout and update_fcn is not None and not progress.connected:
+                        tokens = line.split()
+                        if len(tokens) > 0 and tokens[0] == "[INFO]":
+                            it, result = self._parse_message(tokens)
                             #print(result['probe_chi'])
                             update_fcn(it+1, result)
 
-                    if stderr:
-                        stderr = stderr.decode('utf-8')
-                        print(stderr, file=sys.stderr, end='')
-
                 # get the return value 
-                return_value = run_ptycho.poll()
+                return_value = run_ptycho.wait()
 
             if return_value != 0:
                 message = "At least one MPI process returned a nonzero value, so the whole job is aborted.\n"
@@ -168,9 +154,8 @@ class PtychoReconWorker(QtCore.QThread):
             #raise ex
         finally:
             # clean up temp file
-            os.remove(param.working_directory + '.ptycho_param.pkl')
-            if os.path.isfile(param.working_directory + ".ptycho_param.txt"):
-                os.remove(param.working_directory + ".ptycho_param.txt")
+            progress.close()
+            os.remove(param_path)
 
     def run(self):
         print('Ptycho thread started')
@@ -178,6 +163,12 @@ class PtychoReconWorker(QtCore.QThread):
             self.recon_api(self.param, self.update_signal.emit)
         except IndexError:
             print("[ERROR] IndexError --- most likely a wrong MPI machine file is given?", file=sys.stderr)
+        except ValueError as ex:
+            # raised before the MPI processes are started, so nothing else reports it
+            if self.exception_handler is not None:
+                self.exception_handler(ex)
+            else:
+                print("[ERROR] " + str(ex), file=sys.stderr)
         except:
             # whatever happened in the MPI processes will always (!) generate traceback,
             # so do nothing here
@@ -195,10 +186,11 @@ class PtychoReconWorker(QtCore.QThread):
 # a worker that does the rest of hard work for us
 class HardWorker(QtCore.QThread):
     update_signal = QtCore.pyqtSignal(int, object) # connect to MainWindow???
-    def __init__(self, task=None, *args, parent=None):
+    def __init__(self, task=None, *args, parent=None, **kwargs):
         super().__init__(parent)
         self.task = task
         self.args = args
+        self.kwargs = kwargs
         self.exception_handler = None
         #self.update_signal = QtCore.pyqtSignal(int, object) # connect to MainWindow???
 
@@ -206,8 +198,16 @@ class HardWorker(QtCore.QThread):
         try:
             if self.task == "save_h5":
                 self._save_h5(self.update_signal.emit)
+            elif self.task == "save_h5_live":
+                self._save_h5_live(self.update_signal.emit)
+            elif self.task == "save_h5_mpi":
+                self._save_h5_mpi(self.update_signal.emit)
+            elif self.task == "preprocess_batch":
+                self._preprocess_batch(self.update_signal.emit)
             elif self.task == "fetch_data":
                 self._fetch_data(self.update_signal.emit)
+            elif self.task == "load_catalog":
+                self._load_catalog(self.update_signal.emit)
             # TODO: put other heavy lifting works here
             # TODO: consider merge other worker threads to this one?
         except ValueError as ex:
@@ -225,105 +225,97 @@ class HardWorker(QtCore.QThread):
     def _save_h5(self, update_fcn=None):
         '''
         args = [db, param, scan_num, roi_width, roi_height, cx, cy, threshold, bad_pixels]
+        kwargs: optional keyword arguments of save_data
         '''
+        from core.HXN_databroker import save_data
         print("saving data to h5, this may take a while...")
-        save_data(*self.args)
+        save_data(*self.args, **self.kwargs)
         print("h5 saved.")
 
-    def _fetch_data(self, update_fcn=None):
+    def _save_h5_live(self, update_fcn=None):
         '''
-        args = [db, scan_id, det_name]
+        args = [db, param, scan_num, roi_width, roi_height, cx, cy, threshold, bad_pixels]
+        kwargs: optional keyword arguments of save_data_live
         '''
-        if update_fcn is not None:
-            print("loading begins, this may take a while...", end='')
-            metadata = load_metadata(*self.args)
-
-            # sanity checks
-            if metadata['nz'] == 0:
-                raise ValueError("nz = 0")
-            #print("databroker connected, parsing experimental parameters...", end='')
-            # get nx and ny by looking at the first image
-            img = self.args[0].reg.retrieve(metadata['mds_table'].iat[0])[0]
-            nx, ny = img.shape # can also give a ValueError; TODO: come up a better way!
-            metadata['nx'] = nx
-            metadata['ny'] = ny
-
-            update_fcn(0, metadata) # 0 is just a placeholder
-
-
-class PtychoReconFakeWorker(QtCore.QThread):
-    update_signal = QtCore.pyqtSignal(int, object)
-
-    def __init__(self, param:Param=None, parent=None):
-        super().__init__(parent)
-        self.param = param
-
-    def _get_random_message(self, it):
-        object_chi = np.random.random()
-        probe_chi = np.random.random()
-        diff_chi = np.random.random()
-        return '[INFO] DM {:d} object_chi = {:f} probe_chi = {:f} diff_chi = {:f}'.format(
-            it, object_chi, probe_chi, diff_chi)
-
-    def _array_to_str(self, arr):
-        arrstr = ''
-        for v in arr: arrstr += '{:f} '.format(v)
-        return arrstr
-
-    def _get_random_message_multi(self, it):
-        object_chi = np.random.random(4)
-        probe_chi = np.random.random(4)
-        diff_chi = np.random.random(4)
-
-        object_chi_str = self._array_to_str(object_chi)
-        probe_chi_str = self._array_to_str(probe_chi)
-        diff_chi_str = self._array_to_str(diff_chi)
-
-        return '[INFO] DM {:d} object_chi = {:s} probe_chi = {:s} diff_chi = {:s}'.format(
-            it, object_chi_str, probe_chi_str, diff_chi_str)
-
-
-    def _parse_message(self, message):
-        message = str(message).replace('[', '').replace(']', '')
-
-        tokens = message.split()
-        id, alg, it = tokens[0], tokens[1], int(tokens[2])
-
-        metric_tokens = tokens[3:]
-        metric = {}
-        name = 'Unknown'
-        data = []
-
-        for i in range(len(metric_tokens)):
-            token = str(metric_tokens[i])
-
-            if token == '=': continue
-
-            if i < len(metric_tokens) - 2 and metric_tokens[i+1] == '=':
-                if len(data): metric[name] = list(data)
-                name = token
-                data = []
-                continue
-
-            data.append(float(token))
-
-        if len(data):
-            metric[name] = data
+        from core.HXN_databroker import save_data_live
+        print("saving data to h5 while the scan is running...")
+        # the metadata of the frames saved so far goes back to the GUI's param through update_fcn
+        save_data_live(*self.args, update_fcn=update_fcn, **self.kwargs)
+        print("h5 saved.")
 
-        return id, alg, it, metric
+    def _save_h5_mpi(self, update_fcn=None):
+        '''
+        args = [db, param, scan_num, roi_width, roi_height, cx, cy, threshold, bad_pixels]
+        kwargs: optional keyword arguments of prepare_mpi_save
 
-    def run(self):
-        from time import sleep
-        update_fcn = self.update_signal.emit
-        for it in range(self.param.n_iterations):
+        Same as _save_h5, but the frames are processed by param.mpi_save_processes MPI processes
+        (or all slots of param.mpi_file_path), launched the same way as the reconstruction
+        '''
+        param = self.args[1]
+        from core.HXN_databroker import prepare_mpi_save, finish_mpi_save
+        print("saving data to h5 with MPI, this may take a while...")
+        job_path = prepare_mpi_save(*self.args, **self.kwargs)
+        try:
+            mpirun_command = get_mpirun_command(param, "./core/ptycho_mpi_save.py", param.mpi_save_processes)
+            mpirun_command.append(job_path)
+            with subprocess.Popen(mpirun_command,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE,
+                                  env=dict(os.environ, mpi_warn_on_fork='0')) as save_process:
+                for stream, line in iter_output_lines(save_process):
+                    print(line, file=stream, end='')
+            if save_process.returncode != 0:
+                raise Exception("At least one MPI process returned a nonzero value, so the h5 is not saved.\n"
+                                "Consult the Traceback above to identify the problem.")
+            finish_mpi_save(param, job_path)
+        finally:
+            os.remove(job_path)
+        print("h5 saved.")
 
-            message = self._get_random_message(it)
-            _id, _alg, _it, _metric = self._parse_message(message)
+    def _preprocess_batch(self, update_fcn=None):
+        '''
+        args = [farm, scan_numbers]
+        update_fcn(scan_num, error) is called as each scan is done, error being None on success
+        '''
+        farm, scan_numbers = self.args
+        farm.run(scan_numbers, update_fcn)
 
-            update_fcn(_it+1, _metric)
-            sleep(.1)
+    def _fetch_data(self, update_fcn=None):
+        '''
+        args = [scan_id, det_name]
+        kwargs: cache (a MetadataCache, optional)
+        '''
+        if update_fcn is not None:
+            print("loading begins, this may take a while...", end='')
+            # can give a ValueError if no image is available
+            from core.HXN_databroker import load_scan_metadata
+            metadata = load_scan_metadata(*self.args, **self.kwargs)
 
-        print("finished")
+            update_fcn(0, metadata) # 0 is just a placeholder
 
-    def kill(self):
-        pass
+    def _load_catalog(self, update_fcn=None):
+        '''
+        args = [scan_numbers]
+        kwargs: cache (a MetadataCache, optional)
+        '''
+        from core.HXN_databroker import load_catalog
+        def report(scan_num, summary, error):
+            if update_fcn is not None:
+                update_fcn(scan_num, (summary, error))
+        load_catalog(*self.args, update_fcn=report, **self.kwargs)
+
+
+class PtychoReconFakeWorker(PtychoReconWorker):
+    '''
+    Run ptycho_progress.py in place of the reconstruction: it logs random chi values and sends
+    them through the progress channel, as the ranks would (for testing GUI changes)
+    '''
+    def _get_command(self, param:Param, param_path:str):
+        if param.mode_flag:
+            n_object, n_probe = param.obj_mode_num, param.prb_mode_num
+        elif param.multislice_flag:
+            n_object, n_probe = param.slice_num, 1
+        else:
+            n_object, n_probe = 1, 1
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ptycho_progress.py')
+        return [sys.executable, script, str(param.n_iterations), str(n_object), str(n_probe), '1']
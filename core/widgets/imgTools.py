@@ -1,3 +1,4 @@
+import copy
 import numpy as np
 from scipy.ndimage import median_filter
 
@@ -14,6 +15,86 @@ def rm_outlier_pixels(data, rows, cols, set_to_zero=False):
     return data
 
 
+class BadPixelCorrector(object):
+    '''
+    Replace bad pixels by the median of their good neighbors, for a whole stack of frames at once.
+
+    The neighbors of each bad pixel (its 3x3 neighborhood without itself, other bad pixels and
+    anything outside the frame) are found once per bad-pixel set. Correcting a block of frames is
+    then one gather, one sort and one scatter, independent of the order of the bad pixels.
+    A bad pixel without any good neighbor is set to zero.
+    '''
+    def __init__(self, rows, cols, frame_shape):
+        assert(len(rows) == len(cols))
+        ny, nx = frame_shape
+        rows = np.asarray(rows, dtype=np.intp)
+        cols = np.asarray(cols, dtype=np.intp)
+        inside = (rows >= 0) & (rows < ny) & (cols >= 0) & (cols < nx)
+        rows, cols = rows[inside], cols[inside]
+
+        bad = np.zeros(frame_shape, dtype=bool)
+        bad[rows, cols] = True
+
+        offsets = [(i, j) for i in (-1, 0, 1) for j in (-1, 0, 1) if (i, j) != (0, 0)]
+        nb_rows = rows[:, np.newaxis] + np.array([i for i, _ in offsets])
+        nb_cols = cols[:, np.newaxis] + np.array([j for _, j in offsets])
+        valid = (nb_rows >= 0) & (nb_rows < ny) & (nb_cols >= 0) & (nb_cols < nx)
+        nb_rows = np.clip(nb_rows, 0, ny-1)
+        nb_cols = np.clip(nb_cols, 0, nx-1)
+        valid &= ~bad[nb_rows, nb_cols]
+
+        self.frame_shape = tuple(frame_shape)
+        self.pixels = rows * nx + cols               # flat indices of the bad pixels
+        self.neighbors = nb_rows * nx + nb_cols      # (n_bad, 8) flat indices
+        self.valid = valid                           # (n_bad, 8) which neighbors count
+        count = valid.sum(axis=1)
+        self.has_neighbors = count > 0
+        # after sorting with the invalid neighbors pushed to the end, the median is the mean of these two
+        self.lower = np.maximum(count - 1, 0) // 2
+        self.upper = count // 2
+
+    def __call__(self, data):
+        '''
+        Correct a frame (ny, nx) or a stack of frames (n_frames, ny, nx) in place and return it
+        '''
+        if len(self.pixels) == 0:
+            return data
+        flat = data.reshape(-1, self.frame_shape[0] * self.frame_shape[1])
+        values = flat[:, self.neighbors].astype(np.float64)
+        values[:, ~self.valid] = np.inf
+        values.sort(axis=-1)
+        index = np.arange(len(self.pixels))
+        median = 0.5 * (values[:, index, self.lower] + values[:, index, self.upper])
+        median[:, ~self.has_neighbors] = 0.
+        flat[:, self.pixels] = median.astype(data.dtype, copy=False)
+        if not np.shares_memory(flat, data):
+            data[...] = flat.reshape(data.shape)
+        return data
+
+    def crop(self, y0:int, y1:int, x0:int, x1:int):
+        '''
+        Get a corrector for the window [y0:y1, x0:x1] of the frames, giving the same result there
+        as correcting the full frames. Only the bad pixels whose whole neighborhood lies in the
+        window are kept, so the window needs a 1-pixel margin around the pixels of interest.
+        '''
+        nx = self.frame_shape[1]
+        rows, cols = np.divmod(self.pixels, nx)
+        nb_rows, nb_cols = np.divmod(self.neighbors, nx)
+        keep = (rows >= y0) & (rows < y1) & (cols >= x0) & (cols < x1)
+        keep &= ((nb_rows >= y0) & (nb_rows < y1) & (nb_cols >= x0) & (nb_cols < x1)).all(axis=1)
+
+        # validity was decided on the full frame, so bad pixels outside the window still count
+        cropped = copy.copy(self)
+        cropped.frame_shape = (y1 - y0, x1 - x0)
+        cropped.pixels = (rows[keep] - y0) * (x1 - x0) + (cols[keep] - x0)
+        cropped.neighbors = (nb_rows[keep] - y0) * (x1 - x0) + (nb_cols[keep] - x0)
+        cropped.valid = self.valid[keep]
+        cropped.has_neighbors = self.has_neighbors[keep]
+        cropped.lower = self.lower[keep]
+        cropped.upper = self.upper[keep]
+        return cropped
+
+
 def find_outlier_pixels(data,tolerance=3,worry_about_edges=True, get_fixed_image=False):
     #This function finds the hot or dead pixels in a 2D dataset.
     #tolerance is the number of standard deviations used to cutoff the hot pixels
@@ -1,31 +1,25 @@
 import sys
 import os
+import time
+import tempfile
+import threading
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtWidgets import QFileDialog, QAction
 
 from ui import ui_ptycho
-from core.ptycho_param import Param, parse_config
+from core.ptycho_param import Param, parse_config, write_config
 from core.ptycho_recon import PtychoReconWorker, PtychoReconFakeWorker, HardWorker
 from core.ptycho_qt_utils import PtychoStream
-from core.widgets.mplcanvas import load_image_pil
+from core.ptycho_batch import PreprocessRecipe, PreprocessFarm, RECIPE_FILENAME, parse_scan_range
 
-# databroker related
-try:
-    from core.HXN_databroker import db1, db2, db_old, load_metadata
-    from hxntools.scan_info import ScanInfo
-except ImportError as ex:
-    print('[!] Unable to import hxntools-related packages some features will '
-          'be unavailable')
-    print('[!] (import error: {})'.format(ex))
+# to show the window sooner, the heavy modules are imported on first use:
+# - h5py (core.ptycho_preprocess, core.ptycho_cache) when a file or cache is opened
+# - databroker and hxntools (core.HXN_databroker) when loading from the databroker
+# - matplotlib (the secondary windows) when they are opened
 
-from reconStep_gui import ReconStepWindow
-from roi_gui import RoiWindow
-
-import h5py
 import numpy as np
 from numpy import pi
 from numpy.lib.format import open_memmap
-import matplotlib.pyplot as plt
 import traceback
 
 
@@ -73,6 +67,7 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
         self.menu_export_config.triggered.connect(self.exportConfig)
         self.menu_clear_config_history.triggered.connect(self.removeConfigHistory)
         self.menu_save_config_history.triggered.connect(self.saveConfigHistory)
+        self.menu_scan_catalog.triggered.connect(self.showScanCatalog)
 
         self.btn_MPI_file.clicked.connect(self.setMPIfile)
         self.btn_gpu_all = [self.btn_gpu_0, self.btn_gpu_1, self.btn_gpu_2, self.btn_gpu_3]
@@ -95,15 +90,25 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
         self._ptycho_gpu_thread = None
         self._worker_thread = None
         self._db = None             # hold the Broker instance that contains the info of the given scan id
-        self._mds_table = None      # hold a Pandas.dataframe instance
+        self._mds_table = None      # hold the datum ids of the frames (a numpy array)
+        self._frame_reader = None   # hold a BulkFrameReader for the frames in _mds_table
+        self._raw_cache = None      # hold a RawFrameCache, see the raw_cache property
+        self._metadata_cache = None # hold a MetadataCache, see the metadata_cache property
         self._loaded = False        # whether the user has loaded metadata or not (from either databroker or h5)
         self._scan_numbers = None   # a list of scan numbers for batch mode
         self._batch_prb_filename = None  # probe's filename template for batch mode
         self._batch_obj_filename = None  # object's filename template for batch mode
+        self._batch_farm = None     # PreprocessFarm saving scans ahead of the batch reconstruction
+        self._batch_thread = None   # the HardWorker running _batch_farm, apart from _worker_thread
+        self._batch_preprocess = False  # the batch scans come from _batchPreprocess
+        self._batch_saved = set()   # scans saved by the farm
+        self._batch_failed = set()  # scans the farm could not save
+        self._batch_waiting = False # the batch reconstruction waits for the farm
         self._config_path = os.path.expanduser("~") + "/.ptycho_gui_config"
 
         self.reconStepWindow = None
         self.roiWindow = None
+        self.catalogWindow = None
 
         #if self.menu_save_config_history.isChecked(): # TODO: think of a better way...
         self.retrieveConfigHistory()
@@ -125,12 +130,36 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
     @db.setter
     def db(self, scan_id:int):
         # choose the correct Broker instance based on the given scan id
-        if scan_id <= 34000:
-            self._db = db_old
-        elif scan_id <= 48990:
-            self._db = db1
-        else:
-            self._db = db2
+        from core.HXN_databroker import get_db
+        self.setScanRoutes()
+        self._db = get_db(scan_id)
+
+
+    @property
+    def raw_cache(self):
+        # the local raw-frame cache, or None if it is disabled (param.raw_cache_gb = 0)
+        p = self.param
+        if p.raw_cache_gb <= 0:
+            return None
+        from core.ptycho_cache import RawFrameCache
+        directory = p.raw_cache_dir or os.path.join(tempfile.gettempdir(), 'ptycho_raw_frames')
+        if self._raw_cache is None or self._raw_cache.directory != directory \
+            or self._raw_cache.max_size != int(p.raw_cache_gb * 2**30):
+            self._raw_cache = RawFrameCache(directory, p.raw_cache_gb)
+        return self._raw_cache
+
+
+    @property
+    def metadata_cache(self):
+        # the metadata cache of the working directory, or None if it is disabled (param.metadata_cache = False)
+        p = self.param
+        if not p.metadata_cache:
+            return None
+        from core.ptycho_cache import MetadataCache, METADATA_CACHE_FILENAME
+        filename = os.path.join(p.working_directory, METADATA_CACHE_FILENAME)
+        if self._metadata_cache is None or self._metadata_cache.filename != filename:
+            self._metadata_cache = MetadataCache(filename)
+        return self._metadata_cache
 
 
     def resetButtons(self):
@@ -140,7 +169,8 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
         self.btn_recon_batch_stop.setEnabled(False)
         self.recon_bar.setValue(0)
         #plt.ioff()
-        plt.close('all')
+        if 'matplotlib.pyplot' in sys.modules: # nothing to close if no window has plotted yet
+            sys.modules['matplotlib.pyplot'].close('all')
         # close the mmap arrays
         # removing these arrays, can be changed later if needed
         if self._prb is not None:
@@ -428,6 +458,7 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
             # init reconStepWindow
             if self.ck_preview_flag.isChecked():
                 if self.reconStepWindow is None:
+                    from reconStep_gui import ReconStepWindow
                     self.reconStepWindow = ReconStepWindow()
                 self.reconStepWindow.reset_window(iterations=self.param.n_iterations,
                                                   slider_interval=self.param.display_interval)
@@ -444,6 +475,7 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
 
             thread.update_signal.connect(self.update_recon_step)
             thread.finished.connect(self.resetButtons)
+            thread.exception_handler = self.exception_handler
             if batch_mode:
                 thread.finished.connect(self._batch_manager)
             #thread.finished.connect(self.reconStepWindow.debug)
@@ -608,27 +640,7 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
         Note the range is inclusive on both ends. 
         Ex: 1238 - 1242 with step size 2 --> [1238, 1240, 1242]
         '''
-        scan_range = []
-        scan_numbers = []
-        batch_items = self.le_batch_items.text()
-        every_nth_scan = self.sp_batch_step.value()
-
-        if batch_items == '':
-            raise ValueError("No item list is given for batch processing.")
-
-        # first parse items and separate them into two catogories
-        slist = batch_items.split(',')
-        for item in slist:
-            if '-' in item:
-                sublist = item.split('-')
-                scan_range.append((int(sublist[0].strip()), int(sublist[1].strip())))
-            else:
-                scan_numbers.append(int(item.strip()))
-    
-        # next generate all legit items from the chosen ranges and make a sorted item list
-        for item in scan_range:
-            scan_numbers = scan_numbers + list(range(item[0], item[1]+1, every_nth_scan))
-        scan_numbers.sort(reverse=True)
+        scan_numbers = parse_scan_range(self.le_batch_items.text(), self.sp_batch_step.value())
         print(scan_numbers)
 
         return scan_numbers
@@ -636,35 +648,104 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
 
     def batchStart(self):
         '''
-        Currently only support load from h5. 
+        Reconstruct from h5. With "Load from databroker", the scans are first preprocessed to h5
+        following the recipe of the last "save to h5".
         '''
         if self.cb_dataloader.currentText() == "Load from databroker":
-            print("[WARNING] Batch mode with databroker is not yet supported. Abort.", file=sys.stderr)
+            self._batchPreprocess()
             return
-        
+
         try:
-            self._scan_numbers = self.parse_scan_range()
-            # TODO: is there a way to lock all widgets to prevent accidental parameter changes in the middle?
-
-            # fire up
-            self.le_scan_num.textChanged.disconnect(self.forceLoad)
-            if self.ck_init_prb_batch_flag.isChecked():
-                filename = self.le_prb_path_batch.text()
-                self._batch_prb_filename = filename.split("*")
-            if self.ck_init_obj_batch_flag.isChecked():
-                filename = self.le_obj_path_batch.text()
-                self._batch_obj_filename = filename.split("*")
-            self._batch_manager() # serve as linked list's head
+            self._batchRecon(self.parse_scan_range())
         except Exception as ex:
             self.exception_handler(ex)
 
 
+    def _batchRecon(self, scan_numbers):
+        self._scan_numbers = scan_numbers
+        # TODO: is there a way to lock all widgets to prevent accidental parameter changes in the middle?
+
+        # fire up
+        self.le_scan_num.textChanged.disconnect(self.forceLoad)
+        if self.ck_init_prb_batch_flag.isChecked():
+            filename = self.le_prb_path_batch.text()
+            self._batch_prb_filename = filename.split("*")
+        if self.ck_init_obj_batch_flag.isChecked():
+            filename = self.le_obj_path_batch.text()
+            self._batch_obj_filename = filename.split("*")
+        self._batch_manager() # serve as linked list's head
+
+
+    def _batchPreprocess(self):
+        '''
+        Save the scans of the batch to h5 with a pool of processes, and reconstruct each of them
+        (as in the h5 batch mode) as soon as it is saved. The farm stays param.batch_prefetch_scans
+        scans ahead of the reconstruction, so the next scans are ready when the current one is done.
+        '''
+        if self._batch_thread is not None and self._batch_thread.isRunning():
+            print("[WARNING] The scans of the previous batch are still being saved, try again later.", file=sys.stderr)
+            return
+        try:
+            self.update_param_from_gui()
+            p = self.param
+            recipe_path = p.working_directory + '/' + RECIPE_FILENAME
+            if not os.path.isfile(recipe_path):
+                print("[WARNING] No preprocessing recipe found. Save one scan to h5 from the ROI window first. Abort.",
+                      file=sys.stderr)
+                return
+            recipe = PreprocessRecipe.load(recipe_path)
+            scan_numbers = self.parse_scan_range()
+        except Exception as ex:
+            self.exception_handler(ex)
+            return
+
+        self._batch_farm = PreprocessFarm(recipe, p, p.batch_save_processes, p.batch_prefetch_scans)
+        self._batch_preprocess = True
+        self._batch_saved = set()
+        self._batch_failed = set()
+        self._batch_waiting = False
+        # the reconstruction takes the scans from the end of the list
+        thread = self._batch_thread \
+               = HardWorker("preprocess_batch", self._batch_farm, scan_numbers[::-1])
+        thread.update_signal.connect(self._batchScanSaved)
+        thread.finished.connect(self._batchPreprocessDone)
+        thread.exception_handler = self.exception_handler
+        thread.start()
+
+        self.cb_dataloader.setCurrentText("Load from h5")
+        self._batchRecon(scan_numbers)
+
+
+    def _batchScanSaved(self, scan_num, error):
+        if error is None:
+            self._batch_saved.add(scan_num)
+        else:
+            self._batch_failed.add(scan_num)
+        if self._batch_waiting:
+            self._batch_waiting = False
+            self._batch_manager()
+
+
+    def _batchPreprocessDone(self):
+        # whatever the farm did not save will never come
+        if self._scan_numbers is not None:
+            self._batch_failed.update(set(self._scan_numbers) - self._batch_saved)
+        self._batch_farm = None
+        if self._batch_waiting:
+            self._batch_waiting = False
+            self._batch_manager()
+
+
     def batchStop(self):
         '''
         Brute-force abortion of the entire batch. No resumption is possible.
         '''
         #self._ptycho_gpu_thread.finished.disconnect(self._batch_manager)
         self._scan_numbers = None
+        self._batch_preprocess = False
+        self._batch_waiting = False
+        if self._batch_farm is not None:
+            self._batch_farm.cancel()
         self.le_scan_num.textChanged.connect(self.forceLoad)
         self.stop(True)
 
@@ -677,6 +758,19 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
         is not helping.
         '''
         # TODO: think what if anything goes wrong in the middle. Is this robust?
+        if self._scan_numbers is None:
+            return # stopped
+        if self._batch_preprocess:
+            # the scans are being saved by the farm
+            while len(self._scan_numbers) > 0 and self._scan_numbers[-1] in self._batch_failed:
+                print("[BATCH] skipping scan " + str(self._scan_numbers.pop()) + ", it could not be saved",
+                      file=sys.stderr)
+            if len(self._scan_numbers) > 0 and self._scan_numbers[-1] not in self._batch_saved:
+                print("[BATCH] waiting for scan " + str(self._scan_numbers[-1]) + " to be saved...")
+                self._batch_waiting = True
+                return
+            if len(self._scan_numbers) > 0 and self._batch_farm is not None:
+                self._batch_farm.release() # let the farm prepare one more
         if len(self._scan_numbers) > 0:
             scan_num = self._scan_numbers.pop()
             print("begin processing scan " + str(scan_num) + "...") 
@@ -688,6 +782,7 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
         else:
             print("batch processing complete!")
             self._scan_numbers = None
+            self._batch_preprocess = False
             self.le_scan_num.textChanged.connect(self.forceLoad)
             self.resetButtons()
 
@@ -715,6 +810,8 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
         Correspond to "View & set" in DPC GUI
         '''
         if _TEST:
+            from core.widgets.mplcanvas import load_image_pil
+            from roi_gui import RoiWindow
             image = load_image_pil('./test.tif')
             self.roiWindow = RoiWindow(image=image)
             self.roiWindow.roi_changed.connect(self._get_roi_slot)
@@ -745,6 +842,7 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
             self.exception_handler(ex)
         else:
             if self.roiWindow is None:
+                from roi_gui import RoiWindow
                 self.roiWindow = RoiWindow(image=img, main_window=self)
             else:
                 self.roiWindow.reset_window(image=img, main_window=self)
@@ -763,7 +861,12 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
             message += "Available frames for the chosen scan: [0, {1}]."
             raise ValueError(message.format(frame_num, length-1))
 
-        img = self.db.reg.retrieve(self._mds_table.iat[frame_num])[0]
+        # group the frames by resource once, then each view is a single slice
+        if self._frame_reader is None:
+            from core.HXN_databroker import get_frame_reader
+            self._frame_reader = get_frame_reader(self.db, self._mds_table, raw_cache=self.raw_cache,
+                                                  scan_num=int(self.param.scan_num))
+        img = self._frame_reader.read(frame_num, frame_num+1)[0]
         return img
 
 
@@ -777,9 +880,12 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
             message = "[ERROR] The {0}-th frame doesn't exist. "
             message += "Available frames for the chosen scan: [0, {1}]."
             raise ValueError(message.format(frame_num, length-1))
-        with h5py.File(working_dir+'/scan_'+scan_num+'.h5','r') as f:
+        import h5py
+        from core.ptycho_preprocess import read_diffamp
+        # swmr, in case the scan is still being saved live (see Param.live_save)
+        with h5py.File(working_dir+'/scan_'+scan_num+'.h5','r',swmr=True) as f:
             print("h5 loaded, parsing the {}-th frame...".format(frame_num), end='')
-            img = f['diffamp'][frame_num]
+            img = read_diffamp(f['diffamp'], frame_num)
             #data = f['diffamp'].value
             #img = data[frame_num]
             print("done")
@@ -800,6 +906,45 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
         print(x0, y0, width, height)
 
 
+    def setScanRoutes(self):
+        # which Broker holds which scans, from the config file (param.db_routes) or the default
+        from core.HXN_databroker import set_scan_routes
+        set_scan_routes(self.param.db_routes)
+
+
+    def warmUpDatabroker(self):
+        # connect to the databroker of the current scan in the background, once the window is up
+        if self.cb_dataloader.currentText() != "Load from databroker":
+            return
+        try:
+            scan_id = int(self.le_scan_num.text())
+        except ValueError:
+            return
+        routes = self.param.db_routes
+        def _run():
+            # the import itself takes a while, so it is done here too
+            try:
+                from core.HXN_databroker import set_scan_routes, warm_up
+                set_scan_routes(routes)
+                warm_up([scan_id]).join()
+            except ImportError as ex:
+                print('[!] Unable to import hxntools-related packages some features will '
+                      'be unavailable', file=sys.stderr)
+                print('[!] (import error: {})'.format(ex), file=sys.stderr)
+            except ValueError as ex:
+                print("[WARNING] {}".format(ex), file=sys.stderr)
+        threading.Thread(target=_run, daemon=True).start()
+
+
+    def showScanCatalog(self):
+        if self.catalogWindow is None:
+            from catalog_gui import CatalogWindow
+            self.catalogWindow = CatalogWindow(main_window=self)
+            if self.le_batch_items.text():
+                self.catalogWindow.le_scan_range.setText(self.le_batch_items.text())
+        self.catalogWindow.show()
+
+
     def loadExpParam(self): 
         scan_num = self.le_scan_num.text()
 
@@ -828,14 +973,13 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
     #@profile
     def _loadExpParamBroker(self, scan_id:int):
         self.db = scan_id # set the correct database
-        header = self.db[scan_id]
 
-        # get the list of detector names; TODO: a better way without ScanInfo?
-        scan = ScanInfo(header)
+        # get the list of detector names
         det_name = self.cb_detectorkind.currentText()
         det_name_exists = False
         self.cb_detectorkind.clear()
-        for detector_name in scan.filestore_keys:
+        from core.HXN_databroker import get_detectors
+        for detector_name in get_detectors(scan_id, self.metadata_cache):
             self.cb_detectorkind.addItem(detector_name)
             if det_name == detector_name:
                 det_name_exists = True
@@ -844,7 +988,7 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
 
         # get metadata
         thread = self._worker_thread \
-               = HardWorker("fetch_data", self.db, scan_id, det_name)
+               = HardWorker("fetch_data", scan_id, det_name, cache=self.metadata_cache)
         thread.update_signal.connect(self._setExpParamBroker)
         thread.finished.connect(lambda: self.btn_load_scan.setEnabled(True))
         thread.exception_handler = self.exception_handler
@@ -864,6 +1008,9 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
 
         # get the mds keys to the image (diffamp) array 
         self._mds_table = metadata['mds_table']
+        if self._frame_reader is not None:
+            self._frame_reader.close()
+            self._frame_reader = None
 
         # update experimental parameters
         self.sp_xray_energy.setValue(metadata['xray_energy_kev'])
@@ -882,6 +1029,19 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
         print("done")
 
 
+    def _setLiveSaveMetadata(self, num_frame, metadata:dict):
+        '''
+        Take the metadata of the frames saved so far by save_data_live, which works on a copy of
+        param in the HardWorker thread
+        '''
+        self.param.__dict__.update(metadata)
+        self._mds_table = metadata['mds_table']
+        if self._frame_reader is not None:
+            self._frame_reader.close()
+            self._frame_reader = None
+        self.sp_num_points.setValue(num_frame)
+
+
     def setLoadButton(self):
         if self.cb_dataloader.currentText() == "Load from databroker":
             self.cb_detectorkind.setEnabled(True)
@@ -896,6 +1056,7 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
     #@profile
     def _loadExpParamH5(self, scan_num:str):
         # load the parameters from the h5 in the working directory
+        import h5py
         working_dir = str(self.le_working_directory.text()) # self.param.working_directory
         with h5py.File(working_dir+'/scan_'+scan_num+'.h5','r') as f:
             # this code is not robust enough as certain keys may not be present...
@@ -955,13 +1116,8 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
 
 
     def _exportConfigHelper(self, filename:str):
-        with open(filename, 'w') as f:
-            f.write("[GUI]\n")
-            for key in self.param.__dict__:
-                # skip a few items related to databroker
-                if key == 'points' or key == 'ic' or key == 'mds_table':
-                    continue
-                f.write(key+" = "+str(self.param.__dict__[key])+"\n")
+        # skip a few items related to databroker
+        write_config(self.param, filename)
 
 
     def resetExperimentalParameters(self):
@@ -1020,6 +1176,14 @@ def main():
     w = MainWindow()
     w.show()
     app.installEventFilter(w)
+    if os.environ.get('PTYCHO_STARTUP_BENCHMARK'):
+        # report when the window is up and leave, see benchmark_startup.py
+        def _report():
+            print('[STARTUP] window shown at {:.6f}'.format(time.time()), file=sys.__stdout__, flush=True)
+            app.quit()
+        QtCore.QTimer.singleShot(0, _report)
+    else:
+        QtCore.QTimer.singleShot(0, w.warmUpDatabroker)
 
     console_stdout = PtychoStream(color = "black")
     console_stderr = PtychoStream(color = "red")
@@ -3,19 +3,12 @@ from PyQt5 import QtWidgets
 from ui import ui_roi
 
 import numpy as np
-from core.widgets.imgTools import find_outlier_pixels, find_brightest_pixels, rm_outlier_pixels
+from core.widgets.imgTools import find_outlier_pixels, find_brightest_pixels, BadPixelCorrector
 from core.ptycho_recon import HardWorker
+from core.ptycho_batch import PreprocessRecipe, RECIPE_FILENAME, save_options
 from core.widgets.badpixel_dialog import BadPixelDialog
 
 
-try:
-    from core.HXN_databroker import save_data
-except ImportError as ex:
-    print('[!] Unable to import core.HXN_databroker packages some features will '
-          'be unavailable')
-    print('[!] (import error: {})'.format(ex))
-
-
 class RoiWindow(QtWidgets.QMainWindow, ui_roi.Ui_MainWindow):
 
     def __init__(self, parent=None, image=None, param=None, main_window=None):
@@ -128,7 +121,8 @@ class RoiWindow(QtWidgets.QMainWindow, ui_roi.Ui_MainWindow):
         if badpixels is None: return
 
         img = self.canvas.image
-        img = rm_outlier_pixels(img, badpixels[0], badpixels[1])
+        # same correction as applied by save_data
+        img = BadPixelCorrector(badpixels[0], badpixels[1], img.shape)(img)
 
         self.canvas.draw_image(img)
         self.canvas.clear_overlay()
@@ -179,9 +173,33 @@ class RoiWindow(QtWidgets.QMainWindow, ui_roi.Ui_MainWindow):
         blue_rois = self.canvas.get_blue_roi()
         #print(blue_rois)
 
-        thread = self._worker_thread \
-               = HardWorker("save_h5", master.db, p, int(p.scan_num), self.roi_width, self.roi_height, 
-                                       self.cx, self.cy, threshold, badpixels, blue_rois)
+        # stream to h5 if a memory budget is set
+        mem_budget_mb = p.mem_budget_mb if p.mem_budget_mb > 0 else None
+
+        # keep the recipe, so that batch mode can apply it to other scans
+        recipe = PreprocessRecipe(self.roi_width, self.roi_height, self.cx, self.cy, threshold, badpixels, blue_rois)
+        recipe.save(p.working_directory + '/' + RECIPE_FILENAME)
+
+        if p.live_save:
+            # follow the scan while it is acquired
+            thread = self._worker_thread \
+                   = HardWorker("save_h5_live", master.db, p, int(p.scan_num), self.roi_width, self.roi_height,
+                                                self.cx, self.cy, threshold, badpixels, blue_rois,
+                                diffamp_dtype=p.diffamp_dtype, frames_per_chunk=p.diffamp_chunk_frames,
+                                compression=p.diffamp_compression)
+            thread.update_signal.connect(master._setLiveSaveMetadata)
+        elif p.mpi_save_processes > 0:
+            # preprocess on the MPI hosts; the caches are local to this machine and not used
+            thread = self._worker_thread \
+                   = HardWorker("save_h5_mpi", master.db, p, int(p.scan_num), self.roi_width, self.roi_height,
+                                               self.cx, self.cy, threshold, badpixels, blue_rois,
+                                mem_budget_mb=mem_budget_mb, diffamp_dtype=p.diffamp_dtype,
+                                frames_per_chunk=p.diffamp_chunk_frames, compression=p.diffamp_compression)
+        else:
+            thread = self._worker_thread \
+                   = HardWorker("save_h5", master.db, p, int(p.scan_num), self.roi_width, self.roi_height, 
+                                           self.cx, self.cy, threshold, badpixels, blue_rois,
+                                raw_cache=master.raw_cache, **save_options(p))
         thread.finished.connect(lambda: self.btn_save_to_h5.setEnabled(True))
         thread.exception_handler = master.exception_handler
         self.btn_save_to_h5.setEnabled(False)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules are imported as core.xxx, as ptycho_gui.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
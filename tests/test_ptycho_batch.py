@@ -0,0 +1,19 @@
+import numpy as np
+
+from core.ptycho_param import Param
+from core.ptycho_batch import PreprocessFarm
+
+
+def test_farm_takes_a_snapshot_of_param():
+    param = Param()
+    param.points = np.zeros((2, 10))
+    farm = PreprocessFarm(None, param, num_processes=1)
+
+    # what the GUI does to its param during the batch reconstruction
+    param.scan_num = '1'
+    param.points[:] = 1.
+    param.ic = np.ones(10)
+
+    assert farm.param.scan_num == Param().scan_num
+    assert not farm.param.points.any()
+    assert 'ic' not in farm.param.__dict__
@@ -0,0 +1,110 @@
+import os
+import errno
+
+from core.ptycho_cache import H5Cache
+
+
+def _write(path, content):
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _no_hardlinks(monkeypatch):
+    def link(src, dest):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+    monkeypatch.setattr(os, 'link', link)
+
+
+def test_store_and_link(tmp_path):
+    cache = H5Cache(str(tmp_path / 'cache'), 1.)
+    scan = str(tmp_path / 'scan.h5')
+    _write(scan, b'data')
+    cache.store('k', scan)
+    assert cache.link('k', scan)       # linking onto the file it came from
+    assert _read(scan) == b'data'
+    os.remove(scan)
+    assert cache.link('k', scan)
+    assert _read(scan) == b'data'
+    assert not cache.link('other', scan)
+
+
+def test_cross_device_copies(tmp_path, monkeypatch):
+    _no_hardlinks(monkeypatch)
+    cache = H5Cache(str(tmp_path / 'cache'), 1.)
+    scan = str(tmp_path / 'scan.h5')
+    _write(scan, b'data')
+    cache.store('k', scan)
+    entry = cache.lookup('k')
+    assert not os.path.islink(entry)
+
+    # a hit replaces the scan file, as save_data does, without losing the data
+    assert cache.link('k', scan)
+    assert not os.path.islink(scan)
+    assert _read(scan) == b'data'
+    os.remove(scan)
+    assert _read(entry) == b'data'
+    assert cache.link('k', scan)
+    assert _read(scan) == b'data'
+    assert os.listdir(str(tmp_path / 'cache')) == ['k.h5']
+
+
+def test_old_symlink_entry_is_dropped(tmp_path):
+    cache = H5Cache(str(tmp_path / 'cache'), 1.)
+    scan = str(tmp_path / 'scan.h5')
+    _write(scan, b'data')
+    os.symlink(scan, os.path.join(cache.directory, 'k.h5'))
+    assert not cache.link('k', scan)
+    assert _read(scan) == b'data'
+    assert cache.entries() == []
+
+
+def test_evict(tmp_path):
+    cache = H5Cache(str(tmp_path / 'cache'), 10. / 2**30) # 10 bytes
+    for i, key in enumerate('abc'):
+        src = str(tmp_path / (key + '.h5'))
+        _write(src, b'12345')
+        os.utime(src, (i, i))
+        cache.store(key, src)
+    assert [os.path.basename(p) for _, _, p in cache.entries()] == ['b.h5', 'c.h5']
+
+
+def test_raw_frame_store_created_once(tmp_path):
+    import threading
+    import numpy as np
+    from core.ptycho_cache import RawFrameCache
+
+    cache = RawFrameCache(str(tmp_path), 1.)
+    store = cache.open('scan', 4, (2, 3), np.uint16)
+    store.put(0, np.ones((2, 2, 3), dtype=np.uint16))
+    store.flush()
+
+    # the store exists now, so nobody creates (truncates) it again
+    stores = []
+    threads = [threading.Thread(target=lambda: stores.append(cache.open('scan', 4, (2, 3), np.uint16)))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(s.has(0, 2) and not s.has(2, 4) for s in stores)
+    assert sorted(name for name in os.listdir(str(tmp_path)) if not name.startswith('.')) == \
+        ['scan.filled.npy', 'scan.frames.npy']
+    assert cache.open('other', 4) is None
+
+
+def test_metadata_cache(tmp_path):
+    from core.ptycho_cache import MetadataCache
+    cache = MetadataCache(str(tmp_path / 'metadata.sqlite'))
+    assert cache.get('db1', 1, 'merlin1') is None
+    cache.put('db1', 1, 'merlin1', {'nz': 10})
+    cache.put('db1', 1, '__summary__', {'nz': 11})
+    # another instance on the same file sees the entries, each under its own key
+    cache = MetadataCache(str(tmp_path / 'metadata.sqlite'))
+    assert cache.get('db1', 1, 'merlin1') == {'nz': 10}
+    assert cache.get('db1', 1, '__summary__') == {'nz': 11}
+    assert cache.get('db2', 1, 'merlin1') is None
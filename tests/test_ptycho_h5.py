@@ -0,0 +1,48 @@
+import numpy as np
+import h5py
+import pytest
+
+from core.ptycho_h5 import layout_kwargs, benchmark_layouts
+
+
+def test_contiguous_by_default():
+    assert layout_kwargs(4, 5) == {}
+
+
+def test_chunks_clamped_to_num_frame():
+    assert layout_kwargs(4, 5, 16, num_frame=3)['chunks'] == (3, 4, 5)
+    assert layout_kwargs(4, 5, 16, num_frame=100)['chunks'] == (16, 4, 5)
+    # an empty dataset still needs a valid chunk shape
+    assert layout_kwargs(4, 5, 16, num_frame=0)['chunks'] == (1, 4, 5)
+
+
+def test_resizable_chunks_not_clamped():
+    kwargs = layout_kwargs(4, 5, 16, resizable=True, num_frame=3)
+    assert kwargs['chunks'] == (16, 4, 5)
+    assert kwargs['maxshape'] == (None, 4, 5)
+
+
+def test_compression_needs_chunks():
+    kwargs = layout_kwargs(4, 5, 0, 'gzip', num_frame=3)
+    assert kwargs['chunks'] == (1, 4, 5)
+    assert kwargs['shuffle'] and kwargs['compression'] == 'gzip'
+
+
+def test_unknown_compression():
+    with pytest.raises(ValueError):
+        layout_kwargs(4, 5, compression='bzip2')
+
+
+def test_more_frames_per_chunk_than_frames(tmp_path):
+    data = np.arange(3 * 4 * 5, dtype=np.float32).reshape(3, 4, 5)
+    with h5py.File(str(tmp_path / 'scan.h5'), 'w') as hf:
+        dset = hf.create_dataset('diffamp', data=data, **layout_kwargs(4, 5, 16, 'gzip', num_frame=3))
+        assert dset.chunks == (3, 4, 5)
+        np.testing.assert_array_equal(dset[()], data)
+
+
+def test_benchmark_small_sample(tmp_path):
+    data = np.random.RandomState(0).rand(4, 8, 8)
+    results = benchmark_layouts(data, [(0, ''), (16, ''), (16, 'gzip')], directory=str(tmp_path), num_reads=2)
+    assert [r['layout'] for r in results] == [(0, ''), (16, ''), (16, 'gzip')]
+
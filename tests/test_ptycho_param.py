@@ -0,0 +1,24 @@
+import os
+import numpy as np
+
+from core.ptycho_param import Param, DATA_SOURCE_KEYS, write_run_param, read_run_param
+
+
+def test_run_param_is_lean_and_per_run(tmp_path):
+    param = Param()
+    param.points = np.zeros((2, 1000))
+    param.ic = np.ones(1000)
+    param.mds_table = np.zeros(1000)
+    param.n_iterations = 123
+
+    first = write_run_param(param, str(tmp_path))
+    second = write_run_param(param, str(tmp_path))
+    assert first != second
+
+    read_back = read_run_param(first)
+    assert read_back.n_iterations == 123
+    assert not any(key in read_back.__dict__ for key in DATA_SOURCE_KEYS)
+    # the GUI's param is left alone
+    assert all(key in param.__dict__ for key in DATA_SOURCE_KEYS)
+    os.remove(first)
+    os.remove(second)
@@ -0,0 +1,132 @@
+import numpy as np
+import h5py
+import pytest
+
+from core.ptycho_preprocess import FramePreprocessor, finalize_diffamp, stores_counts
+from core.widgets.imgTools import BadPixelCorrector
+
+
+def _baseline_save_loop(frames, n, nn, cx, cy, ic, threshold, zero_out=None, correct=None):
+    # the per-frame loop save_data used before FramePreprocessor, with the bad pixel step passed in
+    data = np.zeros((frames.shape[0], n, nn))
+    for i in range(frames.shape[0]):
+        img = frames[i]
+        img = img * ic[0] / ic[i]
+        if correct is not None:
+            img = correct(img)
+        if zero_out is not None:
+            for blue_roi in zero_out:
+                x0, y0, w, h = blue_roi
+                img[y0:y0+h, x0:x0+w] = 0.
+        tmptmp = img[cy-nn//2:cy+nn//2, cx-n//2:cx+n//2]
+        tmptmp = np.rot90(tmptmp, axes=(1,0))
+        data[i] = np.fft.fftshift(tmptmp)
+    data[data < threshold] = 0.
+    return np.sqrt(data)
+
+
+def _raw_frames(num_frame=5, shape=(40, 50), seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.poisson(20., size=(num_frame,) + shape).astype(np.uint16), rng.uniform(0.5, 1.5, num_frame)
+
+
+def test_frame_preprocessor_matches_baseline_loop():
+    frames, ic = _raw_frames()
+    zero_out = [(20, 12, 4, 3), (0, 0, 2, 2)]
+    expected = _baseline_save_loop(frames, 16, 12, 22, 18, ic, 15., zero_out)
+    preprocessor = FramePreprocessor(frames.shape[1:], 16, 12, 22, 18, ic, zero_out=zero_out, threshold=15.)
+    # in two blocks, the second one starting at frame 2
+    result = np.concatenate([preprocessor.process(frames[:2], 0), preprocessor.process(frames[2:], 2)])
+    assert result.dtype == np.float64
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_bad_pixel_corrector():
+    frame = np.arange(25, dtype=np.float64).reshape(5, 5)
+    # (0, 0) is a corner, (1, 1) a neighbor of it; (3, 3) is surrounded by bad pixels
+    rows = [0, 1, 3, 2, 2, 2, 3, 3, 4, 4, 4]
+    cols = [0, 1, 3, 2, 3, 4, 2, 4, 2, 3, 4]
+    corrected = BadPixelCorrector(rows, cols, frame.shape)(frame.copy())
+    # the valid neighbors of (0, 0) are (0, 1) and (1, 0), (1, 1) being bad
+    assert corrected[0, 0] == np.median([1., 5.])
+    # those of (1, 1) are the pixels around it but (0, 0) and (2, 2)
+    assert corrected[1, 1] == np.median([1., 2., 5., 7., 10., 11.])
+    assert corrected[3, 3] == 0.
+    good = np.ones(frame.shape, dtype=bool)
+    good[rows, cols] = False
+    np.testing.assert_array_equal(corrected[good], frame[good])
+
+    # a stack is corrected frame by frame
+    stack = np.stack([frame, 2 * frame])
+    BadPixelCorrector(rows, cols, frame.shape)(stack)
+    np.testing.assert_array_equal(stack[1], 2 * corrected)
+
+
+def test_crop_first_matches_full_frame_correction():
+    frames, ic = _raw_frames(num_frame=3)
+    n, nn, cx, cy = 16, 12, 22, 18
+    # inside the ROI, on its border, in the 1-pixel margin, next to each other and far outside
+    rows = [18, 12, 11, 11, 18, 19, 30, 0]
+    cols = [22, 14, 13, 22, 30, 30, 45, 0]
+    corrector = BadPixelCorrector(rows, cols, frames.shape[1:])
+    expected = _baseline_save_loop(frames, n, nn, cx, cy, ic, 15., correct=corrector)
+    preprocessor = FramePreprocessor(frames.shape[1:], n, nn, cx, cy, ic, bad_pixels=[rows, cols], threshold=15.)
+    assert preprocessor.window_shape != frames.shape[1:]
+    np.testing.assert_array_equal(preprocessor.process(frames), expected)
+    # readers may deliver only the window
+    np.testing.assert_array_equal(preprocessor.process(frames[(slice(None),) + preprocessor.window]), expected)
+
+
+def test_finalize_diffamp_rounds_counts():
+    data = np.array([[[0.4, 2.4, 2.5, 2.6], [3.5, 1e6, 7., 0.]]])
+    zero_mask = np.array([[False, False, False, False], [False, False, True, False]])
+    counts = finalize_diffamp(data.copy(), 1., np.uint16, zero_mask)
+    assert counts.dtype == np.uint16
+    # below the threshold, rounded half to even, clipped, zeroed out
+    np.testing.assert_array_equal(counts, [[[0, 2, 2, 3], [4, 65535, 0, 0]]])
+    amplitudes = finalize_diffamp(data.copy(), 1., np.float64, zero_mask)
+    np.testing.assert_array_equal(amplitudes, np.sqrt([[[0., 2.4, 2.5, 2.6], [3.5, 1e6, 0., 0.]]]))
+
+    # the stored counts are the rounded squares of the amplitudes
+    frames, ic = _raw_frames()
+    expected = _baseline_save_loop(frames, 16, 12, 22, 18, ic, 15.)
+    preprocessor = FramePreprocessor(frames.shape[1:], 16, 12, 22, 18, ic, threshold=15., out_dtype=np.uint32)
+    np.testing.assert_array_equal(preprocessor.process(frames), np.rint(expected**2).astype(np.uint32))
+
+
+def test_stores_counts(tmp_path):
+    path = str(tmp_path / 'scan.h5')
+    assert not stores_counts(path)
+    with h5py.File(path, 'w') as hf:
+        hf.create_dataset('diffamp', data=np.zeros((2, 3, 3), dtype=np.uint16)).attrs['sqrt_on_load'] = True
+    assert stores_counts(path)
+    with h5py.File(path, 'w') as hf:
+        hf.create_dataset('diffamp', data=np.zeros((2, 3, 3)))
+    assert not stores_counts(path)
+
+
+def test_pipeline_serialized_stages_add_up():
+    from core.ptycho_preprocess import PreprocessPipeline
+    pipeline = PreprocessPipeline(serialized=('reader', 'writer'))
+    written = []
+    pipeline.run(iter(range(5)), lambda block: block * 2, written.append)
+    assert written == [0, 2, 4, 6, 8]
+    for name, busy in (('reader', 2.), ('compute', 3.), ('writer', 2.)):
+        pipeline.stats[name]['busy'] = busy
+    assert pipeline.report().endswith('limited by the reader + writer stage (serialized by the h5py lock)')
+    pipeline.serialized = ()
+    assert pipeline.report().endswith('limited by the compute stage')
+
+
+def test_fetch_blocks():
+    from core.ptycho_preprocess import ParallelFetcher
+    fetcher = ParallelFetcher(lambda key: np.full((2, 2), key), num_workers=2)
+    blocks = list(fetcher.fetch_blocks(range(5), 5, block_size=2))
+    assert [(start, stop) for start, stop, _ in blocks] == [(0, 2), (2, 4), (4, 5)]
+    np.testing.assert_array_equal(np.concatenate([frames for _, _, frames in blocks])[:, 0, 0], range(5))
+
+    # fewer keys than frames
+    with pytest.raises(ValueError, match='expected 5 frames, but only 3 keys'):
+        list(fetcher.fetch_blocks(range(3), 5, block_size=2))
+    with pytest.raises(ValueError, match='only 4 keys'):
+        list(fetcher.fetch_blocks(range(4), 5, block_size=2))
@@ -0,0 +1,97 @@
+import os
+import sys
+import subprocess
+
+import numpy as np
+import pytest
+
+from core.ptycho_progress import (ProgressServer, RecordDecoder, encode_record, iter_output_lines, ENV_VAR)
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SENDER = os.path.join(os.path.dirname(HERE), 'core', 'ptycho_progress.py')
+
+
+def test_decoder_in_pieces():
+    data = encode_record(3, [1., 2.], [3.], [4., 5., 6.], 0.25) + encode_record(4, [7.], [], [], 1.)
+    for size in (1, 5, len(data)):
+        decoder = RecordDecoder()
+        records = []
+        for start in range(0, len(data), size):
+            records += decoder.feed(data[start:start+size])
+        assert [r.iteration for r in records] == [3, 4]
+        np.testing.assert_array_equal(records[0].object_chi, [1., 2.])
+        np.testing.assert_array_equal(records[0].probe_chi, [3.])
+        np.testing.assert_array_equal(records[0].diff_chi, [4., 5., 6.])
+        assert records[0].elapsed == 0.25
+        assert records[1].probe_chi.size == 0 and records[1].diff_chi.size == 0
+
+
+def _run(code, progress=None, wait=False):
+    env = dict(os.environ, **progress.env) if progress is not None else None
+    process = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               env=env, cwd=os.path.dirname(HERE))
+    if wait:
+        process.wait()
+    return process, list(iter_output_lines(process, progress))
+
+
+def test_lines():
+    code = "import sys; sys.stdout.write('a\\nb'); sys.stdout.flush(); sys.stderr.write('c\\n')"
+    process, items = _run(code)
+    assert [line for stream, line in items if stream is sys.stdout] == ['a\n', 'b']
+    assert [line for stream, line in items if stream is sys.stderr] == ['c\n']
+    process.wait()
+
+
+def test_records_after_the_pipes_close():
+    # the records are only read once both pipes are closed, in the draining phase
+    code = ("import os; from core.ptycho_progress import ProgressClient\n"
+            "client = ProgressClient.from_env()\n"
+            "os.close(1); os.close(2)\n"
+            "for it in range(3): client.send(it, [it], [2. * it, 1.], [], 0.5)\n")
+    with ProgressServer() as progress:
+        process, items = _run(code, progress, wait=True)
+        assert process.returncode == 0
+        assert progress.connected
+    records = [item for stream, item in items if stream is None]
+    assert [r.iteration for r in records] == [0, 1, 2]
+    np.testing.assert_array_equal(records[2].probe_chi, [4., 1.])
+
+
+def test_stand_in_ranks():
+    # multislice-like: 3 object chi values per iteration
+    with ProgressServer() as progress:
+        process = subprocess.Popen([sys.executable, SENDER, '4', '3', '1', '1'], stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, env=dict(os.environ, **progress.env))
+        items = list(iter_output_lines(process, progress))
+        assert process.wait() == 0
+        path = progress.path
+    assert not os.path.exists(path)
+    records = [item for stream, item in items if stream is None]
+    lines = [line for stream, line in items if stream is sys.stdout]
+    assert [r.iteration for r in records] == [0, 1, 2, 3]
+    assert all(r.object_chi.shape == (3,) and r.elapsed > 0 for r in records)
+    assert len(lines) == 4 and lines[0].startswith('[INFO] DM 0 object_chi')
+
+
+def test_no_server():
+    env = dict(os.environ)
+    env.pop(ENV_VAR, None)
+    process = subprocess.Popen([sys.executable, SENDER, '1', '1', '1', '1'], stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, env=env)
+    items = list(iter_output_lines(process))
+    assert process.wait() == 0
+    assert [stream for stream, _ in items] == [sys.stdout]
+
+
+def test_parse_message():
+    pytest.importorskip('PyQt5')
+    from core.ptycho_param import Param
+    from core.ptycho_recon import PtychoReconWorker
+    param = Param()
+    param.multislice_flag = True
+    worker = PtychoReconWorker(param)
+    it, result = worker._parse_message('[INFO] DM 12 object_chi = [0.1 0.2] probe_chi = [ 0.3] diff_chi = 0.4'.split())
+    assert it == 12
+    assert result == {'object_chi': [0.1, 0.2], 'probe_chi': [0.3], 'diff_chi': [0.4]}
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+# Form implementation generated from reading ui file 'ui_catalog.ui'
+#
+# Created by: PyQt5 UI code generator 5.6
+#
+# WARNING! All changes made in this file will be lost!
+
+from PyQt5 import QtCore, QtGui, QtWidgets
+
+class Ui_MainWindow(object):
+    def setupUi(self, MainWindow):
+        MainWindow.setObjectName("MainWindow")
+        MainWindow.resize(820, 480)
+        self.centralwidget = QtWidgets.QWidget(MainWindow)
+        self.centralwidget.setObjectName("centralwidget")
+        self.verticalLayout = QtWidgets.QVBoxLayout(self.centralwidget)
+        self.verticalLayout.setObjectName("verticalLayout")
+        self.horizontalLayout = QtWidgets.QHBoxLayout()
+        self.horizontalLayout.setObjectName("horizontalLayout")
+        self.label = QtWidgets.QLabel(self.centralwidget)
+        self.label.setObjectName("label")
+        self.horizontalLayout.addWidget(self.label)
+        self.le_scan_range = QtWidgets.QLineEdit(self.centralwidget)
+        self.le_scan_range.setObjectName("le_scan_range")
+        self.horizontalLayout.addWidget(self.le_scan_range)
+        self.btn_load = QtWidgets.QPushButton(self.centralwidget)
+        self.btn_load.setMaximumSize(QtCore.QSize(80, 16777215))
+        self.btn_load.setObjectName("btn_load")
+        self.horizontalLayout.addWidget(self.btn_load)
+        self.verticalLayout.addLayout(self.horizontalLayout)
+        self.tw_scans = QtWidgets.QTableWidget(self.centralwidget)
+        self.tw_scans.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.tw_scans.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
+        self.tw_scans.setObjectName("tw_scans")
+        self.tw_scans.setColumnCount(8)
+        self.tw_scans.setRowCount(0)
+        item = QtWidgets.QTableWidgetItem()
+        self.tw_scans.setHorizontalHeaderItem(0, item)
+        item = QtWidgets.QTableWidgetItem()
+        self.tw_scans.setHorizontalHeaderItem(1, item)
+        item = QtWidgets.QTableWidgetItem()
+        self.tw_scans.setHorizontalHeaderItem(2, item)
+        item = QtWidgets.QTableWidgetItem()
+        self.tw_scans.setHorizontalHeaderItem(3, item)
+        item = QtWidgets.QTableWidgetItem()
+        self.tw_scans.setHorizontalHeaderItem(4, item)
+        item = QtWidgets.QTableWidgetItem()
+        self.tw_scans.setHorizontalHeaderItem(5, item)
+        item = QtWidgets.QTableWidgetItem()
+        self.tw_scans.setHorizontalHeaderItem(6, item)
+        item = QtWidgets.QTableWidgetItem()
+        self.tw_scans.setHorizontalHeaderItem(7, item)
+        self.verticalLayout.addWidget(self.tw_scans)
+        self.progressBar = QtWidgets.QProgressBar(self.centralwidget)
+        self.progressBar.setProperty("value", 0)
+        self.progressBar.setObjectName("progressBar")
+        self.verticalLayout.addWidget(self.progressBar)
+        self.horizontalLayout_2 = QtWidgets.QHBoxLayout()
+        self.horizontalLayout_2.setObjectName("horizontalLayout_2")
+        self.btn_use_selected = QtWidgets.QPushButton(self.centralwidget)
+        self.btn_use_selected.setObjectName("btn_use_selected")
+        self.horizontalLayout_2.addWidget(self.btn_use_selected)
+        self.btn_close = QtWidgets.QPushButton(self.centralwidget)
+        self.btn_close.setObjectName("btn_close")
+        self.horizontalLayout_2.addWidget(self.btn_close)
+        self.verticalLayout.addLayout(self.horizontalLayout_2)
+        MainWindow.setCentralWidget(self.centralwidget)
+
+        self.retranslateUi(MainWindow)
+        QtCore.QMetaObject.connectSlotsByName(MainWindow)
+
+    def retranslateUi(self, MainWindow):
+        _translate = QtCore.QCoreApplication.translate
+        MainWindow.setWindowTitle(_translate("MainWindow", "Scan catalog"))
+        self.label.setText(_translate("MainWindow", "Scans"))
+        self.le_scan_range.setToolTip(_translate("MainWindow", "Set scan numbers and ranges. Example: 2, 3-5, 7-15, 23, 30-55"))
+        self.btn_load.setText(_translate("MainWindow", "load"))
+        self.tw_scans.setSortingEnabled(True)
+        item = self.tw_scans.horizontalHeaderItem(0)
+        item.setText(_translate("MainWindow", "scan"))
+        item = self.tw_scans.horizontalHeaderItem(1)
+        item.setText(_translate("MainWindow", "scan type"))
+        item = self.tw_scans.horizontalHeaderItem(2)
+        item.setText(_translate("MainWindow", "points"))
+        item = self.tw_scans.horizontalHeaderItem(3)
+        item.setText(_translate("MainWindow", "energy (keV)"))
+        item = self.tw_scans.horizontalHeaderItem(4)
+        item.setText(_translate("MainWindow", "angle"))
+        item = self.tw_scans.horizontalHeaderItem(5)
+        item.setText(_translate("MainWindow", "step x"))
+        item = self.tw_scans.horizontalHeaderItem(6)
+        item.setText(_translate("MainWindow", "step y"))
+        item = self.tw_scans.horizontalHeaderItem(7)
+        item.setText(_translate("MainWindow", "detectors"))
+        self.btn_use_selected.setToolTip(_translate("MainWindow", "Put the selected scans in the batch mode scan list"))
+        self.btn_use_selected.setText(_translate("MainWindow", "use selected for batch"))
+        self.btn_close.setText(_translate("MainWindow", "close"))
+
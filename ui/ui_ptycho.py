@@ -870,10 +870,14 @@ class Ui_MainWindow(object):
         self.menu_save_config_history.setObjectName("menu_save_config_history")
         self.menu_clear_config_history = QtWidgets.QAction(MainWindow)
         self.menu_clear_config_history.setObjectName("menu_clear_config_history")
+        self.menu_scan_catalog = QtWidgets.QAction(MainWindow)
+        self.menu_scan_catalog.setObjectName("menu_scan_catalog")
         self.menuFile.addAction(self.menu_import_config)
         self.menuFile.addAction(self.menu_export_config)
         self.menuFile.addAction(self.menu_clear_config_history)
         self.menuFile.addAction(self.menu_save_config_history)
+        self.menuFile.addSeparator()
+        self.menuFile.addAction(self.menu_scan_catalog)
         self.menuBar.addAction(self.menuFile.menuAction())
 
         self.retranslateUi(MainWindow)
@@ -1012,4 +1016,6 @@ class Ui_MainWindow(object):
         self.menu_save_config_history.setText(_translate("MainWindow", "Save config history"))
         self.menu_save_config_history.setToolTip(_translate("MainWindow", "The config history is saved to \".ptycho_gui_config\" in the user\'s home directory when the \"start\" button is clicked"))
         self.menu_clear_config_history.setText(_translate("MainWindow", "Clear config history"))
+        self.menu_scan_catalog.setText(_translate("MainWindow", "Scan catalog"))
+        self.menu_scan_catalog.setToolTip(_translate("MainWindow", "List a range of scans from the databroker to choose the scans of a batch"))
 